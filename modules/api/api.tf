@@ -22,6 +22,12 @@ resource aws_api_gateway_resource query {
   path_part = "query"
 }
 
+resource aws_api_gateway_resource query-batch {
+  rest_api_id = aws_api_gateway_rest_api.BeaconApi.id
+  parent_id = aws_api_gateway_resource.query.id
+  path_part = "batch"
+}
+
 resource aws_api_gateway_resource s3response {
   rest_api_id = aws_api_gateway_rest_api.BeaconApi.id
   parent_id = aws_api_gateway_rest_api.BeaconApi.root_resource_id
@@ -429,6 +435,107 @@ resource aws_api_gateway_integration_response query-post {
   depends_on = [aws_api_gateway_integration.query-post]
 }
 
+resource aws_api_gateway_method query-batch-options {
+  rest_api_id = aws_api_gateway_rest_api.BeaconApi.id
+  resource_id = aws_api_gateway_resource.query-batch.id
+  http_method = "OPTIONS"
+  authorization = "NONE"
+}
+
+resource aws_api_gateway_method_response query-batch-options {
+  rest_api_id = aws_api_gateway_method.query-batch-options.rest_api_id
+  resource_id = aws_api_gateway_method.query-batch-options.resource_id
+  http_method = aws_api_gateway_method.query-batch-options.http_method
+  status_code = "200"
+
+  response_parameters = {
+    "method.response.header.Access-Control-Allow-Headers" = true
+    "method.response.header.Access-Control-Allow-Methods" = true
+    "method.response.header.Access-Control-Allow-Origin" = true
+  }
+
+  response_models = {
+    "application/json" = "Empty"
+  }
+}
+
+resource aws_api_gateway_integration query-batch-options {
+  rest_api_id = aws_api_gateway_method.query-batch-options.rest_api_id
+  resource_id = aws_api_gateway_method.query-batch-options.resource_id
+  http_method = aws_api_gateway_method.query-batch-options.http_method
+  type = "MOCK"
+
+  request_templates = {
+    "application/json" = <<TEMPLATE
+      {
+        "statusCode": 200
+      }
+    TEMPLATE
+  }
+}
+
+resource aws_api_gateway_integration_response query-batch-options {
+  rest_api_id = aws_api_gateway_method.query-batch-options.rest_api_id
+  resource_id = aws_api_gateway_method.query-batch-options.resource_id
+  http_method = aws_api_gateway_method.query-batch-options.http_method
+  status_code = aws_api_gateway_method_response.query-batch-options.status_code
+
+  response_parameters = {
+    "method.response.header.Access-Control-Allow-Headers" = "'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token'"
+    "method.response.header.Access-Control-Allow-Methods" = "'OPTIONS,POST'"
+    "method.response.header.Access-Control-Allow-Origin" = "'*'"
+  }
+
+  response_templates = {
+    "application/json" = ""
+  }
+
+  depends_on = [aws_api_gateway_integration.query-batch-options]
+}
+
+resource aws_api_gateway_method query-batch-post {
+  rest_api_id = aws_api_gateway_rest_api.BeaconApi.id
+  resource_id = aws_api_gateway_resource.query-batch.id
+  http_method = "POST"
+  authorization = "NONE"
+}
+
+resource aws_api_gateway_method_response query-batch-post {
+  rest_api_id = aws_api_gateway_method.query-batch-post.rest_api_id
+  resource_id = aws_api_gateway_method.query-batch-post.resource_id
+  http_method = aws_api_gateway_method.query-batch-post.http_method
+  status_code = "200"
+
+  response_parameters = {
+    "method.response.header.Access-Control-Allow-Origin" = true
+  }
+
+  response_models = {
+    "application/json" = "Empty"
+  }
+}
+
+resource aws_api_gateway_integration query-batch-post {
+  rest_api_id = aws_api_gateway_method.query-batch-post.rest_api_id
+  resource_id = aws_api_gateway_method.query-batch-post.resource_id
+  http_method = aws_api_gateway_method.query-batch-post.http_method
+  type = "AWS_PROXY"
+  uri = module.lambda-queryDatasets.function_invoke_arn
+  integration_http_method = "POST"
+}
+
+resource aws_api_gateway_integration_response query-batch-post {
+  rest_api_id = aws_api_gateway_method.query-batch-post.rest_api_id
+  resource_id = aws_api_gateway_method.query-batch-post.resource_id
+  http_method = aws_api_gateway_method.query-batch-post.http_method
+  status_code = aws_api_gateway_method_response.query-batch-post.status_code
+
+  response_templates = {
+    "application/json" = ""
+  }
+
+  depends_on = [aws_api_gateway_integration.query-batch-post]
+}
 
 resource aws_api_gateway_method s3response-options {
   rest_api_id = aws_api_gateway_rest_api.BeaconApi.id
@@ -587,6 +694,14 @@ resource aws_api_gateway_deployment BeaconApi {
     aws_api_gateway_integration.query-post.id,
     aws_api_gateway_integration_response.query-post.id,
     aws_api_gateway_method_response.query-post.id,
+    aws_api_gateway_method.query-batch-options.id,
+    aws_api_gateway_integration.query-batch-options.id,
+    aws_api_gateway_integration_response.query-batch-options.id,
+    aws_api_gateway_method_response.query-batch-options.id,
+    aws_api_gateway_method.query-batch-post.id,
+    aws_api_gateway_integration.query-batch-post.id,
+    aws_api_gateway_integration_response.query-batch-post.id,
+    aws_api_gateway_method_response.query-batch-post.id,
     aws_api_gateway_method.s3response-options.id,
     aws_api_gateway_integration.s3response-options.id,
     aws_api_gateway_integration_response.s3response-options.id,
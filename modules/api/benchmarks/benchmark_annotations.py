@@ -0,0 +1,159 @@
+"""
+Compares splitQuery's lookups of variant annotations from the block index
+submitDataset builds with scanning the whole annotation tsv, for queries
+matching various numbers of variants.
+
+    python benchmark_annotations.py [--s3-ms 25] [--mbps 500]
+
+get_annotations runs against an in-memory stand-in for S3 that counts the
+calls made and bytes read. Latency is the measured time plus the given
+time to first byte for each call and --mbps for the bytes transferred.
+The index is already loaded, as it is in a warm container.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SPLIT_QUERY_DIR = os.path.join(BENCHMARKS_DIR, '..', 'lambda', 'splitQuery')
+
+ANNOTATION_LOCATION = 's3://benchmark/annotations.tsv'
+GENOME_LENGTH = 29903
+EXTRA_COLUMNS = 20
+MATCHED_VARIANTS = (1, 10, 100, 1000, 10000)
+
+
+class StreamingBody(io.BytesIO):
+    def iter_lines(self):
+        return iter(self.getvalue().splitlines())
+
+
+class RecordingBucket:
+    """
+    Stands in for splitQuery's S3Client, holding objects in memory.
+    """
+    def __init__(self):
+        self.objects = {}
+        self.calls = 0
+        self.bytes_read = 0
+
+    def get_object(self, bucket, key, byte_range=None):
+        body = self.objects[key]
+        if byte_range is not None:
+            body = body[byte_range[0]:byte_range[1]]
+        self.calls += 1
+        self.bytes_read += len(body)
+        return StreamingBody(body)
+
+
+def make_annotations():
+    random.seed(0)
+    fieldnames = (['Variant', 'SIFT_score']
+                  + [f'Column{i}' for i in range(EXTRA_COLUMNS)])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter='\t', lineterminator='\n')
+    writer.writerow(fieldnames)
+    variants = []
+    for pos in range(1, GENOME_LENGTH + 1):
+        ref = random.choice('ACGT')
+        for alt in 'ACGT':
+            if alt == ref:
+                continue
+            variant = f'{pos}{ref}>{alt}'
+            variants.append(variant)
+            writer.writerow(
+                [variant, random.choice(['.', f'{random.random():.2f}'])]
+                + [random.choice(['.', 'missense', 'synonymous', 'ORF1ab'])
+                   for _ in range(EXTRA_COLUMNS)])
+    # Annotation files aren't necessarily in position order
+    lines = buffer.getvalue().splitlines()
+    body = lines[:1] + random.sample(lines[1:], len(lines) - 1)
+    return '\n'.join(body).encode(), variants
+
+
+def measure(split_query, bucket, annotation_index, variants, args, repeats):
+    best = None
+    for _ in range(repeats):
+        bucket.calls = bucket.bytes_read = 0
+        start = time.perf_counter()
+        split_query.get_annotations(ANNOTATION_LOCATION, annotation_index,
+                                    variants)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    transfer_ms = bucket.bytes_read * 8 / (args.mbps * 1000)
+    return {
+        'round_trips': bucket.calls,
+        'bytes_read': bucket.bytes_read,
+        'latency_ms': 1000 * best + bucket.calls * args.s3_ms + transfer_ms,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--s3-ms', type=float, default=25,
+                        help="Time to first byte of an S3 GetObject")
+    parser.add_argument('--mbps', type=float, default=500,
+                        help="Throughput from S3")
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    for variable in ('CACHE_BUCKET', 'CACHE_TABLE', 'INDEX_BUCKET',
+                     'PERFORM_QUERY_LAMBDA', 'RESPONSE_BUCKET'):
+        os.environ.setdefault(variable, 'benchmark')
+    os.environ.setdefault('LAMBDA_TASK_ROOT', SPLIT_QUERY_DIR)
+    os.environ.setdefault('SAMPLE_ENCODING', 'varint')
+    os.environ.setdefault('SPLIT_SIZE', '1000000')
+    sys.path.insert(0, SPLIT_QUERY_DIR)
+    import lambda_function as split_query
+    from annotation_index import build_index
+
+    tsv, all_variants = make_annotations()
+    bucket = RecordingBucket()
+    split_query.s3 = bucket
+    bucket.objects[ANNOTATION_LOCATION.split('/', 3)[3]] = tsv
+    start = time.perf_counter()
+    index, index_key, blocks = build_index(
+        (line.decode() for line in StreamingBody(tsv).iter_lines()),
+        ANNOTATION_LOCATION)
+    build_seconds = time.perf_counter() - start
+    bucket.objects[index_key] = json.dumps(index).encode()
+    bucket.objects[index['blocksKey']] = blocks
+    print(f"tsv of {len(all_variants)} variants, {len(tsv)} bytes; index"
+          f" of {len(index['blocks'])} blocks, {len(blocks)} bytes, built in"
+          f" {build_seconds:.2f}s")
+    print(f"{'variants':>8} {'scan trips':>10} {'index trips':>11}"
+          f" {'scan bytes':>10} {'index bytes':>11}"
+          f" {'scan ms':>8} {'index ms':>8}")
+    stdout = sys.stdout
+    for variant_count in MATCHED_VARIANTS:
+        random.seed(variant_count)
+        # A query's variants are usually close together
+        first = random.randrange(len(all_variants) - variant_count)
+        variants = set(all_variants[first:first + variant_count])
+        # splitQuery logs every S3 call, which would swamp the results
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            # Loads the index
+            split_query.get_annotations(ANNOTATION_LOCATION, index_key,
+                                        variants)
+            scan = measure(split_query, bucket, None, variants, args,
+                           args.repeats)
+            indexed = measure(split_query, bucket, index_key, variants, args,
+                              args.repeats)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        print(f"{variant_count:>8} {scan['round_trips']:>10}"
+              f" {indexed['round_trips']:>11} {scan['bytes_read']:>10}"
+              f" {indexed['bytes_read']:>11} {scan['latency_ms']:>8.1f}"
+              f" {indexed['latency_ms']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""
+Compares FanOut, with a lambda client sized to its concurrency, against the
+previous thread per call sharing a default lambda client, when fanning
+out invocations.
+
+    python benchmark_fan_out.py [--calls 50 200 500] [--latency-ms 100]
+
+Invocations go to a local HTTP server standing in for Lambda, which takes
+--latency-ms to answer each one and counts the connections opened. It
+runs in its own process, so the threads counted are the caller's. Both
+schemes make the same invoke calls through boto3.
+"""
+import argparse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+
+import boto3
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SHARED_RESOURCES_DIR = os.path.join(BENCHMARKS_DIR, '..', 'shared_resources')
+
+CONCURRENCY = 200
+
+
+class LambdaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.connections.get_lock():
+            self.server.connections.value += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        time.sleep(self.server.latency)
+        body = json.dumps({'exists': False}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LambdaServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, latency, connections):
+        super().__init__(('127.0.0.1', 0), LambdaHandler)
+        self.latency = latency
+        self.connections = connections
+
+
+def serve(latency, connections, ports):
+    server = LambdaServer(latency, connections)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+def make_client(port, **config):
+    from botocore.config import Config
+    return boto3.client(
+        'lambda', endpoint_url=f'http://127.0.0.1:{port}',
+        config=Config(retries={'max_attempts': 0}, **config))
+
+
+def invoke(client):
+    response = client.invoke(FunctionName='benchmark', Payload=b'{}')
+    return json.loads(response['Payload'].read())
+
+
+def thread_per_call(client, calls):
+    responses = queue.Queue()
+    for _ in range(calls):
+        threading.Thread(target=lambda: responses.put(invoke(client))).start()
+    for _ in range(calls):
+        responses.get()
+
+
+def fan_out(client, calls, fan_out_module):
+    with fan_out_module.FanOut('benchmark', CONCURRENCY) as calls_out:
+        for _ in range(calls):
+            calls_out.submit(lambda: invoke(client), error_result={})
+        for _ in calls_out.results():
+            pass
+
+
+def measure(connections, scheme, calls):
+    connections.value = 0
+    peak_threads = threading.active_count()
+    finished = threading.Event()
+
+    def sample_threads():
+        nonlocal peak_threads
+        while not finished.wait(0.005):
+            peak_threads = max(peak_threads, threading.active_count())
+
+    sampler = threading.Thread(target=sample_threads)
+    sampler.start()
+    start = time.perf_counter()
+    scheme(calls)
+    seconds = time.perf_counter() - start
+    finished.set()
+    sampler.join()
+    return {
+        'seconds': seconds,
+        'connections': connections.value,
+        # Not counting the sampler
+        'peak_threads': peak_threads - 1,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--calls', type=int, nargs='+',
+                        default=[50, 200, 500])
+    parser.add_argument('--latency-ms', type=float, default=100)
+    args = parser.parse_args()
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    sys.path.insert(0, SHARED_RESOURCES_DIR)
+    import fan_out as fan_out_module
+    # urllib3 warns for every connection it discards from a full pool
+    logging.getLogger('urllib3').setLevel(logging.ERROR)
+
+    connections = multiprocessing.Value('i', 0)
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=serve, args=(args.latency_ms / 1000, connections, ports),
+        daemon=True)
+    server.start()
+    port = ports.get()
+    default_client = make_client(port)
+    sized_client = make_client(port, max_pool_connections=CONCURRENCY)
+    # The FanOut logs a summary of latencies, which would swamp the results
+    stdout = sys.stdout
+    print(f"{'calls':>6} {'old s':>7} {'new s':>7} {'old conns':>9}"
+          f" {'new conns':>9} {'old threads':>11} {'new threads':>11}")
+    for calls in args.calls:
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            old = measure(
+                connections, lambda n: thread_per_call(default_client, n),
+                calls)
+            new = measure(
+                connections,
+                lambda n: fan_out(sized_client, n, fan_out_module), calls)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        print(f"{calls:>6} {old['seconds']:>7.2f} {new['seconds']:>7.2f}"
+              f" {old['connections']:>9} {new['connections']:>9}"
+              f" {old['peak_threads']:>11} {new['peak_threads']:>11}")
+    server.terminate()
+
+
+if __name__ == '__main__':
+    main()
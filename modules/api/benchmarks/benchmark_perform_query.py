@@ -0,0 +1,263 @@
+"""
+Measures performQuery's perform_queries over synthetic `bcftools query`
+output, reporting records per second, peak RSS and traced allocations for
+each case as JSON.
+
+    python benchmark_perform_query.py [--full] [--output results.json]
+
+Each case runs in a fresh interpreter so its peak RSS isn't inflated by
+earlier cases. The default runs vary one dimension at a time from a
+baseline case. --full runs every combination.
+"""
+import argparse
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+PERFORM_QUERY_DIR = os.path.join(BENCHMARKS_DIR, '..', 'lambda',
+                                 'performQuery')
+
+# Keeps the generated stream to roughly this many bytes of genotypes
+STREAM_BYTES = 50 * 2**20
+MIN_RECORDS = 20
+MAX_RECORDS = 5000
+GENOTYPE_TEMPLATES = 4
+
+BASELINE = {
+    'sample_count': 10000,
+    'allele_count': 2,
+    'ac_an': True,
+    'ploidy': 1,
+    'variant_type': 'SNP',
+    'include_details': True,
+}
+
+DIMENSIONS = {
+    'sample_count': [1000, 10000, 100000, 500000],
+    'allele_count': [1, 2, 3],
+    'ac_an': [True, False],
+    'ploidy': [1, 2],
+    'variant_type': ['SNP', 'DEL', 'INS', 'DUP', 'DUP:TANDEM', 'CNV'],
+    'include_details': [True, False],
+}
+
+# REF and candidate ALTs that exercise each variant_type branch
+VARIANT_ALLELES = {
+    'SNP': ('A', ['C', 'G', 'T']),
+    'DEL': ('ACGT', ['A', '<DEL>', 'AC']),
+    'INS': ('A', ['ACGT', '<INS>', 'AC']),
+    'DUP': ('AC', ['ACAC', '<DUP>', '<CN3>']),
+    'DUP:TANDEM': ('AC', ['ACAC', '<DUP:TANDEM>', '<CN2>']),
+    'CNV': ('A', ['<CNV>', '<CN0>', '<DEL>']),
+}
+
+
+class SyntheticVcf:
+    """
+    Stands in for subprocess.Popen running `bcftools query`, producing
+    records in whichever --format perform_queries asks for.
+    """
+    def __init__(self, sample_count, allele_count, ac_an, ploidy,
+                 variant_type, records):
+        self.records = records
+        self.records_read = 0
+        reference, alts = VARIANT_ALLELES[variant_type]
+        self.reference = reference.encode()
+        self.all_alts = ','.join(alts[:allele_count]).encode()
+        random_state = np.random.RandomState(0)
+        self.templates = [
+            self._make_template(random_state, sample_count, allele_count,
+                                ac_an, ploidy)
+            for _ in range(GENOTYPE_TEMPLATES)
+        ]
+
+    def __call__(self, args, **kwargs):
+        query_format = args[args.index('--format') + 1]
+        self.stdout = self._generate(scan='[%GT,]' not in query_format)
+        return self
+
+    def _generate(self, scan):
+        for pos in range(1, self.records + 1):
+            info, alt_counts, total_count, genotypes = self.templates[
+                pos % len(self.templates)]
+            self.records_read += 1
+            prefix = b'%d\t%s\t%s\t' % (pos, self.reference, self.all_alts)
+            if scan:
+                yield prefix + alt_counts + b'\t' + total_count + b'\n'
+            else:
+                yield prefix + info + b'\t' + genotypes + b'\n'
+
+    @staticmethod
+    def _make_template(random_state, sample_count, allele_count, ac_an,
+                       ploidy):
+        # Mostly reference calls, with some missing and some of each alt
+        weights = np.array([8, 1] + [1] * allele_count, dtype=float)
+        codes = np.array([b'0', b'.'] + [str(i + 1).encode()
+                                         for i in range(allele_count)])
+        calls = codes[random_state.choice(len(codes),
+                                          size=(sample_count, ploidy),
+                                          p=weights / weights.sum())]
+        columns = np.full((sample_count, 2 * ploidy), b'/', dtype='S1')
+        columns[:, 0::2] = calls
+        columns[:, -1] = b','
+        genotypes = columns.tobytes()
+        called = calls[calls != b'.'].astype(int)
+        counts = np.bincount(called, minlength=allele_count + 1)
+        alt_counts = ','.join(str(count) for count in counts[1:]).encode()
+        total_count = str(len(called)).encode()
+        if ac_an:
+            info = b'AC=' + alt_counts + b';AN=' + total_count
+        else:
+            info = b'DP=30'
+            alt_counts = b'.'
+            total_count = b'.'
+        return info, alt_counts, total_count, genotypes
+
+
+def get_query(variant_type):
+    # SNPs are queried by their alternate bases rather than a variant type
+    if variant_type == 'SNP':
+        return 'N', 'N', None
+    return 'N', None, variant_type
+
+
+def run_case(case, repeats):
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('LAMBDA_TASK_ROOT', PERFORM_QUERY_DIR)
+    os.environ.setdefault('INDEX_BUCKET', 'benchmark')
+    os.environ.setdefault('RESPONSE_BUCKET', 'benchmark')
+    sys.path.insert(0, PERFORM_QUERY_DIR)
+    import lambda_function as perform_query_lambda
+
+    genotype_bytes = 2 * case['ploidy'] * case['sample_count']
+    records = max(MIN_RECORDS,
+                  min(MAX_RECORDS, STREAM_BYTES // genotype_bytes))
+    vcf = SyntheticVcf(case['sample_count'], case['allele_count'],
+                       case['ac_an'], case['ploidy'], case['variant_type'],
+                       records)
+    reference_bases, alternate_bases, variant_type = get_query(
+        case['variant_type'])
+    scan = not case['include_details'] and case['ac_an']
+
+    queries = [{
+        'reference_bases': reference_bases,
+        'region_start': 1,
+        'region_end': records,
+        'end_min': 1,
+        'end_max': 2**31,
+        'alternate_bases': alternate_bases,
+        'variant_type': variant_type,
+        'include_details': case['include_details'],
+    }]
+
+    def query():
+        vcf.records_read = 0
+        (result,), = perform_query_lambda.perform_queries(
+            queries, 'synthetic.vcf.gz', '1', [(1, records)], scan=scan,
+            info_tags={'AC', 'AN'}, popen=vcf)
+        return result
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = query()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Tracing slows the query down, so it gets its own untimed run
+    blocks_before = sys.getallocatedblocks()
+    tracemalloc.start()
+    query()
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    retained_blocks = sys.getallocatedblocks() - blocks_before
+
+    return dict(
+        case,
+        records=records,
+        records_read=vcf.records_read,
+        seconds=best,
+        records_per_second=vcf.records_read / best,
+        rss_before_kb=rss_before,
+        peak_rss_kb=peak_rss,
+        traced_peak_bytes=traced_peak,
+        retained_blocks=retained_blocks,
+        exists=result['exists'],
+        call_count=result['call_count'],
+        variants=len(result['variant_samples']),
+    )
+
+
+def get_cases(full):
+    if full:
+        names = list(DIMENSIONS)
+        return [
+            dict(zip(names, values))
+            for values in itertools.product(*DIMENSIONS.values())
+        ]
+    cases = [BASELINE]
+    for name, values in DIMENSIONS.items():
+        cases += [
+            dict(BASELINE, **{name: value})
+            for value in values
+            if value != BASELINE[name]
+        ]
+    return cases
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=BENCHMARKS_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--full', action='store_true',
+                        help="Run every combination of the dimensions")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', help="Write the results to this file")
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case), args.repeats)))
+        return
+    results = []
+    for case in get_cases(args.full):
+        print(f"Running {json.dumps(case)}", file=sys.stderr)
+        output = subprocess.check_output([
+            sys.executable, os.path.abspath(__file__),
+            '--repeats', str(args.repeats),
+            '--run-case', json.dumps(case),
+        ])
+        # performQuery prints as it goes, the result is the last line
+        results.append(json.loads(output.splitlines()[-1]))
+    report = json.dumps({
+        'commit': get_commit(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'results': results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
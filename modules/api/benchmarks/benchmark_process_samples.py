@@ -0,0 +1,301 @@
+"""
+Times splitQuery's process_samples, which aggregates the sample metadata
+of a query's hits, over synthetic datasets of various sizes.
+
+    python benchmark_process_samples.py [--carriers N] [--repeats N]
+
+The metadata is served as summariseVcf builds it, from an in-memory
+stand-in for S3. Timings are of warm calls, once the columns are loaded.
+At each size the output is first checked to be identical, down to the
+order of keys and lists, to that of the Counter based implementation it
+replaced, which is timed alongside it. The reference's samples of each
+variant are sorted first, as it listed them in the order of a set.
+"""
+import argparse
+from collections import Counter, defaultdict
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SPLIT_QUERY_DIR = os.path.join(BENCHMARKS_DIR, '..', 'lambda', 'splitQuery')
+
+SAMPLE_COUNTS = (10000, 100000, 1000000)
+FIELDS = ['Location', 'SampleCollectionDate', 'State']
+LOCATIONS = ['Australia/Victoria', 'Australia/NSW', 'China/Hubei',
+             'United States/WA', 'United States/NY', 'India/Gujarat', 'Brazil',
+             '']
+VCFS = ('s3://benchmark/first.vcf.gz', 's3://benchmark/second.vcf.gz')
+VARIANTS = 50
+
+
+class MetadataBucket:
+    """
+    Stands in for splitQuery's S3Client, serving prebuilt metadata columns.
+    """
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, bucket, key, byte_range=None):
+        return io.BytesIO(self.objects[key])
+
+    def get_changed_object(self, bucket, key, etag=None):
+        return key, io.BytesIO(self.objects[key])
+
+
+def build_metadata(bucket, vcf_location, sample_count, sample_metadata,
+                   country_codes):
+    random.seed(sample_count)
+    rows = [
+        [random.choice(LOCATIONS),
+         f'2020-{random.randint(1, 12):02}-{random.randint(1, 28):02}']
+        for _ in range(sample_count)
+    ]
+    columns = sample_metadata.build_columns(
+        ['Location', 'SampleCollectionDate'], rows, country_codes)
+    build = sample_metadata.get_build(columns)
+    for field, (codes, values) in columns.items():
+        codes_key, values_key = sample_metadata.get_column_keys(
+            vcf_location, build, field)
+        codes_buffer = io.BytesIO()
+        np.save(codes_buffer, codes)
+        bucket.objects[codes_key] = codes_buffer.getvalue()
+        bucket.objects[values_key] = json.dumps(values).encode()
+    bucket.objects[sample_metadata.get_manifest_key(vcf_location)] = (
+        json.dumps({
+            'build': build,
+            'sampleCount': sample_count,
+            'fields': sorted(columns),
+        }).encode())
+
+
+def reference_process_samples(split_query, variants, fields):
+    """
+    process_samples as it was before it counted values with bincounts,
+    expanding the metadata columns to a list of values for every sample.
+    """
+    vcf_offsets = {}
+    all_sample_details = []
+    included_samples = set()
+    uncompressed_variants = {}
+
+    for variant, location_samples in variants.items():
+        variant_samples = set()
+        for vcf_location, sample_indexes in location_samples.items():
+            if vcf_location not in vcf_offsets:
+                columns = split_query.get_sample_columns(vcf_location,
+                                                         fields)
+                if columns is None:
+                    offset = -1
+                else:
+                    offset = len(all_sample_details)
+                    all_sample_details += [
+                        list(sample)
+                        for sample in zip(*(
+                            np.array(values, dtype=object)[codes]
+                            for codes, values in columns
+                        ))
+                    ]
+                vcf_offsets.update({vcf_location: offset})
+            else:
+                offset = vcf_offsets[vcf_location]
+            if offset == -1:
+                continue
+            variant_samples.update(
+                s_i + offset
+                for s_i in sample_indexes
+            )
+        uncompressed_variants[variant] = variant_samples
+        included_samples |= variant_samples
+
+    extra_fields = {}
+
+    for field_i, field in enumerate(fields):
+        if field == 'Location':
+            location_counts_dict = Counter(
+                sample[field_i]
+                for sample in all_sample_details
+            )
+            extra_fields['locationCounts'] = [
+                {
+                    location: count,
+                }
+                for location, count in location_counts_dict.items()
+            ]
+        elif field == 'SampleCollectionDate':
+            date_counts_dict = Counter(
+                sample[field_i]
+                for sample in all_sample_details
+            )
+            extra_fields['dateCounts'] = sorted(
+                [
+                    {
+                        date: count,
+                    }
+                    for date, count in date_counts_dict.items()
+                ],
+                key=lambda x: list(x.keys())[0]
+            )
+        elif field == 'State':
+            state_counts_dict = Counter(
+                sample[field_i]
+                for sample in all_sample_details
+            )
+            extra_fields['stateCounts'] = [
+                {
+                    state: count,
+                }
+                for state, count in state_counts_dict.items()
+            ]
+
+    for value_field, counts_field in (('Location', 'locationDateCounts'),
+                                      ('State', 'stateDateCounts')):
+        if {'SampleCollectionDate', value_field} <= set(fields):
+            value_i = fields.index(value_field)
+            date_i = fields.index('SampleCollectionDate')
+            value_date_counts_dict = Counter(
+                (sample[value_i], sample[date_i])
+                for sample in all_sample_details
+            )
+            value_date_counts = defaultdict(list)
+            for (value, date), count in value_date_counts_dict.items():
+                value_date_counts[value].append({date: count})
+            for date_counts in value_date_counts.values():
+                date_counts.sort(key=lambda x: list(x.keys())[0])
+            extra_fields[counts_field] = value_date_counts
+
+    compression_mapping = []
+    offset = 0
+    for i in range(len(all_sample_details)):
+        if i in included_samples:
+            new_index = i - offset
+        else:
+            new_index = -1
+            offset += 1
+        compression_mapping.append(new_index)
+
+    compressed_variants = {
+        variant: [
+            compression_mapping[s_i]
+            for s_i in sample_indexes
+        ]
+        for variant, sample_indexes in uncompressed_variants.items()
+    }
+    sample_details = [
+        sample
+        for index, sample in enumerate(all_sample_details)
+        if compression_mapping[index] != -1
+    ]
+    return sample_details, compressed_variants, extra_fields
+
+
+def check_output(output, reference_output):
+    # The reference listed each variant's samples in the order of a set,
+    # process_samples lists them in order.
+    reference_output[1].update(
+        (variant, sorted(samples))
+        for variant, samples in reference_output[1].items()
+    )
+    # Serialising compares the order of keys as well as their values
+    for name, value, reference_value in zip(
+            ('sample_details', 'compressed_variants', 'extra_fields'),
+            output, reference_output):
+        if json.dumps(value) != json.dumps(reference_value):
+            raise AssertionError(f"process_samples gave different"
+                                 f" {name} to the reference")
+
+
+def time_calls(function, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def benchmark(split_query, sample_metadata, sample_count, carriers, repeats):
+    bucket = MetadataBucket()
+    split_query.s3 = bucket
+    # The vcfs are named the same at every size, so the manifests of the
+    # last size would otherwise be used again
+    split_query.manifests.clear()
+    vcf_sample_count = sample_count // len(VCFS)
+    for vcf_location in VCFS:
+        build_metadata(bucket, vcf_location, vcf_sample_count,
+                       sample_metadata, split_query.country_codes)
+    random.seed(0)
+    # As splitQuery totals them, a sorted array for each variant and vcf
+    variants = {
+        f'{pos}A>G': {
+            vcf_location: np.sort(random.sample(
+                range(vcf_sample_count), min(carriers, vcf_sample_count)))
+            for vcf_location in VCFS
+        }
+        for pos in range(VARIANTS)
+    }
+    # And as sets, as the reference totalled them
+    set_variants = {
+        variant: {
+            vcf_location: set(samples.tolist())
+            for vcf_location, samples in location_samples.items()
+        }
+        for variant, location_samples in variants.items()
+    }
+    # Also loads the columns
+    check_output(split_query.process_samples(variants, FIELDS),
+                 reference_process_samples(split_query, set_variants,
+                                           FIELDS))
+    return (
+        time_calls(lambda: split_query.process_samples(variants, FIELDS),
+                   repeats),
+        time_calls(lambda: reference_process_samples(split_query,
+                                                     set_variants, FIELDS),
+                   repeats),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--carriers', type=int, default=1000,
+                        help="Samples with each variant in each vcf")
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    for variable in ('CACHE_BUCKET', 'CACHE_TABLE', 'INDEX_BUCKET',
+                     'PERFORM_QUERY_LAMBDA', 'RESPONSE_BUCKET'):
+        os.environ.setdefault(variable, 'benchmark')
+    os.environ.setdefault('LAMBDA_TASK_ROOT', SPLIT_QUERY_DIR)
+    os.environ.setdefault('SAMPLE_ENCODING', 'varint')
+    os.environ.setdefault('SPLIT_SIZE', '1000000')
+    sys.path.insert(0, SPLIT_QUERY_DIR)
+    import lambda_function as split_query
+    import sample_metadata
+
+    with tempfile.TemporaryDirectory() as metadata_dir:
+        split_query.METADATA_DIR = metadata_dir
+        # splitQuery logs every S3 call, which would swamp the results
+        stdout = sys.stdout
+        for sample_count in SAMPLE_COUNTS:
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                seconds, reference_seconds = benchmark(
+                    split_query, sample_metadata, sample_count,
+                    args.carriers, args.repeats)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            print(f"{sample_count:>9} samples {1000 * seconds:>10.1f} ms,"
+                  f" reference {1000 * reference_seconds:>10.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+"""
+Compares splitQuery's compressed, inline-when-small QueryCache entries with
+the previous scheme of an uncompressed S3 object behind a pointer item, for
+responses of various sizes.
+
+    python benchmark_query_cache.py [--dynamodb-ms 8] [--s3-ms 25]
+
+splitQuery's own cache_response and get_cached run against stand-ins for
+DynamoDB and S3 that count the calls made. Hit latency is the measured
+decode time plus the given round trip time for each call and --mbps for
+the bytes transferred. Store time only covers serialising the entry.
+Storage is the DynamoDB item size, as DynamoDB bills it, plus the size of
+any S3 object.
+"""
+import argparse
+import copy
+import io
+import json
+import os
+import random
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SPLIT_QUERY_DIR = os.path.join(BENCHMARKS_DIR, '..', 'lambda', 'splitQuery')
+
+# Variants in each synthetic response, 0 being a response that isn't
+# included, and whether the response lists samples and keeps details
+CASES = [
+    ('miss', 0, False),
+    ('hit', 1, False),
+    ('hit', 20, False),
+    ('hit', 20, True),
+    ('hit', 200, True),
+    ('hit', 2000, True),
+]
+DATASET_SAMPLES = 50000
+LOCATIONS = ['Australia/Victoria', 'Australia/NSW', 'China/Hubei', 'USA/WA',
+             'England', 'India/Gujarat', 'Brazil']
+
+
+class RecordingTable:
+    """
+    Stands in for the DynamoDB client, holding the cache table in memory.
+    """
+    def __init__(self):
+        self.items = {}
+        self.calls = 0
+        self.bytes_read = 0
+
+    def put_item(self, TableName, Item):
+        self.items[Item['queryArgs']['S']] = copy.deepcopy(Item)
+        return {}
+
+    def get_item(self, TableName, Key, ProjectionExpression=None):
+        self.calls += 1
+        item = self.items.get(Key['queryArgs']['S'])
+        if item is None:
+            return {}
+        self.bytes_read += item_size(item)
+        return {'Item': item}
+
+
+class RecordingBucket:
+    """
+    Stands in for splitQuery's S3Client, holding objects in memory.
+    """
+    def __init__(self):
+        self.objects = {}
+        self.calls = 0
+        self.bytes_read = 0
+
+    def get_object(self, bucket, key):
+        self.calls += 1
+        self.bytes_read += len(self.objects[key])
+        return io.BytesIO(self.objects[key])
+
+    def put_object(self, bucket, key, body):
+        self.objects[key] = body
+
+
+def item_size(item):
+    # Attribute names plus values, as DynamoDB measures items
+    return sum(
+        len(name.encode()) + len(value.get('B', b''))
+        + len(value.get('S', '').encode()) + len(value.get('N', ''))
+        for name, value in item.items()
+    )
+
+
+def make_stored(variant_count, with_samples, encode_samples):
+    if not variant_count:
+        return {
+            'response': {
+                'include': False,
+                'exists': False,
+            },
+            'details': None,
+        }
+    random.seed(variant_count)
+    variants = []
+    call_counts = {}
+    detail_samples = {}
+    for pos in sorted(random.sample(range(1, 30000), variant_count)):
+        ref, alt = random.sample('ACGT', 2)
+        samples = sorted(random.sample(range(DATASET_SAMPLES),
+                                       random.randint(1, 300)))
+        code = f'{pos}{ref}>{alt}'
+        variant = {
+            'pos': pos,
+            'ref': ref,
+            'alt': alt,
+            'SIFT_score': round(random.random(), 2),
+            'sampleCount': len(samples),
+            'frequency': len(samples) / DATASET_SAMPLES,
+        }
+        if with_samples:
+            variant['samples'] = samples
+            call_counts[code] = len(samples)
+            detail_samples[code] = {
+                's3://bucket/sequences.vcf.gz': encode_samples(samples),
+            }
+        variants.append(variant)
+    sample_count = sum(variant['sampleCount'] for variant in variants)
+    response = {
+        'include': True,
+        'datasetId': 'benchmark',
+        'exists': True,
+        'frequency': sample_count / DATASET_SAMPLES,
+        'variantCount': variant_count,
+        'callCount': sample_count,
+        'sampleCount': sample_count,
+        'note': None,
+        'externalUrl': None,
+        'info': {
+            'description': 'Synthetic dataset',
+            'name': 'benchmark',
+            'datasetSampleCount': DATASET_SAMPLES,
+            'variants': variants,
+            'totalEntries': variant_count,
+        },
+        'error': None,
+    }
+    if with_samples:
+        response['info'].update({
+            'sampleFields': ['Location'],
+            'sampleDetails': [
+                [random.choice(LOCATIONS)] for _ in range(sample_count)
+            ],
+            'locationCounts': {location: sample_count // len(LOCATIONS)
+                               for location in LOCATIONS},
+        })
+    return {
+        'response': response,
+        'details': {
+            'callCounts': call_counts,
+            'samples': detail_samples,
+        } if with_samples else None,
+    }
+
+
+def measure(store, load, table, bucket, args, repeats):
+    start = time.perf_counter()
+    store()
+    store_time = time.perf_counter() - start
+    best = None
+    for _ in range(repeats):
+        table.calls = bucket.calls = 0
+        table.bytes_read = bucket.bytes_read = 0
+        start = time.perf_counter()
+        json.loads(load())
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    transfer_ms = ((table.bytes_read + bucket.bytes_read) * 8
+                   / (args.mbps * 1000))
+    return {
+        'store_ms': 1000 * store_time,
+        'round_trips': table.calls + bucket.calls,
+        'decode_ms': 1000 * best,
+        'latency_ms': (1000 * best + table.calls * args.dynamodb_ms
+                       + bucket.calls * args.s3_ms + transfer_ms),
+        'item_bytes': sum(item_size(item) for item in table.items.values()),
+        'object_bytes': sum(len(body) for body in bucket.objects.values()),
+    }
+
+
+def benchmark(split_query, stored, args):
+    query_details = {
+        'region_start': 1,
+        'region_end': 30000,
+        'end_min': 1,
+        'end_max': 30000,
+    }
+    query_args = split_query.get_query_key(query_details)
+
+    # The scheme before entries were compressed
+    old_table = RecordingTable()
+    old_bucket = RecordingBucket()
+
+    def old_store():
+        key = f'benchmark/{query_args}'
+        old_bucket.put_object(None, key, json.dumps(stored).encode())
+        old_table.put_item(None, {
+            'datasetId': {'S': 'benchmark'},
+            'queryArgs': {'S': query_args},
+            'queryLocation': {'S': key},
+        })
+
+    def old_load():
+        item = old_table.get_item(None, {
+            'datasetId': {'S': 'benchmark'},
+            'queryArgs': {'S': query_args},
+        })['Item']
+        return old_bucket.get_object(None,
+                                     item['queryLocation']['S']).read()
+
+    table = RecordingTable()
+    bucket = RecordingBucket()
+    split_query.dynamodb = table
+    split_query.s3 = bucket
+    old = measure(old_store, old_load, old_table, old_bucket, args,
+                  args.repeats)
+    new = measure(
+        lambda: split_query.cache_response(stored, 'benchmark', query_args,
+                                           query_details, 'version'),
+        lambda: split_query.get_cached(
+            split_query.get_cache_item('benchmark', query_args, 'version')),
+        table, bucket, args, args.repeats)
+    # Only compare the entries themselves, not the range items
+    new['item_bytes'] = item_size(table.items[query_args])
+    return old, new
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--dynamodb-ms', type=float, default=8,
+                        help="Round trip time of a DynamoDB GetItem")
+    parser.add_argument('--s3-ms', type=float, default=25,
+                        help="Time to first byte of an S3 GetObject")
+    parser.add_argument('--mbps', type=float, default=500,
+                        help="Throughput from DynamoDB and S3")
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    for variable in ('CACHE_BUCKET', 'CACHE_TABLE', 'INDEX_BUCKET',
+                     'PERFORM_QUERY_LAMBDA', 'RESPONSE_BUCKET'):
+        os.environ.setdefault(variable, 'benchmark')
+    os.environ.setdefault('LAMBDA_TASK_ROOT', SPLIT_QUERY_DIR)
+    os.environ.setdefault('SAMPLE_ENCODING', 'varint')
+    os.environ.setdefault('SPLIT_SIZE', '1000000')
+    sys.path.insert(0, SPLIT_QUERY_DIR)
+    import lambda_function as split_query
+
+    print(f"{'response':>16} {'json bytes':>11}"
+          f" {'old item+object':>16} {'new item+object':>16}"
+          f" {'old trips':>9} {'new trips':>9}"
+          f" {'old hit ms':>10} {'new hit ms':>10}"
+          f" {'old store ms':>12} {'new store ms':>12}")
+    for kind, variant_count, with_samples in CASES:
+        stored = make_stored(variant_count, with_samples,
+                             split_query.encode_samples)
+        old, new = benchmark(split_query, stored, args)
+        description = (f"{kind} {variant_count}"
+                       f"{' +samples' if with_samples else ''}")
+        print(f"{description:>16} {len(json.dumps(stored)):>11}"
+              f" {old['item_bytes']:>7}+{old['object_bytes']:<8}"
+              f" {new['item_bytes']:>7}+{new['object_bytes']:<8}"
+              f" {old['round_trips']:>9} {new['round_trips']:>9}"
+              f" {old['latency_ms']:>10.1f} {new['latency_ms']:>10.1f}"
+              f" {old['store_ms']:>12.1f} {new['store_ms']:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Compares the size and speed of sending a variant's sample indexes from
+performQuery to splitQuery as JSON lists or as base64 packed varints.
+
+    python benchmark_sample_encoding.py [--dataset-size N] [--repeats N]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'shared_resources'))
+
+from sample_encoding import decode_samples, encode_samples  # noqa: E402
+
+
+SAMPLE_COUNTS = (10000, 100000, 1000000)
+
+
+def time_call(function, argument, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(argument)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+
+def benchmark(sample_count, dataset_size, repeats):
+    samples = sorted(random.sample(range(dataset_size), sample_count))
+    json_payload, json_encode = time_call(json.dumps, samples, repeats)
+    _, json_decode = time_call(json.loads, json_payload, repeats)
+    varint_payload, varint_encode = time_call(encode_samples, samples,
+                                              repeats)
+    decoded, varint_decode = time_call(
+        lambda payload: decode_samples(payload).tolist(), varint_payload,
+        repeats)
+    assert decoded == samples
+    return {
+        'samples': sample_count,
+        'json_bytes': len(json_payload),
+        'varint_bytes': len(varint_payload),
+        'json_encode_ms': 1000 * json_encode,
+        'json_decode_ms': 1000 * json_decode,
+        'varint_encode_ms': 1000 * varint_encode,
+        'varint_decode_ms': 1000 * varint_decode,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--dataset-size', type=int, default=2000000,
+                        help="Number of samples in the simulated vcf")
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+    random.seed(0)
+    print(f"{'samples':>9} {'json bytes':>11} {'varint bytes':>13}"
+          f" {'json enc/dec ms':>17} {'varint enc/dec ms':>19}")
+    for sample_count in SAMPLE_COUNTS:
+        result = benchmark(min(sample_count, args.dataset_size),
+                           args.dataset_size, args.repeats)
+        print(f"{result['samples']:>9} {result['json_bytes']:>11}"
+              f" {result['varint_bytes']:>13}"
+              f" {result['json_encode_ms']:>8.1f}/"
+              f"{result['json_decode_ms']:<8.1f}"
+              f" {result['varint_encode_ms']:>9.1f}/"
+              f"{result['varint_decode_ms']:<9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,18 @@ resource aws_dynamodb_table cache {
   }
 }
 
+resource aws_dynamodb_table catalog_version {
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key = "catalog"
+  name = "CatalogVersion"
+  tags = var.common-tags
+
+  attribute {
+    name = "catalog"
+    type = "S"
+  }
+}
+
 resource aws_dynamodb_table datasets {
   billing_mode = "PAY_PER_REQUEST"
   hash_key = "id"
@@ -40,8 +52,10 @@ resource aws_dynamodb_table datasets {
       "sampleCount",
       "description",
       "annotationLocation",
+      "annotationIndex",
       "id",
       "name",
+      "updateDateTime",
     ]
     projection_type = "INCLUDE"
   }
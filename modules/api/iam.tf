@@ -17,6 +17,15 @@ data aws_iam_policy_document main-apigateway {
 # submitDataset Lambda Function
 #
 data aws_iam_policy_document lambda-submitDataset {
+  statement {
+    actions = [
+      "dynamodb:UpdateItem",
+    ]
+    resources = [
+      aws_dynamodb_table.catalog_version.arn,
+    ]
+  }
+
   statement {
     actions = [
       "dynamodb:PutItem",
@@ -51,6 +60,15 @@ data aws_iam_policy_document lambda-submitDataset {
 # summariseDataset Lambda Function
 #
 data aws_iam_policy_document lambda-summariseDataset {
+  statement {
+    actions = [
+      "dynamodb:UpdateItem",
+    ]
+    resources = [
+      aws_dynamodb_table.catalog_version.arn,
+    ]
+  }
+
   statement {
     actions = [
       "dynamodb:UpdateItem",
@@ -85,6 +103,25 @@ data aws_iam_policy_document lambda-summariseDataset {
     ]
     resources = ["*"]
   }
+
+  statement {
+    actions = [
+      "s3:ListBucket",
+    ]
+    resources = [
+      aws_s3_bucket.indexes.arn,
+    ]
+  }
+
+  statement {
+    actions = [
+      "s3:DeleteObject",
+      "s3:PutObject",
+    ]
+    resources = [
+      "${aws_s3_bucket.indexes.arn}/*",
+    ]
+  }
 }
 
 #
@@ -116,6 +153,16 @@ data aws_iam_policy_document lambda-summariseVcf {
     ]
     resources = ["*"]
   }
+
+  statement {
+    actions = [
+      "s3:DeleteObject",
+      "s3:PutObject",
+    ]
+    resources = [
+      "${aws_s3_bucket.indexes.arn}/*",
+    ]
+  }
 }
 
 #
@@ -158,6 +205,15 @@ data aws_iam_policy_document lambda-summariseSlice {
     ]
     resources = ["*"]
   }
+
+  statement {
+    actions = [
+      "s3:PutObject",
+    ]
+    resources = [
+      "${aws_s3_bucket.indexes.arn}/*",
+    ]
+  }
 }
 
 #
@@ -213,6 +269,16 @@ data aws_iam_policy_document lambda-getInfo {
 data aws_iam_policy_document lambda-queryDatasets {
   statement {
     actions = [
+      "dynamodb:GetItem",
+    ]
+    resources = [
+      aws_dynamodb_table.catalog_version.arn,
+    ]
+  }
+
+  statement {
+    actions = [
+      "s3:AbortMultipartUpload",
       "s3:PutObject",
     ]
     resources = [
@@ -229,6 +295,15 @@ data aws_iam_policy_document lambda-queryDatasets {
     ]
   }
 
+  statement {
+    actions = [
+      "dynamodb:BatchGetItem",
+    ]
+    resources = [
+      aws_dynamodb_table.vcf_summaries.arn,
+    ]
+  }
+
   statement {
     actions = [
       "lambda:InvokeFunction",
@@ -253,13 +328,18 @@ data aws_iam_policy_document lambda-splitQuery {
     actions = [
       "lambda:InvokeFunction",
     ]
-    resources = [module.lambda-performQuery.function_arn]
+    resources = [
+      module.lambda-performQuery.function_arn,
+      module.lambda-splitQuery.function_arn,
+    ]
   }
 
   statement {
     actions = [
       "dynamodb:PutItem",
       "dynamodb:GetItem",
+      "dynamodb:Query",
+      "dynamodb:UpdateItem",
     ]
     resources = [aws_dynamodb_table.cache.arn]
   }
@@ -280,6 +360,16 @@ data aws_iam_policy_document lambda-splitQuery {
     ]
     resources = ["*"]
   }
+
+  statement {
+    actions = [
+      "s3:ListBucket",
+    ]
+    resources = [
+      aws_s3_bucket.indexes.arn,
+      aws_s3_bucket.large_response_bucket.arn,
+    ]
+  }
 }
 
 
@@ -294,6 +384,15 @@ data aws_iam_policy_document lambda-performQuery {
     ]
     resources = ["*"]
   }
+
+  statement {
+    actions = [
+      "s3:PutObject",
+    ]
+    resources = [
+      "${aws_s3_bucket.large_response_bucket.arn}/${module.lambda-performQuery.function_name}/*",
+    ]
+  }
 }
 
 #
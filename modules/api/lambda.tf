@@ -75,6 +75,14 @@ resource aws_lambda_permission APIQueryDatasets {
   source_arn = "${aws_api_gateway_rest_api.BeaconApi.execution_arn}/*/*/${aws_api_gateway_resource.query.path_part}"
 }
 
+resource aws_lambda_permission APIQueryBatch {
+  statement_id = "AllowAPIQueryBatchInvoke"
+  action = "lambda:InvokeFunction"
+  function_name = module.lambda-queryDatasets.function_name
+  principal = "apigateway.amazonaws.com"
+  source_arn = "${aws_api_gateway_rest_api.BeaconApi.execution_arn}/*/*/${aws_api_gateway_resource.query.path_part}/${aws_api_gateway_resource.query-batch.path_part}"
+}
+
 #
 # splitQuery Lambda Function
 #
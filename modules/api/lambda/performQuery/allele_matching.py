@@ -0,0 +1 @@
+../../shared_resources/allele_matching.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../shared_resources/cancellation.py
\ No newline at end of file
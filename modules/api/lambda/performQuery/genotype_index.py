@@ -0,0 +1 @@
+../../shared_resources/genotype_index.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../shared_resources/genotypes.py
\ No newline at end of file
@@ -1,316 +1,618 @@
+import bisect
 from collections import defaultdict
+import hashlib
 import json
 import os
-import re
+import shutil
 import subprocess
 
+import boto3
+import numpy as np
+
+from allele_matching import get_hit_finder
+from cancellation import Cancellation
+from genotype_index import GenotypeIndex, get_index_prefix, parse_index_key
+from genotypes import get_allele_carriers, parse_genotypes
+from memory_cache import MemoryCache
+from sample_encoding import (JSON_ENCODING, VARINT_ENCODING, encode_samples,
+                             encode_variant_samples)
+from tabix_reader import (S3File, can_read, get_info_value, get_reader,
+                          split_query_record, split_site_record)
+
+# Records read between checks for cancellation, which would otherwise add
+# noticeably to the cheapest records
+CANCEL_CHECK_RECORDS = 256
+# Size of the genotype indexes kept downloaded between invocations, leaving
+# the rest of /tmp for bcftools
+GENOTYPE_INDEX_CACHE_SIZE = 256 * 2**20
+# Where genotype indexes are downloaded to be memory mapped
+GENOTYPE_INDEX_DIR = '/tmp/genotype_indexes'
+# Size of the lists of each vcf chromosome's genotype indexes kept between
+# invocations
+GENOTYPE_INDEX_LIST_CACHE_SIZE = 16 * 2**20
+INDEX_BUCKET = os.environ['INDEX_BUCKET']
+MAXIMUM_RESPONSE_SIZE = 6 * 2**20
+RESPONSE_BUCKET = os.environ['RESPONSE_BUCKET']
+
 os.environ['PATH'] += ':' + os.environ['LAMBDA_TASK_ROOT']
-IUPAC_AMBIGUITY_CODES = {
-    'A': {
-        'A',
-    },
-    'C': {
-        'C',
-    },
-    'G': {
-        'G',
-    },
-    'T': {
-        'T',
-    },
-    'U': {
-        'T',
-    },
-    'M': {
-        'A',
-        'C',
-    },
-    'R': {
-        'A',
-        'G',
-    },
-    'W': {
-        'A',
-        'T'
-    },
-    'S': {
-        'C',
-        'G',
-    },
-    'Y': {
-        'C',
-        'T',
-    },
-    'K': {
-        'T',
-        'G',
-    },
-    'V': {
-        'A',
-        'C',
-        'G',
-    },
-    'H': {
-        'A',
-        'C',
-        'T',
-    },
-    'D': {
-        'T',
-        'A',
-        'G',
-    },
-    'B': {
-        'T',
-        'C',
-        'G',
-    },
-    'N': {
-        'T',
-        'A',
-        'C',
-        'G',
-    },
-}
-
-IUPAC_MATCHES = {
-    code1: {
-        code2 for code2, bases2 in IUPAC_AMBIGUITY_CODES.items()
-        if bases1 & bases2
-    } for code1, bases1 in IUPAC_AMBIGUITY_CODES.items()
-}
-
-all_count_pattern = re.compile('[0-9]+')
-get_all_calls = all_count_pattern.findall
-regular_alt = re.compile(f'[{"".join(IUPAC_AMBIGUITY_CODES.keys())}]+')
-
-
-class VariantGenotypes:
-    def __init__(self):
-        self.genotype_to_alt_indexes = {}
-        self.alt_pattern = re.compile('\\b([1-9][0-9]*)\\b')
-
-    def alt_indexes(self, genotype):
-        try:
-            return self.genotype_to_alt_indexes[genotype]
-        except KeyError:
-            alt_strings = self.alt_pattern.findall(genotype)
-            alt_indexes = {int(i)-1 for i in alt_strings}
-            self.genotype_to_alt_indexes[genotype] = alt_indexes
-            return alt_indexes
 
+s3 = boto3.client('s3')
 
-variant_genotypes = VariantGenotypes()
+# An evicted index's file is deleted, though a query still using it keeps
+# its mapping until it's done
+genotype_index_cache = MemoryCache(
+    'Genotype index cache', GENOTYPE_INDEX_CACHE_SIZE,
+    on_remove=lambda genotype_index: os.remove(genotype_index.path))
+# The genotype indexes of each vcf chromosome, by the eTag of the vcf they
+# were built from. A resummarised vcf's indexes are only listed again once
+# its eTag changes.
+genotype_index_lists = MemoryCache('Genotype index lists',
+                                   GENOTYPE_INDEX_LIST_CACHE_SIZE)
+# The INFO tags defined in each vcf's header are kept for the lifetime of
+# the container
+loaded_info_tags = {}
 
+# Files left by an earlier process in this container aren't in the cache,
+# so would never be removed
+shutil.rmtree(GENOTYPE_INDEX_DIR, ignore_errors=True)
 
-def truncate_ref_alt(ref, alt):
-    if regular_alt.fullmatch(alt):
-        # Just a sequence of IUPAC characters
-        suffix_len = 0
-        max_suffix = 1 - min(len(ref), len(alt))
-        while (suffix_len > max_suffix
-               and ref[suffix_len-1] == alt[suffix_len-1]):
-            suffix_len -= 1
-        if suffix_len:
-            return ref[:suffix_len], alt[:suffix_len]
-    return ref, alt
 
+def add_index_hits(genotype_index, pos, ref_alts, hit_indexes, first_allele,
+                   total_count, include_details, result):
+    call_counts = [
+        int(genotype_index.call_counts[first_allele+i])
+        for i in hit_indexes
+    ]
+    result['call_count'] += sum(call_counts)
+    if result['call_count']:
+        if not result['exists']:
+            result['exists'] = True
+            if not include_details:
+                return
+        for hit, call_count in zip(hit_indexes, call_counts):
+            name = name_variant(pos, *ref_alts[hit])
+            if call_count:
+                result['variant_call_counts'][name] += call_count
+            samples = genotype_index.get_carriers(first_allele + hit)
+            if len(samples):
+                result['variant_samples'][name] += samples.tolist()
+    result['all_alleles_count'] += total_count
 
-def get_possible_codes(code):
-    possible_codes = {''}
-    if code is not None:
-        for base in code:
-            next_possible_codes = set()
-            for possible_code in possible_codes:
-                for iupac_code in IUPAC_MATCHES[base]:
-                    next_possible_codes.add(possible_code + iupac_code)
-            possible_codes = next_possible_codes
-    return possible_codes
 
+def add_record_hits(pos, ref_alts, hit_indexes, info_str, genotypes,
+                    include_details, result):
+    """
+    Adds the hits in a record from bcftools query to a result. Returns True
+    if the record showed the allele exists and nothing more is needed.
+    """
+    # Look through INFO for AC and AN, used for efficient calculations. Note
+    # we cannot request them explicitly in the query, as bcftools will crash
+    # if they aren't present.
+    all_alt_counts = None
+    total_count = None
+    for info in info_str.decode().split(';'):
+        if not all_alt_counts and info.startswith('AC='):
+            all_alt_counts = info[3:]
+            if total_count is not None:
+                break
+        elif total_count is None and info.startswith('AN='):
+            total_count = int(info[3:])
+            if all_alt_counts is not None:
+                break
+    calls = None
+    if all_alt_counts is not None:
+        alt_counts = all_alt_counts.split(',')
+        call_counts = [int(alt_counts[i]) for i in hit_indexes]
+    else:
+        # Slower, but doesn't require INFO/AC
+        calls = parse_genotypes(genotypes)
+        allele_counts = np.bincount(calls[1],
+                                    minlength=max(hit_indexes)+2)
+        call_counts = [int(allele_counts[i+1]) for i in hit_indexes]
+    result['call_count'] += sum(call_counts)
+    if result['call_count']:
+        if not result['exists']:
+            result['exists'] = True
+            if not include_details:
+                return True
+        if calls is None:
+            calls = parse_genotypes(genotypes)
+        for hit, call_count in zip(hit_indexes, call_counts):
+            name = name_variant(pos, *ref_alts[hit])
+            if call_count:
+                result['variant_call_counts'][name] += call_count
+            samples = get_allele_carriers(*calls, hit+1)
+            if len(samples):
+                result['variant_samples'][name] += samples.tolist()
+    # Used for calculating frequency. This will be a misleading value if the
+    #  alleles are spread over multiple vcf records. Ideally we should
+    #  return a dictionary for each matching record/allele, but for now the
+    #  beacon specification doesn't support it. A quick fix might be to
+    #  represent the frequency of any matching allele in the population of
+    #  haplotypes, but this could lead to an illegal value > 1.
+    if total_count is not None:
+        result['all_alleles_count'] += total_count
+    else:
+        # Slower, but doesn't require INFO/AN
+        if calls is None:
+            calls = parse_genotypes(genotypes)
+        result['all_alleles_count'] += len(calls[1])
+    return False
 
-def name_variant(pos, ref, alt):
-    return f'{pos}{ref}>{alt}'
+
+def add_scan_hits(hit_indexes, alt_counts, total_count, result):
+    """
+    Adds the hits in a record's INFO/AC to a result. Returns True if they
+    show the allele exists.
+    """
+    # A missing AC value gives no calls, as GT isn't available to count
+    counts = alt_counts.split(b',')
+    result['call_count'] += sum(int(counts[i]) for i in hit_indexes
+                                if i < len(counts) and counts[i] != b'.')
+    if result['call_count']:
+        result['exists'] = True
+        return True
+    if total_count is not None and total_count != b'.':
+        result['all_alleles_count'] += int(total_count)
+    return False
+
+
+def check_size(response, context):
+    response_length = len(json.dumps(response))
+    print(f"Response is {response_length} characters")
+    if response_length <= MAXIMUM_RESPONSE_SIZE:
+        return response
+    print("Response is too large, uploading variant samples to S3...")
+    # One line of result index, variant and packed samples per variant, so
+    # they can be merged a line at a time.
+    body = bytearray()
+    for result_index, result in enumerate(response['results']):
+        for variant, samples in result.get('variant_samples', {}).items():
+            if response['sample_encoding'] != VARINT_ENCODING:
+                samples = encode_samples(samples)
+            body += f'{result_index}\t{variant}\t{samples}\n'.encode()
+        result['variant_samples'] = {}
+    key = f'{context.function_name}/{context.aws_request_id}.samples'
+    kwargs = {
+        'Bucket': RESPONSE_BUCKET,
+        'Key': key,
+    }
+    print(f"Calling s3.put_object with kwargs {json.dumps(kwargs)}")
+    s3_response = s3.put_object(Body=bytes(body), **kwargs)
+    print(f"Received response {json.dumps(s3_response, default=str)}")
+    response['spilled_samples'] = {
+        'bucket': RESPONSE_BUCKET,
+        'key': key,
+    }
+    return response
+
+
+def get_active_queries(queries):
+    """
+    Returns a function giving the indexes of the queries whose region
+    contains a position. Positions must be given in increasing order, as
+    queries are dropped once a position passes their region.
+    """
+    order = sorted(range(len(queries)),
+                   key=lambda i: queries[i]['region_start'])
+    starts = [queries[i]['region_start'] for i in order]
+    next_query = 0
+    active = []
+    min_end = None
+
+    def active_queries(pos):
+        nonlocal next_query, active, min_end
+        if min_end is not None and pos > min_end:
+            active = [i for i in active if queries[i]['region_end'] >= pos]
+            min_end = min((queries[i]['region_end'] for i in active),
+                          default=None)
+        while next_query < len(order) and starts[next_query] <= pos:
+            i = order[next_query]
+            next_query += 1
+            if queries[i]['region_end'] >= pos:
+                active.append(i)
+                if min_end is None or queries[i]['region_end'] < min_end:
+                    min_end = queries[i]['region_end']
+        return active
+
+    def finished():
+        return next_query == len(order) and not active
+
+    return active_queries, finished
 
 
-def perform_query(reference_bases, region, end_min, end_max, alternate_bases,
-                  variant_type, include_details, vcf_location):
+def get_genotype_indexes(vcf_location, chrom, vcf_etag, first_bp, last_bp):
+    """
+    Returns the genotype indexes covering the region, or None if it isn't
+    completely covered. vcf_etag is the eTag of the vcf the indexes were
+    built from, and is None unless splitQuery found it to be the vcf's
+    current eTag, as indexes of a vcf that has since been replaced, or is
+    still being summarised, can't be trusted.
+    """
+    if vcf_etag is None or not vcf_location.startswith('s3://'):
+        return None
+    index_ranges = [
+        index_range
+        for index_range in list_genotype_indexes(vcf_location, chrom,
+                                                 vcf_etag)
+        if index_range[0] <= last_bp and index_range[1] >= first_bp
+    ]
+    # Only use the indexes if the region is completely covered, otherwise
+    # the vcf may still be being summarised.
+    covered = first_bp - 1
+    for start, end, _, _ in index_ranges:
+        if start > covered + 1:
+            return None
+        covered = max(covered, end)
+    if covered < last_bp:
+        return None
+    return [
+        load_genotype_index(key, etag)
+        for _, _, key, etag in index_ranges
+    ]
+
+
+def list_genotype_indexes(vcf_location, chrom, vcf_etag):
+    """
+    Returns the start, end, key and eTag of each of the vcf chromosome's
+    genotype indexes, in order.
+    """
+    index_list = genotype_index_lists.get((vcf_location, chrom), vcf_etag)
+    if index_list is not None:
+        return index_list
+    kwargs = {
+        'Bucket': INDEX_BUCKET,
+        'Prefix': get_index_prefix(vcf_location, chrom),
+    }
+    index_list = []
+    continuation_token = True
+    while continuation_token:
+        print(f"Calling s3.list_objects_v2 with kwargs {json.dumps(kwargs)}")
+        response = s3.list_objects_v2(**kwargs)
+        contents = response.get('Contents', [])
+        print(f"Received {len(contents)} keys")
+        for obj in contents:
+            start, end = parse_index_key(obj['Key'])
+            index_list.append((start, end, obj['Key'], obj['ETag']))
+        continuation_token = response.get('NextContinuationToken')
+        kwargs['ContinuationToken'] = continuation_token
+    index_list.sort()
+    genotype_index_lists.put((vcf_location, chrom), index_list,
+                             sum(len(key) + 64 for _, _, key, _ in index_list),
+                             vcf_etag)
+    return index_list
+
+
+def get_query_records(region, chrom, first_bp, last_bp, vcf_location,
+                      popen=subprocess.Popen):
+    if can_read(vcf_location):
+        for line in get_reader(vcf_location).fetch(chrom, first_bp, last_bp):
+            yield split_query_record(line)
+        return
     args = [
         'bcftools', 'query',
         '--regions', region,
         '--format', '%POS\t%REF\t%ALT\t%INFO\t[%GT,]\n',
         vcf_location
     ]
-    query_process = subprocess.Popen(args, stdout=subprocess.PIPE, cwd='/tmp',
-                                     encoding='ascii')
-    v_prefix = '<{}'.format(variant_type)
-    first_bp = int(region[region.find(':')+1: region.find('-')])
-    last_bp = int(region[region.find('-')+1:])
-    approx = reference_bases == 'N' and variant_type
-    exists = False
-    variant_samples = defaultdict(list)
-    call_count = 0
-    all_alleles_count = 0
-    reference_matches = get_possible_codes(reference_bases)
-    alternate_matches = get_possible_codes(alternate_bases)
-    for line in query_process.stdout:
-        try:
-            (position, reference, all_alts, info_str,
-             genotypes) = line.split('\t')
-        except ValueError as e:
-            print(repr(line.split('\t')))
-            raise e
-
-        pos = int(position)
-        # Ensure each variant will only be found by one process
-        if not first_bp <= pos <= last_bp:
-            continue
+    # GT is left as bytes so it can be parsed without decoding
+    query_process = popen(args, stdout=subprocess.PIPE, cwd='/tmp')
+    try:
+        for line in query_process.stdout:
+            try:
+                (position, reference, all_alts, info_str,
+                 genotypes) = line.split(b'\t')
+            except ValueError as e:
+                print(repr(line.split(b'\t')))
+                raise e
+            yield position, reference, all_alts, info_str, genotypes
+    finally:
+        query_process.stdout.close()
 
-        ref_alts = [
-            truncate_ref_alt(reference, alt)
-            for alt in all_alts.split(',')
-        ]
-        hit_indexes = {
-            i for i, (ref, _) in enumerate(ref_alts)
-            if (end_min <= pos + len(ref) - 1 <= end_max
-                and approx or ref.upper() in reference_matches
-                )
-        }
-        if not hit_indexes:
-            continue
 
-        if alternate_bases is None:
-            if variant_type == 'DEL':
-                hit_indexes &= {
-                    i for i, (ref, alt) in enumerate(ref_alts)
-                    if (i in hit_indexes and (
-                        (alt.startswith(v_prefix)
-                         or alt == '<CN0>')
-                        if alt.startswith('<')
-                        else len(alt) < len(ref)))
-                }
-            elif variant_type == 'INS':
-                hit_indexes &= {
-                    i for i, (ref, alt) in enumerate(ref_alts)
-                    if (alt.startswith(v_prefix)
-                        if alt.startswith('<')
-                        else len(alt) > len(ref))
-                }
-            # The calculation of these gets shaky as we don't have the
-            # bases before ref, so these will only work in trivial cases
-            elif variant_type == 'DUP':
-                hit_indexes &= {
-                    i for i, (ref, alt) in enumerate(ref_alts)
-                    if ((alt.startswith(v_prefix)
-                         or (alt.startswith('<CN')
-                             and alt not in ('<CN0>', '<CN1>')))
-                        if alt.startswith('<')
-                        else re.fullmatch('({}){{2,}}'.format(ref),
-                                          alt))
-                }
-            elif variant_type == 'DUP:TANDEM':
-                hit_indexes &= {
-                    i for i, (ref, alt) in enumerate(ref_alts)
-                    if ((alt.startswith(v_prefix)
-                         or alt == '<CN2>')
-                        if alt.startswith('<')
-                        else alt == ref+ref)
-                }
-            elif variant_type == 'CNV':
-                hit_indexes &= {
-                    i for i, (ref, alt) in enumerate(ref_alts)
-                    if ((alt.startswith(v_prefix)
-                         or alt.startswith('<CN')
-                         or alt.startswith('<DEL')
-                         or alt.startswith('<DUP'))
-                        if alt.startswith('<')
-                        else re.fullmatch('\\.|({})*'.format(ref),
-                                          alt))
-                }
-            else:
-                # For structural variants that aren't otherwise recognisable
-                hit_indexes &= {
-                    i for i, (_, alt) in enumerate(ref_alts)
-                    if alt.startswith(v_prefix)
-                }
+def get_info_tags(vcf_location, tags=('AC', 'AN')):
+    """
+    Returns which of the given INFO tags are defined in the header, as
+    bcftools fails if asked to format an undefined tag. Headers read with
+    bcftools are remembered by the vcf's eTag.
+    """
+    if can_read(vcf_location):
+        reader = get_reader(vcf_location)
+        return {tag for tag in tags if reader.has_info(tag)}
+    etag = None
+    if vcf_location.startswith('s3://'):
+        etag = S3File(vcf_location).get_etag()
+        try:
+            loaded_etag, defined_tags = loaded_info_tags[vcf_location, tags]
+        except KeyError:
+            pass
         else:
-            hit_indexes &= {
-                i for i, (_, alt) in enumerate(ref_alts)
-                if alt.upper() in alternate_matches
-            }
-        if not hit_indexes:
-            continue
+            if loaded_etag == etag:
+                return defined_tags
+    args = [
+        'bcftools', 'view',
+        '--header-only',
+        '--no-version',
+        vcf_location
+    ]
+    header = subprocess.Popen(args, stdout=subprocess.PIPE, cwd='/tmp',
+                              encoding='ascii')
+    defined_tags = set()
+    for line in header.stdout:
+        if line.startswith('#CHROM'):
+            break
+        for tag in tags:
+            if line.startswith(f'##INFO=<ID={tag},'):
+                defined_tags.add(tag)
+    header.stdout.close()
+    # Otherwise the exited process is left as a zombie
+    header.wait()
+    if etag is not None:
+        loaded_info_tags[vcf_location, tags] = (etag, defined_tags)
+    return defined_tags
 
-        # Look through INFO for AC and AN, used for efficient calculations. Note
-        # we cannot request them explicitly in the query, as bcftools will crash
-        # if they aren't present.
-        all_alt_counts = None
-        total_count = None
-        for info in info_str.split(';'):
-            if not all_alt_counts and info.startswith('AC='):
-                all_alt_counts = info[3:]
-                if total_count is not None:
-                    break
-            elif total_count is None and info.startswith('AN='):
-                total_count = int(info[3:])
-                if all_alleles_count is not None:
-                    break
-        all_calls = None
-        if all_alt_counts is not None:
-            alt_counts = all_alt_counts.split(',')
-            call_counts = [int(alt_counts[i]) for i in hit_indexes]
-            call_count += sum(call_counts)
-        else:
-            # Much slower, but doesn't require INFO/AC
-            all_calls = get_all_calls(genotypes)
-            hit_set = set(str(i+1) for i in hit_indexes)
-            call_count += sum(1 for call in all_calls if call in hit_set)
-        if call_count:
-            if not exists:
-                exists = True
-                if not include_details:
-                    break
-            genotype_samples = defaultdict(list)
-            for i, gt in enumerate(genotypes.split(',')):
-                genotype_samples[gt].append(i)
-            for genotype, samples in genotype_samples.items():
-                all_hits = variant_genotypes.alt_indexes(genotype)
-                for hit in all_hits & hit_indexes:
-                    name = name_variant(position, *ref_alts[hit])
-                    variant_samples[name] += samples
-        # Used for calculating frequency. This will be a misleading value if the
-        #  alleles are spread over multiple vcf records. Ideally we should
-        #  return a dictionary for each matching record/allele, but for now the
-        #  beacon specification doesn't support it. A quick fix might be to
-        #  represent the frequency of any matching allele in the population of
-        #  haplotypes, but this could lead to an illegal value > 1.
-        if total_count is not None:
-            all_alleles_count += total_count
-        else:
-            # Much slower, but doesn't require INFO/AN
-            if all_calls is None:
-                all_calls = get_all_calls(genotypes)
-            all_alleles_count += len(all_calls)
-    query_process.stdout.close()
+
+def get_scan_records(region, chrom, first_bp, last_bp, vcf_location,
+                     info_tags, popen=subprocess.Popen):
+    if can_read(vcf_location):
+        for line in get_reader(vcf_location).fetch(chrom, first_bp, last_bp):
+            position, reference, all_alts, info = split_site_record(line)
+            yield (position, reference, all_alts,
+                   get_info_value(info, b'AC') or b'.',
+                   get_info_value(info, b'AN'))
+        return
+    query_format = '%POS\t%REF\t%ALT\t%INFO/AC'
+    if 'AN' in info_tags:
+        query_format += '\t%INFO/AN'
+    args = [
+        'bcftools', 'query',
+        '--regions', region,
+        '--format', query_format + '\n',
+        vcf_location
+    ]
+    query_process = popen(args, stdout=subprocess.PIPE, cwd='/tmp')
+    try:
+        for line in query_process.stdout:
+            fields = line.rstrip(b'\n').split(b'\t')
+            if len(fields) == 4:
+                fields.append(None)
+            yield fields
+    finally:
+        query_process.stdout.close()
+
+
+def load_genotype_index(key, etag):
+    genotype_index = genotype_index_cache.get(key, etag)
+    if genotype_index is not None:
+        return genotype_index
+    # Named by eTag too, so a newer index never replaces a mapped file
+    local_path = '{}/{}.gti'.format(
+        GENOTYPE_INDEX_DIR, hashlib.md5(f'{key}/{etag}'.encode()).hexdigest())
+    os.makedirs(GENOTYPE_INDEX_DIR, exist_ok=True)
+    print(f"Downloading s3://{INDEX_BUCKET}/{key} to {local_path}")
+    s3.download_file(INDEX_BUCKET, key, local_path)
+    genotype_index = GenotypeIndex(local_path)
+    genotype_index_cache.put(key, genotype_index,
+                             os.path.getsize(local_path), etag)
+    return genotype_index
+
+
+def name_variant(pos, ref, alt):
+    return f'{pos}{ref}>{alt}'
+
+
+def new_result():
     return {
-        'exists': exists,
-        'all_alleles_count': all_alleles_count,
-        'variant_samples': variant_samples,
-        'call_count': call_count,
+        'exists': False,
+        'all_alleles_count': 0,
+        'variant_samples': defaultdict(list),
+        'variant_call_counts': defaultdict(int),
+        'call_count': 0,
     }
 
 
+def parse_region(region):
+    chrom = region[:region.find(':')]
+    first_bp = int(region[region.find(':')+1: region.find('-')])
+    last_bp = int(region[region.find('-')+1:])
+    return chrom, first_bp, last_bp
+
+
+def get_runs(work_items, include_details):
+    """
+    Groups the work items into runs of contiguous splits of the same vcf
+    and chromosome, which are scanned together in a single pass. Yields
+    the vcf location, chromosome, the eTag its genotype indexes can be
+    used with, INFO tags, whether INFO/AC can be scanned instead of
+    genotypes, and the run's splits with their work item indexes.
+    """
+    vcf_splits = defaultdict(list)
+    vcf_etags = {}
+    for i, work_item in enumerate(work_items):
+        chrom, first_bp, last_bp = parse_region(work_item['region'])
+        vcf_etags[work_item['vcf_location']] = work_item.get('vcf_etag')
+        vcf_splits[(work_item['vcf_location'], chrom)].append(
+            (first_bp, last_bp, i))
+    info_tags = defaultdict(set)
+    if not include_details:
+        for vcf_location, _ in vcf_splits:
+            if vcf_location not in info_tags:
+                info_tags[vcf_location] = get_info_tags(vcf_location)
+    for (vcf_location, chrom), splits in vcf_splits.items():
+        splits.sort()
+        runs = []
+        for split in splits:
+            if runs and split[0] == runs[-1][-1][1] + 1:
+                runs[-1].append(split)
+            else:
+                runs.append([split])
+        # Without details only existence is needed, which INFO/AC can
+        # answer without streaming every sample's genotype.
+        scan = not include_details and 'AC' in info_tags[vcf_location]
+        for run in runs:
+            yield (vcf_location, chrom, vcf_etags[vcf_location],
+                   info_tags[vcf_location], scan, run)
+
+
+def perform_batch_queries(queries, work_items, cancellation=None):
+    """
+    Returns a result for each work item and query, with the results of
+    each work item's queries together in query order, or None if the
+    queries were cancelled before they were all complete.
+    """
+    include_details = any(query['include_details'] for query in queries)
+    results = [new_result() for _ in range(len(work_items) * len(queries))]
+    answered = [False for _ in queries]
+    for vcf_location, chrom, vcf_etag, info_tags, scan, run in get_runs(
+            work_items, include_details):
+        if all(answered):
+            # The remaining work items' results are left without hits
+            break
+        run_results = perform_queries(
+            queries, vcf_location, chrom,
+            [(first_bp, last_bp) for first_bp, last_bp, _ in run],
+            vcf_etag=vcf_etag, scan=scan, info_tags=info_tags,
+            cancellation=cancellation, answered=answered)
+        if cancellation is not None and cancellation.is_cancelled():
+            return None
+        for (_, _, i), split_results in zip(run, run_results):
+            offset = i * len(queries)
+            results[offset:offset + len(queries)] = split_results
+    return results
+
+
+def perform_queries(queries, vcf_location, chrom, splits, vcf_etag=None,
+                    scan=False, info_tags=(), popen=subprocess.Popen,
+                    cancellation=None, answered=None):
+    """
+    Queries a contiguous run of splits of a vcf for one or more allele
+    queries in a single pass, returning a list of each query's results for
+    each split. Each query only considers the records in its own region.
+    The vcf's genotype indexes are used instead of bcftools if vcf_etag is
+    the eTag they were built from. popen runs bcftools, and can be swapped
+    for a stand-in that produces the same output. Stops early, leaving the results incomplete, if the
+    cancellation is cancelled.
+
+    Without details a query is answered by a hit in any split, so it is
+    skipped once it has one, and the run stops once every query has.
+    answered holds whether each query has been answered, and is updated in
+    place so it can be shared with the other runs of a batch.
+    """
+    is_cancelled = (cancellation.is_cancelled if cancellation is not None
+                    else lambda: False)
+    first_bp = splits[0][0]
+    last_bp = splits[-1][1]
+    finders = [
+        get_hit_finder(query['reference_bases'], query['end_min'],
+                       query['end_max'], query['alternate_bases'],
+                       query['variant_type'])
+        for query in queries
+    ]
+    include_details = [query['include_details'] for query in queries]
+    results = [[new_result() for _ in queries] for _ in splits]
+    if answered is None:
+        answered = [False for _ in queries]
+    unanswered = answered.count(False)
+    split_starts = [split_first_bp for split_first_bp, _ in splits]
+    active_queries, finished = get_active_queries(queries)
+
+    def get_split_results(pos):
+        split_index = bisect.bisect_right(split_starts, pos) - 1
+        if split_index < 0 or pos > splits[split_index][1]:
+            return None
+        return results[split_index]
+
+    genotype_indexes = get_genotype_indexes(vcf_location, chrom, vcf_etag,
+                                            first_bp, last_bp)
+    if genotype_indexes is not None:
+        record_count = 0
+        for genotype_index in genotype_indexes:
+            for (pos, reference, all_alts, total_count,
+                 first_allele) in genotype_index.records(first_bp, last_bp):
+                if not record_count % CANCEL_CHECK_RECORDS and is_cancelled():
+                    return results
+                record_count += 1
+                split_results = get_split_results(pos)
+                if split_results is None:
+                    continue
+                for i in active_queries(pos):
+                    if answered[i]:
+                        continue
+                    result = split_results[i]
+                    ref_alts, hit_indexes = finders[i](pos, reference,
+                                                       all_alts)
+                    if not hit_indexes:
+                        continue
+                    add_index_hits(genotype_index, pos, ref_alts,
+                                   hit_indexes, first_allele, total_count,
+                                   include_details[i], result)
+                    if result['exists'] and not include_details[i]:
+                        answered[i] = True
+                        unanswered -= 1
+                if finished() or not unanswered:
+                    return results
+        return results
+    region = f'{chrom}:{first_bp}-{last_bp}'
+    if scan:
+        records = get_scan_records(region, chrom, first_bp, last_bp,
+                                   vcf_location, info_tags, popen)
+    else:
+        records = get_query_records(region, chrom, first_bp, last_bp,
+                                    vcf_location, popen)
+    for record_count, record in enumerate(records):
+        if not record_count % CANCEL_CHECK_RECORDS and is_cancelled():
+            break
+        pos = int(record[0])
+        split_results = get_split_results(pos)
+        if split_results is None:
+            continue
+        reference = record[1].decode()
+        all_alts = record[2].decode()
+        for i in active_queries(pos):
+            if answered[i]:
+                continue
+            result = split_results[i]
+            ref_alts, hit_indexes = finders[i](pos, reference, all_alts)
+            if not hit_indexes:
+                continue
+            if scan:
+                add_scan_hits(hit_indexes, record[3], record[4], result)
+            else:
+                add_record_hits(pos, ref_alts, hit_indexes, record[3],
+                                record[4], include_details[i], result)
+            if result['exists'] and not include_details[i]:
+                answered[i] = True
+                unanswered -= 1
+        if finished() or not unanswered:
+            break
+    records.close()
+    return results
+
+
 def lambda_handler(event, context):
     print('Event Received: {}'.format(json.dumps(event)))
-    reference_bases = event['reference_bases']
-    region = event['region']
-    end_min = event['end_min']
-    end_max = event['end_max']
-    alternate_bases = event['alternate_bases']
-    variant_type = event['variant_type']
-    include_details = event['include_details']
-    vcf_location = event['vcf_location']
-    response = perform_query(reference_bases, region, end_min, end_max,
-                             alternate_bases, variant_type, include_details,
-                             vcf_location)
+    queries = event['queries']
+    work_items = event['work_items']
+    sample_encoding = event.get('sample_encoding', JSON_ENCODING)
+    with Cancellation(RESPONSE_BUCKET,
+                      parent_keys=event.get('cancel_keys', [])) as cancellation:
+        results = perform_batch_queries(queries, work_items, cancellation)
+    if results is None:
+        response = {
+            'cancelled': True,
+        }
+        print('Returning response: {}'.format(json.dumps(response)))
+        return response
+    if sample_encoding == VARINT_ENCODING:
+        for result in results:
+            result['variant_samples'] = encode_variant_samples(
+                result['variant_samples'])
+    else:
+        sample_encoding = JSON_ENCODING
+    response = {
+        'results': results,
+        'sample_encoding': sample_encoding,
+    }
+    response = check_size(response, context)
     print('Returning response: {}'.format(json.dumps(response)))
     return response
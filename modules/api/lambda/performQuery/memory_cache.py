@@ -0,0 +1 @@
+../../shared_resources/memory_cache.py
\ No newline at end of file
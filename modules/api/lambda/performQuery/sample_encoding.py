@@ -0,0 +1 @@
+../../shared_resources/sample_encoding.py
\ No newline at end of file
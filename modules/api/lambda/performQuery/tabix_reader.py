@@ -0,0 +1 @@
+../../shared_resources/tabix_reader.py
\ No newline at end of file
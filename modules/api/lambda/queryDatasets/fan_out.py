@@ -0,0 +1 @@
+../../shared_resources/fan_out.py
\ No newline at end of file
@@ -1,20 +1,50 @@
+from collections import defaultdict
+from functools import partial
 import json
 import os
-import queue
 import re
-import threading
+import time
 
 import boto3
 
-from api_response import bad_request, bundle_response, missing_parameter
+from api_response import (bad_request, bundle_serialised_response,
+                          missing_parameter)
 from aws_utils import S3Client
-from chrom_matching import CHROMOSOMES, get_matching_chromosome, get_vcf_chromosomes
-
+from cancellation import Cancellation, get_cancel_key
+from chrom_matching import (CHROMOSOMES, get_contig_chromosome, get_contig_map,
+                            get_vcf_chromosomes)
+from dataset_catalog import get_catalog_version
+from fan_out import FanOut, get_lambda_client
+from memory_cache import MemoryCache
+from presence_bitmap import (PresenceBitmap, get_presence_prefix,
+                             parse_presence_key)
+from response_stream import StreamingResponse
+
+BATCH_GET_MAX_ITEMS = 100
+BATCH_RESOURCE = '/query/batch'
 BEACON_ID = os.environ['BEACON_ID']
+# A cached dataset catalog is used without checking the catalog version for
+# this long, and reloaded after CATALOG_MAX_AGE_SECONDS regardless, as the
+# assembly_index may not yet have caught up when the version is bumped.
+CATALOG_CHECK_SECONDS = 10
+CATALOG_MAX_AGE_SECONDS = 300
+# Size of the vcf contig maps kept between invocations
+CONTIG_CACHE_SIZE = 16 * 2**20
 DATASETS_TABLE_NAME = os.environ['DATASETS_TABLE']
+INDEX_BUCKET = os.environ['INDEX_BUCKET']
+# Allele requests in a single call to the batch endpoint
+MAXIMUM_BATCH_SIZE = 500
 MAXIMUM_RESPONSE_SIZE = 6 * 2**20
+# Size of the vcf presence bitmaps kept between invocations
+PRESENCE_CACHE_SIZE = 64 * 2**20
 RESPONSE_BUCKET = os.environ['RESPONSE_BUCKET']
 SPLIT_QUERY = os.environ['SPLIT_QUERY_LAMBDA']
+# Datasets queried at once
+SPLIT_QUERY_CONCURRENCY = 50
+# A vcf's eTag is read again once it was last read this long ago, as a vcf
+# replaced in place leaves what was summarised from it out of date
+VCF_CHECK_SECONDS = 10
+VCF_SUMMARIES_TABLE_NAME = os.environ['VCF_SUMMARIES_TABLE']
 
 INCLUDE_DATASETS_VALUES = {
     'ALL',
@@ -28,34 +58,104 @@ os.environ['PATH'] += ':' + os.environ['LAMBDA_TASK_ROOT']
 base_pattern = re.compile('[ACGTUMRWSYKVHDBN]+')
 
 dynamodb = boto3.client('dynamodb')
-aws_lambda = boto3.client('lambda')
+aws_lambda = get_lambda_client(SPLIT_QUERY_CONCURRENCY)
 s3 = S3Client()
 
+catalogs = {}
+contig_cache = MemoryCache('Contig cache', CONTIG_CACHE_SIZE)
+presence_cache = MemoryCache('Presence cache', PRESENCE_CACHE_SIZE)
+# The time each vcf's eTag was read and what it was
+vcf_etags = {}
+
 
-def check_size(response, context):
-    response_length = len(json.dumps(response))
-    print(f"Response is {response_length} characters")
-    if response_length > MAXIMUM_RESPONSE_SIZE:
+def check_size(body, context):
+    print(f"Response is {len(body)} characters")
+    if len(body) > MAXIMUM_RESPONSE_SIZE:
         print("Response is too large, uploading to S3...")
-        response_key = f'{context.aws_request_id}.json'
-        key = f'{context.function_name}/{response_key}'
-        s3.put_object(RESPONSE_BUCKET, key,
-                      json.dumps(response).encode())
+        s3.put_object(RESPONSE_BUCKET, get_response_key(context),
+                      body.encode())
+        return get_s3_response(context)
+    return body
+
+
+def get_catalog(assembly_id):
+    """
+    Returns the datasets of an assembly by id, kept between invocations
+    while the catalog version stays the same.
+    """
+    now = time.time()
+    catalog = catalogs.get(assembly_id)
+    if catalog is not None:
+        if now - catalog['checked'] < CATALOG_CHECK_SECONDS:
+            return catalog['datasets']
+        version = get_catalog_version()
+        if (version == catalog['version']
+                and now - catalog['loaded'] < CATALOG_MAX_AGE_SECONDS):
+            catalog['checked'] = now
+            return catalog['datasets']
+    else:
+        version = get_catalog_version()
+    print(f"Loading dataset catalog for {assembly_id} at version {version}")
+    datasets = {item['id']['S']: item for item in query_datasets_table(
+        assembly_id)}
+    catalogs[assembly_id] = {
+        'checked': now,
+        'datasets': datasets,
+        'loaded': now,
+        'version': version,
+    }
+    return datasets
+
+
+def get_dataset_details(dataset, vcf_chromosomes, vcf_etags, index_etags):
+    """
+    Returns what splitQuery needs to know about a dataset, or None if it
+    can't be queried. The update time and vcf eTags are there so that a
+    dataset resubmitted or with a vcf replaced in place looks different to
+    the responses splitQuery has cached. Index eTags are only given for
+    the vcfs whose indexes were built from what they hold now.
+    """
+    vcf_locations = {vcf: vcf_chromosomes[vcf]
+                     for vcf in dataset['vcfLocations']['SS']
+                     if vcf_chromosomes[vcf]}
+    annotation_location = dataset.get('annotationLocation', {'S': None})['S']
+    annotation_index = dataset.get('annotationIndex', {'S': None})['S']
+    try:
         return {
-            's3Response': {
-                'key': response_key,
-            },
+            'annotation_index': annotation_index,
+            'annotation_location': annotation_location,
+            'dataset_id': dataset['id']['S'],
+            'description': dataset.get('description', {'S': None})['S'],
+            'name': dataset['name']['S'],
+            'vcf_locations': vcf_locations,
+            'vcf_etags': {vcf: vcf_etags.get(vcf) for vcf in vcf_locations},
+            'index_etags': {vcf: index_etags[vcf] for vcf in vcf_locations
+                            if vcf in index_etags},
+            'sample_count': int(dataset['sampleCount']['N']),
+            'update_date_time': dataset.get('updateDateTime',
+                                            {'S': None})['S'],
         }
-    return response
+    except KeyError:
+        # Dataset hasn't been summarised yet or is invalid, skip
+        return None
 
 
 def get_datasets(assembly_id, dataset_ids):
+    catalog = get_catalog(assembly_id)
+    if dataset_ids:
+        return [catalog[dataset_id] for dataset_id in dict.fromkeys(dataset_ids)
+                if dataset_id in catalog]
+    return list(catalog.values())
+
+
+def query_datasets_table(assembly_id):
     items = []
     kwargs = {
-        'TableName': 'Datasets',
+        'TableName': DATASETS_TABLE_NAME,
         'IndexName': 'assembly_index',
         'ProjectionExpression': 'id,vcfLocations,annotationLocation,'
-                                'sampleCount,#name,description',
+                                'annotationIndex,sampleCount,#name,'
+                                'description,updateDateTime',
         'KeyConditionExpression': 'assemblyId = :assemblyId',
         'ExpressionAttributeNames': {
             '#name': 'name',
@@ -68,64 +168,216 @@ def get_datasets(assembly_id, dataset_ids):
     while more_results:
         print("Querying table: {}".format(json.dumps(kwargs)))
         response = dynamodb.query(**kwargs)
-        print("Received response: {}".format(json.dumps(response)))
-        items += response.get('Items', [])
+        page_items = response.pop('Items', [])
+        # The items themselves are too many to log usefully
+        print(f"Received {len(page_items)} items with response"
+              f" {json.dumps(response)}")
+        items += page_items
         last_evaluated = response.get('LastEvaluatedKey', {})
         if last_evaluated:
             kwargs['ExclusiveStartKey'] = last_evaluated
         else:
             more_results = False
-    if dataset_ids:
-        items = [i for i in items if i['id']['S'] in dataset_ids]
     return items
 
 
-def get_vcf_chromosome_map(datasets, chromosome):
-    all_vcfs = list(set(loc for d in datasets for loc in d['vcfLocations']['SS']))
-    vcf_chromosome_map = {}
-    for vcf in all_vcfs:
-        vcf_chromosomes = get_vcf_chromosomes(vcf).keys()
-        vcf_chromosome_map[vcf] = get_matching_chromosome(vcf_chromosomes,
-                                                          chromosome)
-    return vcf_chromosome_map
+def get_contig_maps(vcf_locations):
+    """
+    Returns the contig map of each vcf, as summariseVcf recorded it, and
+    the eTags of the vcfs that have finished being summarised. Maps are
+    kept between invocations by the eTag they were recorded with, so once
+    they're all loaded only the eTags need to be read. Vcfs without a
+    recorded map are read with bcftools instead.
+    """
+    all_cached = all(location in contig_cache for location in vcf_locations)
+    projection = ('vcfLocation,eTag,toUpdate'
+                  + ('' if all_cached else ',contigs'))
+    contig_maps = {}
+    etags = {}
+    summarised = {}
+    to_get = []
+    for item in get_summaries(vcf_locations, projection):
+        vcf_location = item['vcfLocation']['S']
+        etag = item.get('eTag', {}).get('S')
+        etags[vcf_location] = etag
+        if etag is not None and 'toUpdate' not in item:
+            summarised[vcf_location] = etag
+        if 'contigs' in item:
+            contig_maps[vcf_location] = read_contig_map(item, etag)
+        else:
+            contig_map = contig_cache.get(vcf_location, etag)
+            if contig_map is not None:
+                contig_maps[vcf_location] = contig_map
+            elif all_cached:
+                to_get.append(vcf_location)
+    if to_get:
+        # Resummarised since they were cached
+        for item in get_summaries(to_get, 'vcfLocation,contigs'):
+            if 'contigs' in item:
+                contig_maps[item['vcfLocation']['S']] = read_contig_map(
+                    item, etags[item['vcfLocation']['S']])
+    for vcf_location in vcf_locations:
+        if vcf_location not in contig_maps:
+            contig_map = get_contig_map(get_vcf_chromosomes(vcf_location))
+            if vcf_location in etags:
+                contig_cache.put(vcf_location, contig_map,
+                                 len(json.dumps(contig_map)),
+                                 etags[vcf_location])
+            contig_maps[vcf_location] = contig_map
+    return contig_maps, summarised
+
+
+def get_summaries(vcf_locations, projection):
+    items = []
+    for offset in range(0, len(vcf_locations), BATCH_GET_MAX_ITEMS):
+        kwargs = {
+            'RequestItems': {
+                VCF_SUMMARIES_TABLE_NAME: {
+                    'ProjectionExpression': projection,
+                    'Keys': [
+                        {
+                            'vcfLocation': {
+                                'S': location,
+                            },
+                        }
+                        for location in vcf_locations[
+                            offset:offset + BATCH_GET_MAX_ITEMS]
+                    ],
+                },
+            },
+        }
+        more_results = True
+        while more_results:
+            print("Calling dynamodb.batch_get_item with kwargs"
+                  f" {json.dumps(kwargs)}")
+            response = dynamodb.batch_get_item(**kwargs)
+            print(f"Received response {json.dumps(response)}")
+            items += response['Responses'][VCF_SUMMARIES_TABLE_NAME]
+            unprocessed_keys = response.get('UnprocessedKeys')
+            if unprocessed_keys:
+                kwargs['RequestItems'] = unprocessed_keys
+            else:
+                more_results = False
+    return items
 
 
-def perform_query(dataset, query_details, page_details,
-                  responses):
+def get_response_key(context):
+    return f'{context.function_name}/{context.aws_request_id}.json'
 
-    payload = json.dumps({
-        'dataset': dataset,
-        'query_details': query_details,
-        'page_details': page_details,
+
+def get_s3_response(context):
+    return json.dumps({
+        's3Response': {
+            'key': f'{context.aws_request_id}.json',
+        },
     })
-    print("Invoking {lambda_name} with payload: {payload}".format(
-        lambda_name=SPLIT_QUERY, payload=payload))
-    response = aws_lambda.invoke(
-        FunctionName=SPLIT_QUERY,
-        Payload=payload,
-    )
-    response_json = response['Payload'].read()
-    print("dataset_id {ds} received payload: {p}".format(ds=dataset['dataset_id'],
-                                                         p=response_json))
-    response_dict = json.loads(response_json)
-    responses.put(response_dict)
 
 
-def query_datasets(parameters, context):
-    response_dict = {
-        'beaconId': BEACON_ID,
-        'apiVersion': None,
-        'alleleRequest': parameters,
+def get_vcf_chromosome_map(datasets, chromosome):
+    """
+    Returns the name of the chromosome in each of the datasets' vcfs, the
+    current eTag of each vcf, the eTags of the vcfs that have been
+    summarised as they are now, and the presence bitmaps of those that
+    have them.
+    """
+    all_vcfs = list(set(loc for d in datasets for loc in d['vcfLocations']['SS']))
+    contig_maps, summarised = get_contig_maps(all_vcfs)
+    current_etags = get_current_etags(all_vcfs)
+    # A vcf replaced in place isn't described by what was summarised from
+    # it until it has been resummarised
+    etags = {
+        vcf: etag
+        for vcf, etag in summarised.items()
+        if current_etags.get(vcf) == etag
     }
-    validation_error = validate_request(parameters)
-    if validation_error:
-        return bad_request(validation_error, response_dict)
-
-    datasets = get_datasets(parameters['assemblyId'],
-                            parameters.get('datasetIds'))
-
-    reference_name = parameters['referenceName']
-    vcf_chromosomes = get_vcf_chromosome_map(datasets, reference_name)
+    vcf_chromosomes = {
+        vcf: get_contig_chromosome(contig_maps[vcf], chromosome)
+        for vcf in all_vcfs
+    }
+    return (vcf_chromosomes, current_etags, etags,
+            get_presence_bitmaps(vcf_chromosomes, etags))
+
+
+def get_current_etags(vcf_locations):
+    """
+    Returns the eTag each vcf has now, in the form summariseVcf records it.
+    An eTag read within VCF_CHECK_SECONDS is used again, and the rest are
+    read concurrently. A vcf that can't be read is left out.
+    """
+    now = time.time()
+    etags = {}
+    to_read = []
+    for vcf_location in vcf_locations:
+        checked, etag = vcf_etags.get(vcf_location, (0, None))
+        if now - checked < VCF_CHECK_SECONDS:
+            etags[vcf_location] = etag
+        else:
+            to_read.append(vcf_location)
+    if to_read:
+        with FanOut('vcf eTags', SPLIT_QUERY_CONCURRENCY) as fan_out:
+            for vcf_location in to_read:
+                fan_out.submit(partial(read_etag, vcf_location),
+                               error_result=(vcf_location, None))
+            for vcf_location, etag in fan_out.results():
+                if etag is not None:
+                    vcf_etags[vcf_location] = (now, etag)
+                    etags[vcf_location] = etag
+    return etags
+
+
+def get_empty_vcfs(vcf_locations, presence_bitmaps, query_details):
+    """
+    Returns the vcfs that the presence bitmaps show have no records the
+    query could match.
+    """
+    return [
+        vcf_location for vcf_location in vcf_locations
+        if vcf_location in presence_bitmaps
+        and not presence_bitmaps[vcf_location].may_match(
+            query_details['region_start'], query_details['region_end'],
+            query_details['alternate_bases'])
+    ]
+
+
+def get_presence_bitmaps(vcf_chromosomes, etags):
+    """
+    Returns the presence bitmaps of the chromosome in each vcf that has
+    finished being summarised and still has the eTag it was summarised
+    with. Bitmaps are kept between invocations by that eTag.
+    """
+    presence_bitmaps = {}
+    to_load = []
+    for vcf_location, chrom in vcf_chromosomes.items():
+        if not chrom or vcf_location not in etags:
+            continue
+        presence_bitmap = presence_cache.get((vcf_location, chrom),
+                                             etags[vcf_location])
+        if presence_bitmap is None:
+            to_load.append((vcf_location, chrom))
+        else:
+            presence_bitmaps[vcf_location] = presence_bitmap
+    if to_load:
+        with FanOut('Presence bitmaps', SPLIT_QUERY_CONCURRENCY) as fan_out:
+            for vcf_location, chrom in to_load:
+                fan_out.submit(partial(load_presence_bitmap, vcf_location,
+                                       chrom),
+                               error_result=(vcf_location, None))
+            for vcf_location, presence_bitmap in fan_out.results():
+                if presence_bitmap is None:
+                    continue
+                presence_cache.put(
+                    (vcf_location, vcf_chromosomes[vcf_location]),
+                    presence_bitmap, presence_bitmap.size,
+                    etags[vcf_location])
+                presence_bitmaps[vcf_location] = presence_bitmap
+    return presence_bitmaps
+
+
+def get_query_details(parameters):
+    """
+    Translates a validated allele request into the query details and page
+    details splitQuery takes.
+    """
     start = parameters.get('start')
     if start is None:
         region_start = parameters['startMin']
@@ -155,7 +407,6 @@ def query_datasets(parameters, context):
             region_end = region_start
             end_min = region_start + max_offset
             end_max = end_min
-    include_datasets = parameters.get('includeDatasetResponses', 'NONE')
     query_details = {
         'region_start': region_start,
         'region_end': region_end,
@@ -164,7 +415,8 @@ def query_datasets(parameters, context):
         'reference_bases': reference_bases,
         'alternate_bases': parameters.get('alternateBases'),
         'variant_type': parameters.get('variantType'),
-        'include_datasets': include_datasets,
+        'include_datasets': parameters.get('includeDatasetResponses',
+                                           'NONE'),
         'sample_fields': parameters.get('sampleFields')
     }
     page_details = {
@@ -173,59 +425,265 @@ def query_datasets(parameters, context):
         'sortby': parameters.get('variantsSortby', 'pos'),
         'desc': bool(parameters.get('variantsDescending')),
     }
-    responses = queue.Queue()
-    threads = []
+    return query_details, page_details
+
+
+def load_presence_bitmap(vcf_location, chrom):
+    if not vcf_location.startswith('s3://'):
+        return vcf_location, None
+    kwargs = {
+        'Bucket': INDEX_BUCKET,
+        'Prefix': get_presence_prefix(vcf_location, chrom),
+    }
+    slices = []
+    continuation_token = True
+    while continuation_token:
+        print(f"Calling s3.list_objects_v2 with kwargs {json.dumps(kwargs)}")
+        response = s3.client.list_objects_v2(**kwargs)
+        print(f"Received response {json.dumps(response, default=str)}")
+        for obj in response.get('Contents', []):
+            start, end = parse_presence_key(obj['Key'])
+            slices.append((start, end,
+                           s3.get_object(INDEX_BUCKET, obj['Key']).read()))
+        continuation_token = response.get('NextContinuationToken')
+        kwargs['ContinuationToken'] = continuation_token
+    return vcf_location, PresenceBitmap(slices)
+
+
+def read_etag(vcf_location):
+    if not vcf_location.startswith('s3://'):
+        # summariseVcf records the location in place of an eTag
+        return vcf_location, vcf_location
+    delimiter_index = vcf_location.find('/', 5)
+    etag = s3.get_etag(vcf_location[5:delimiter_index],
+                       vcf_location[delimiter_index + 1:])
+    return vcf_location, etag.strip('"')
+
+
+def read_contig_map(item, etag):
+    contigs_json = item['contigs']['S']
+    contig_map = json.loads(contigs_json)
+    contig_cache.put(item['vcfLocation']['S'], contig_map, len(contigs_json),
+                     etag)
+    return contig_map
+
+
+def perform_batch_query(dataset, queries, request_indexes):
+    """
+    Has splitQuery answer a batch of queries of one dataset, returning the
+    indexes of the allele requests they came from and a response for each.
+    """
+    payload = json.dumps({
+        'dataset': dataset,
+        'queries': queries,
+    })
+    print("Invoking {lambda_name} with payload: {payload}".format(
+        lambda_name=SPLIT_QUERY, payload=payload))
+    response = aws_lambda.invoke(
+        FunctionName=SPLIT_QUERY,
+        Payload=payload,
+    )
+    response_json = response['Payload'].read()
+    print("dataset_id {ds} received payload: {p}".format(ds=dataset['dataset_id'],
+                                                         p=response_json))
+    responses = read_response(json.loads(response_json)).get('responses')
+    # If the function errored out, there will be no responses
+    return request_indexes, responses or [{} for _ in request_indexes]
+
+
+def perform_query(dataset, query_details, page_details, empty_vcfs,
+                  cancellation):
+    """
+    Has splitQuery answer a query of one dataset, returning the dataset's
+    id and the response. A response too large to return from splitQuery
+    is left in S3, with its exists and include fields alongside its
+    location.
+    """
+    dataset_id = dataset['dataset_id']
+    if not cancellation.should_dispatch():
+        return dataset_id, {}
+    payload = json.dumps({
+        'dataset': dataset,
+        'query_details': query_details,
+        'page_details': page_details,
+        'empty_vcfs': empty_vcfs,
+        'cancel_keys': cancellation.child_keys,
+    })
+    print("Invoking {lambda_name} with payload: {payload}".format(
+        lambda_name=SPLIT_QUERY, payload=payload))
+    response = aws_lambda.invoke(
+        FunctionName=SPLIT_QUERY,
+        Payload=payload,
+    )
+    response_json = response['Payload'].read()
+    print("dataset_id {ds} received payload: {p}".format(ds=dataset_id,
+                                                         p=response_json))
+    return dataset_id, json.loads(response_json)
+
+
+def query_datasets(parameters, context):
+    response_dict = {
+        'beaconId': BEACON_ID,
+        'apiVersion': None,
+        'alleleRequest': parameters,
+    }
+    validation_error = validate_request(parameters)
+    if validation_error:
+        return bad_request(validation_error, response_dict)
+
+    datasets = get_datasets(parameters['assemblyId'],
+                            parameters.get('datasetIds'))
+
+    (vcf_chromosomes, vcf_etags, index_etags,
+     presence_bitmaps) = get_vcf_chromosome_map(datasets,
+                                                parameters['referenceName'])
+    query_details, page_details = get_query_details(parameters)
+    include_datasets = query_details['include_datasets']
+    # A dataset that can't have a hit and won't be included in the response
+    # doesn't need querying at all.
+    skip_empty = include_datasets in ('NONE', 'HIT')
+    fan_out = FanOut('splitQuery', SPLIT_QUERY_CONCURRENCY)
+    # Only a NONE query stops before every dataset has answered, so only it
+    # has the splitQuery invocations watch for a marker.
+    cancel_key = (get_cancel_key(context.function_name, context.aws_request_id)
+                  if include_datasets == 'NONE' else None)
+    cancellation = Cancellation(RESPONSE_BUCKET, cancel_key)
+    dataset_ids = []
+    skipped = 0
     for dataset in datasets:
-        dataset_id = dataset['id']['S']
-        vcf_locations = {vcf: vcf_chromosomes[vcf]
-                         for vcf in dataset['vcfLocations']['SS']
-                         if vcf_chromosomes[vcf]}
-        annotation_location = dataset.get('annotationLocation',
-                                          {'S': None})['S']
-        try:
-            dataset_details = {
-                'annotation_location': annotation_location,
-                'dataset_id': dataset_id,
-                'description': dataset.get('description', {'S': None})['S'],
-                'name': dataset['name']['S'],
-                'vcf_locations': vcf_locations,
-                'sample_count': int(dataset['sampleCount']['N']),
-
-            }
-        except KeyError:
-            # Dataset hasn't been summarised yet or is invalid, skip
+        dataset_details = get_dataset_details(dataset, vcf_chromosomes,
+                                              vcf_etags, index_etags)
+        if dataset_details is None:
             continue
-        t = threading.Thread(target=perform_query,
-                             kwargs={
-                                 'dataset': dataset_details,
-                                 'query_details': query_details,
-                                 'page_details': page_details,
-                                 'responses': responses,
-                             })
-        t.start()
-        threads.append(t)
-    num_threads = len(threads)
+        vcf_locations = dataset_details['vcf_locations']
+        empty_vcfs = get_empty_vcfs(vcf_locations, presence_bitmaps,
+                                    query_details)
+        if skip_empty and len(empty_vcfs) == len(vcf_locations):
+            skipped += 1
+            continue
+        dataset_ids.append(dataset_details['dataset_id'])
+        fan_out.submit(partial(perform_query, dataset_details, query_details,
+                               page_details, empty_vcfs, cancellation),
+                       error_result=(dataset_details['dataset_id'], {}))
+    print(f"Skipping {skipped} datasets with no records that could match")
+    # Dataset responses are written out in order of datasetId as they
+    # arrive, so the full response is never held or serialised as a whole.
+    streaming_response = StreamingResponse(
+        s3, RESPONSE_BUCKET, get_response_key(context), MAXIMUM_RESPONSE_SIZE,
+        response_dict, 'datasetAlleleResponses', dataset_ids)
     processed = 0
-    dataset_responses = []
     exists = False
-    while processed < num_threads and (include_datasets != 'NONE'
-                                       or not exists):
-        raw_response = responses.get()
-        response = read_response(raw_response)
-        processed += 1
-        if 'exists' not in response:
-            # function errored out, ignore
-            continue
-        exists = exists or response['exists']
-        if response.pop('include'):
-            dataset_responses.append(response)
-    dataset_responses.sort(key=lambda r: r['datasetId'])
-    response_dict.update({
-        'exists': exists,
-        'datasetAlleleResponses': dataset_responses or None,
-    })
-    response_dict = check_size(response_dict, context)
-    return bundle_response(200, response_dict)
+    with fan_out, streaming_response:
+        for dataset_id, response in fan_out.results():
+            processed += 1
+            if 'exists' not in response:
+                # function errored out, ignore
+                streaming_response.add(dataset_id)
+                continue
+            exists = exists or response['exists']
+            if not response.pop('include'):
+                streaming_response.add(dataset_id)
+            elif 's3Response' in response:
+                s3_response = response['s3Response']
+                streaming_response.add_s3(dataset_id, s3_response['bucket'],
+                                          s3_response['key'])
+            else:
+                streaming_response.add(dataset_id,
+                                       json.dumps(response).encode())
+            if include_datasets == 'NONE' and exists:
+                break
+        if processed < len(fan_out):
+            # The answer is known, so stop the remaining datasets' queries
+            cancellation.cancel_children()
+        body = streaming_response.finish({
+            'exists': exists,
+        })
+    if body is None:
+        return bundle_serialised_response(200, get_s3_response(context))
+    return bundle_serialised_response(200, body.decode())
+
+
+def query_batch(parameters, context):
+    """
+    Answers a list of allele requests, each as /query would. Requests of
+    the same assembly, datasets and chromosome are sent to splitQuery
+    together, one invocation per dataset, so the vcfs are scanned once
+    for all of them.
+    """
+    response_dict = {
+        'beaconId': BEACON_ID,
+        'apiVersion': None,
+    }
+    validation_error = validate_batch(parameters)
+    if validation_error:
+        return bad_request(validation_error, response_dict)
+
+    allele_requests = parameters['requests']
+    groups = defaultdict(list)
+    for i, allele_request in enumerate(allele_requests):
+        dataset_ids = allele_request.get('datasetIds')
+        groups[(allele_request['assemblyId'],
+                tuple(dataset_ids) if dataset_ids else None,
+                allele_request['referenceName'])].append(i)
+    fan_out = FanOut('splitQuery', SPLIT_QUERY_CONCURRENCY)
+    for (assembly_id, dataset_ids, reference_name), indexes in groups.items():
+        datasets = get_datasets(assembly_id, dataset_ids)
+        (vcf_chromosomes, vcf_etags, index_etags,
+         presence_bitmaps) = get_vcf_chromosome_map(datasets, reference_name)
+        queries = []
+        for i in indexes:
+            query_details, page_details = get_query_details(
+                allele_requests[i])
+            queries.append({
+                'query_details': query_details,
+                'page_details': page_details,
+            })
+        for dataset in datasets:
+            dataset_details = get_dataset_details(dataset, vcf_chromosomes,
+                                                  vcf_etags, index_etags)
+            if dataset_details is None:
+                continue
+            vcf_locations = dataset_details['vcf_locations']
+            dataset_queries = []
+            dataset_indexes = []
+            for i, query in zip(indexes, queries):
+                empty_vcfs = get_empty_vcfs(vcf_locations, presence_bitmaps,
+                                            query['query_details'])
+                # As for /query, skip what can't hit and won't be included
+                if (len(empty_vcfs) == len(vcf_locations)
+                        and query['query_details']['include_datasets']
+                        in ('NONE', 'HIT')):
+                    continue
+                dataset_queries.append(dict(query, empty_vcfs=empty_vcfs))
+                dataset_indexes.append(i)
+            if not dataset_queries:
+                continue
+            fan_out.submit(partial(perform_batch_query, dataset_details,
+                                   dataset_queries, dataset_indexes),
+                           error_result=(dataset_indexes,
+                                         [{} for _ in dataset_indexes]))
+    exists = [False] * len(allele_requests)
+    dataset_responses = [[] for _ in allele_requests]
+    with fan_out:
+        for indexes, responses in fan_out.results():
+            for i, response in zip(indexes, responses):
+                if 'exists' not in response:
+                    # function errored out, ignore
+                    continue
+                exists[i] = exists[i] or response['exists']
+                if response.pop('include'):
+                    dataset_responses[i].append(response)
+    response_dict['responses'] = []
+    for allele_request, request_exists, request_responses in zip(
+            allele_requests, exists, dataset_responses):
+        request_responses.sort(key=lambda r: r['datasetId'])
+        response_dict['responses'].append({
+            'alleleRequest': allele_request,
+            'exists': request_exists,
+            'datasetAlleleResponses': request_responses or None,
+        })
+    return bundle_serialised_response(
+        200, check_size(json.dumps(response_dict), context))
 
 
 def read_response(raw_response):
@@ -388,6 +846,26 @@ def validate_request(parameters):
     return ''
 
 
+def validate_batch(parameters):
+    allele_requests = parameters.get('requests')
+    if allele_requests is None:
+        return missing_parameter('requests')
+    if not isinstance(allele_requests, list):
+        return "requests must be an array"
+    if not allele_requests:
+        return "requests must contain at least one allele request"
+    if len(allele_requests) > MAXIMUM_BATCH_SIZE:
+        return "requests may contain at most {} allele requests".format(
+            MAXIMUM_BATCH_SIZE)
+    for i, allele_request in enumerate(allele_requests):
+        if not isinstance(allele_request, dict):
+            return "requests[{}] must be an object".format(i)
+        validation_error = validate_request(allele_request)
+        if validation_error:
+            return "requests[{}]: {}".format(i, validation_error)
+    return ''
+
+
 def lambda_handler(event, context):
     print('Event Received: {}'.format(json.dumps(event)))
     extra_params = {
@@ -402,6 +880,8 @@ def lambda_handler(event, context):
         except ValueError:
             return bad_request('Error parsing request body, Expected JSON.',
                                extra_params)
+        if event.get('resource') == BATCH_RESOURCE:
+            return query_batch(parameters, context)
     else:  # method == 'GET'
         parameters = event['queryStringParameters']
         if not parameters:
@@ -0,0 +1 @@
+../../shared_resources/response_stream.py
\ No newline at end of file
@@ -1,18 +1,33 @@
-import base64
 from collections import Counter, defaultdict
 import csv
+from functools import partial
+import gzip
+import hashlib
+import itertools
 import json
 import math
 from operator import itemgetter
 import os
-import queue
-import re
+import shutil
 import threading
+import time
 
 import boto3
 from botocore.exceptions import ClientError
+import numpy as np
 
+from allele_matching import get_hit_finder
+from annotation_index import get_block_ranges, read_block, variant_pattern
 from aws_utils import S3Client
+from cancellation import Cancellation, get_cancel_key
+from fan_out import FanOut, get_lambda_client
+from memory_cache import MemoryCache
+from record_density import get_density_prefix, parse_density_key, plan_splits
+from sample_encoding import (VARINT_ENCODING, decode_samples,
+                             decode_variant_samples, encode_samples)
+from sample_metadata import (METADATA_TRANSLATIONS, NORMALISED_FIELDS,
+                             encode_column, get_column_keys,
+                             get_manifest_key, get_metadata_csv, normalise)
 
 
 EXTRA_ANNOTATION_FIELDS = {
@@ -20,69 +35,266 @@ EXTRA_ANNOTATION_FIELDS = {
     'SIFT_score',
 }
 
+# Rough time for performQuery to scan a split of TARGET_SPLIT_RECORDS
+# records, used to pack splits into invocations that should each take about
+# TARGET_INVOCATION_SECONDS.
+ESTIMATED_SPLIT_SECONDS = 0.5
+TARGET_INVOCATION_SECONDS = 8
+TARGET_SPLIT_RECORDS = 300
+
+# Queries of a batch whose regions are closer together than this many bases
+# are scanned together, as reading the records between them is cheaper
+# than another pass over the vcfs
+BATCH_REGION_GAP = 10000
+# Cache lookups and writes for the queries of a batch made at once
+BATCH_CACHE_CONCURRENCY = 32
+# Annotation blocks closer together than this are fetched in one request
+ANNOTATION_RANGE_GAP = 256 * 2**10
+# Beyond this many ranges, the span covering all of them is fetched instead
+MAXIMUM_ANNOTATION_RANGES = 8
+# Size of the annotation indexes kept loaded between invocations
+ANNOTATION_INDEX_CACHE_SIZE = 16 * 2**20
 CACHE_BUCKET = os.environ['CACHE_BUCKET']
+# gzip's highest level takes several times as long to write large entries
+# for only a few percent less space
+CACHE_COMPRESS_LEVEL = 6
 CACHE_TABLE = os.environ['CACHE_TABLE']
 COUNTRY_CODES_PATH = os.environ['LAMBDA_TASK_ROOT'] + '/country_codes.json'
+# Size of the record densities kept loaded between invocations
+DENSITY_CACHE_SIZE = 16 * 2**20
+# Record densities read at once, as many as the S3 client has connections
+DENSITY_CONCURRENCY = 10
+INDEX_BUCKET = os.environ['INDEX_BUCKET']
+# Compressed cache entries up to this size are kept in the cache table item
+# itself, saving the S3 round trip on a hit. A read of up to 4KB costs one
+# read unit, so this keeps inline hits to at most two.
+INLINE_CACHE_SIZE = 8 * 2**10
 MAXIMUM_RESPONSE_SIZE = 6 * 2**20
-METADATA_TRANSLATIONS = {
-    'State': 'Location',
-}
+# Keeps the page indexes stored in a cache item well under DynamoDB's
+# 400KB item limit
+MAXIMUM_PAGE_INDEX_SIZE = 64 * 2**10
+# Where sample metadata columns are downloaded to be memory mapped
+METADATA_DIR = '/tmp/metadata'
+# Size of the sample metadata columns kept loaded between invocations
+METADATA_CACHE_SIZE = 128 * 2**20
+# A vcf's sample metadata manifest is checked for changes once it was last
+# checked this long ago
+MANIFEST_CHECK_SECONDS = 10
+# Variants stored together in each compressed chunk of a sorted copy, few
+# enough that a page reads little more than it returns
+PAGE_CHUNK_SIZE = 10
+# Prefix of the cache item attributes locating a sorted copy of an entry's
+# variants, so one page can be read without the rest
+PAGE_PREFIX = 'pages/'
 PERFORM_QUERY = os.environ['PERFORM_QUERY_LAMBDA']
+# Batches of splits queried at once, enough for most queries to run in a
+# single wave within the timeout
+PERFORM_QUERY_CONCURRENCY = 200
+# Serialised size of the responses kept in memory between invocations
+RESPONSE_CACHE_SIZE = 64 * 2**20
 RESPONSE_BUCKET = os.environ['RESPONSE_BUCKET']
+SAMPLE_ENCODING = os.environ['SAMPLE_ENCODING']
+# Query details that define the region rather than the allele
+RANGE_DETAILS = ('region_start', 'region_end', 'end_min', 'end_max')
+# Prefix of the cache items recording which region a detailed result covers
+RANGE_PREFIX = 'range/'
+RANGE_ATTRIBUTES = ('regionStart', 'regionEnd', 'endMin', 'endMax')
+# The counts in a response's info that need each set of sample fields
+SAMPLE_FIELD_COUNTS = {
+    'locationCounts': {'Location'},
+    'dateCounts': {'SampleCollectionDate'},
+    'stateCounts': {'State'},
+    'locationDateCounts': {'Location', 'SampleCollectionDate'},
+    'stateDateCounts': {'State', 'SampleCollectionDate'},
+}
 SPLIT_SIZE = int(os.environ['SPLIT_SIZE'])
 
-aws_lambda = boto3.client('lambda')
+aws_lambda = get_lambda_client(PERFORM_QUERY_CONCURRENCY)
 dynamodb = boto3.client('dynamodb')
 s3 = S3Client()
 
+annotation_index_cache = MemoryCache('Annotation index cache',
+                                     ANNOTATION_INDEX_CACHE_SIZE)
+density_cache = MemoryCache('Record density cache', DENSITY_CACHE_SIZE)
+# An evicted column's file is deleted, though a query still using it keeps
+# its mapping until it's done
+metadata_cache = MemoryCache(
+    'Sample metadata cache', METADATA_CACHE_SIZE,
+    on_remove=lambda column: remove_column_file(column))
+response_cache = MemoryCache('Response cache', RESPONSE_CACHE_SIZE)
+
+# The time each vcf's sample metadata manifest was checked, its eTag and
+# what it was
+manifests = {}
+
 with open(COUNTRY_CODES_PATH) as country_codes_json:
     country_codes = json.load(country_codes_json)
 
+# Files left by an earlier process in this container aren't in the cache,
+# so would never be removed
+shutil.rmtree(METADATA_DIR, ignore_errors=True)
 
-def cache_response(response, dataset_id, query_args):
-    response_body = json.dumps(response).encode()
-    encoded_query = base64.urlsafe_b64encode(query_args.encode())
-    safe_query = encoded_query.decode().strip('=')
-    key = f'{dataset_id}/{safe_query}'
-    s3.put_object(CACHE_BUCKET, key, response_body)
-    kwargs = {
-        'TableName': CACHE_TABLE,
-        'Item': {
+
+def build_response(dataset, query_details, exists, call_count, variants):
+    include_datasets = query_details['include_datasets']
+    sample_fields = query_details['sample_fields']
+    vcf_samples = defaultdict(list)
+    for location_samples in variants.values():
+        for vcf_location, samples in location_samples.items():
+            vcf_samples[vcf_location].append(samples)
+    vcf_samples = {
+        vcf_location: np.unique(np.concatenate(all_samples))
+        for vcf_location, all_samples in vcf_samples.items()
+    }
+    dataset_sample_count = dataset['sample_count']
+    if (include_datasets == 'ALL' or (include_datasets == 'HIT' and exists)
+            or (include_datasets == 'MISS' and not exists)):
+        annotations = get_annotations(dataset['annotation_location'],
+                                      dataset.get('annotation_index'),
+                                      variants.keys())
+        variant_codes = []
+        for annotation in annotations:
+            variant_code = annotation.pop('Variant')
+            variant_codes.append(variant_code)
+            pos, ref, alt = variant_pattern.fullmatch(variant_code).groups()
+            variant_sample_count = sum(
+                len(s) for s in variants[variant_code].values()
+            )
+            annotation.update({
+                'pos': int(pos),
+                'ref': ref,
+                'alt': alt,
+                'sampleCount': variant_sample_count,
+                'frequency': get_frequency(variant_sample_count, dataset_sample_count),
+            })
+        sample_count = sum(len(samples)
+                           for samples in vcf_samples.values())
+        response_dict = {
+            'include': True,
+            'datasetId': dataset['dataset_id'],
+            'exists': exists,
+            # Note not allelic frequency, only sample frequency
+            'frequency': get_frequency(sample_count, dataset_sample_count),
+            'variantCount': len(variants),
+            'callCount': call_count,
+            'sampleCount': sample_count,
+            'note': None,
+            'externalUrl': None,
+            'info': {
+                'description': dataset['description'],
+                'name': dataset['name'],
+                'datasetSampleCount': dataset_sample_count,
+                'variants': annotations,
+                'totalEntries': len(annotations),
+            },
+            'error': None,
+        }
+        if sample_fields:
+            (sample_details, compressed_variants,
+             extra_fields) = process_samples(variants, sample_fields)
+            response_dict['info'].update({
+                'sampleFields': sample_fields,
+                'sampleDetails': sample_details,
+            })
+            response_dict['info'].update(extra_fields)
+            for code, variant in zip(variant_codes,
+                                     response_dict['info']['variants']):
+                variant['samples'] = compressed_variants[code]
+    else:
+        response_dict = {
+            'include': False,
+            'exists': exists,
+        }
+    return response_dict
+
+
+def cache_response(stored, dataset_id, query_args, query_details,
+                   dataset_version):
+    response_body = json.dumps(stored).encode()
+    compressed_body = gzip.compress(response_body,
+                                    compresslevel=CACHE_COMPRESS_LEVEL)
+    item = {
+        'datasetId': {
+            'S': dataset_id,
+        },
+        'queryArgs': {
+            'S': query_args,
+        },
+        'datasetVersion': {
+            'S': dataset_version,
+        },
+    }
+    if len(compressed_body) <= INLINE_CACHE_SIZE:
+        item['queryResponse'] = {
+            'B': compressed_body,
+        }
+    else:
+        key = f'{dataset_id}/{query_args}.json.gz'
+        s3.put_object(CACHE_BUCKET, key, compressed_body)
+        item['queryLocation'] = {
+            'S': key,
+        }
+    put_cache_item(item)
+    if stored['details'] is not None:
+        # Lets queries of smaller regions find this result
+        range_item = {
             'datasetId': {
                 'S': dataset_id,
             },
             'queryArgs': {
-                'S': query_args,
+                'S': (f'{RANGE_PREFIX}{get_allele_key(query_details)}/'
+                      f'{query_args}'),
             },
-            'queryLocation': {
-                'S': key
+        }
+        for attribute, detail in zip(RANGE_ATTRIBUTES, RANGE_DETAILS):
+            range_item[attribute] = {
+                'N': str(query_details[detail]),
             }
-        },
-    }
-    print(f"Calling dynamodb.put_item with kwargs {json.dumps(kwargs)}")
-    dynamodb_response = dynamodb.put_item(**kwargs)
-    response_string = json.dumps(dynamodb_response, default=str)
-    print(f"Received response {response_string}")
+        put_cache_item(range_item)
+    return response_body, item
 
 
 def check_size(response, context):
-    response_length = len(json.dumps(response))
-    print(f"Response is {response_length} characters")
-    if response_length > MAXIMUM_RESPONSE_SIZE:
+    """
+    Uploads a response too large to return to S3. A dataset response is
+    uploaded without its include field, which is returned alongside the
+    location with its exists field, so queryDatasets can copy it into its
+    own response without reading it.
+    """
+    include = response.pop('include', None)
+    body = json.dumps(response).encode()
+    print(f"Response is {len(body)} characters")
+    if len(body) > MAXIMUM_RESPONSE_SIZE:
         print("Response is too large, uploading to S3...")
         key = f'{context.function_name}/{context.aws_request_id}.json'
-        s3.put_object(RESPONSE_BUCKET, key,
-                      json.dumps(response).encode())
-        return {
+        s3.put_object(RESPONSE_BUCKET, key, body)
+        s3_response = {
             's3Response': {
                 'bucket': RESPONSE_BUCKET,
                 'key': key,
             },
         }
+        if include is not None:
+            s3_response.update({
+                'exists': response['exists'],
+                'include': include,
+            })
+        return s3_response
+    if include is not None:
+        response['include'] = include
     return response
 
 
-def get_cached(dataset_id, query_args):
+def describe_bytes(value):
+    return f'<{len(value)} bytes>'
+
+
+def get_cache_item(dataset_id, query_args, dataset_version,
+                   page_details=None):
+    """
+    Returns the cache item of the query, or None if there isn't one stored
+    for this version of the dataset.
+    """
     kwargs = {
         'TableName': CACHE_TABLE,
         'Key': {
@@ -93,21 +305,254 @@ def get_cached(dataset_id, query_args):
                 'S': query_args,
             },
         },
-        'ProjectionExpression': 'queryLocation',
+        'ProjectionExpression': 'queryLocation,queryResponse,datasetVersion',
     }
+    if page_details is not None:
+        kwargs['ProjectionExpression'] += ',#page'
+        kwargs['ExpressionAttributeNames'] = {
+            '#page': get_page_attribute(page_details),
+        }
     print(f"Calling dynamodb.get_item with kwargs: {json.dumps(kwargs)}")
     response = dynamodb.get_item(**kwargs)
-    print(f"Received response {json.dumps(response)}")
+    print("Received response"
+          f" {json.dumps(response, default=describe_bytes)}")
     item = response.get('Item')
-    if not item:
+    if (item is not None
+            and item.get('datasetVersion', {}).get('S') != dataset_version):
+        # Until flushCache has caught up with a change to the dataset
+        print("Cache item is from a different version of the dataset")
         return None
+    return item
+
+
+def get_cached(item):
+    if 'queryResponse' in item:
+        return gzip.decompress(item['queryResponse']['B'])
     query_location = item['queryLocation']['S']
     try:
         streaming_body = s3.get_object(CACHE_BUCKET, query_location)
     except ClientError as error:
         print(json.dumps(error.response, default=str))
         return None
-    return json.load(streaming_body)
+    if query_location.endswith('.gz'):
+        # Decompress as it downloads rather than holding both copies
+        with gzip.GzipFile(fileobj=streaming_body) as body:
+            return body.read()
+    # Stored uncompressed before entries were compressed
+    return streaming_body.read()
+
+
+def get_covering_query(dataset_id, query_details):
+    """
+    Returns the query args of the cached detailed result of the same allele
+    query over the smallest region containing this query's, if any.
+    """
+    kwargs = {
+        'TableName': CACHE_TABLE,
+        'KeyConditionExpression': ('datasetId = :datasetId'
+                                   ' AND begins_with(queryArgs, :prefix)'),
+        'ProjectionExpression': 'queryArgs,' + ','.join(RANGE_ATTRIBUTES),
+        'ExpressionAttributeValues': {
+            ':datasetId': {
+                'S': dataset_id,
+            },
+            ':prefix': {
+                'S': f'{RANGE_PREFIX}{get_allele_key(query_details)}/',
+            },
+        },
+    }
+    best_query_args = None
+    best_size = None
+    last_key = True
+    while last_key:
+        print(f"Calling dynamodb.query with kwargs {json.dumps(kwargs)}")
+        response = dynamodb.query(**kwargs)
+        print(f"Received response {json.dumps(response, default=str)}")
+        for item in response['Items']:
+            region_start, region_end, end_min, end_max = (
+                int(item[attribute]['N']) for attribute in RANGE_ATTRIBUTES)
+            if not (region_start <= query_details['region_start']
+                    and query_details['region_end'] <= region_end
+                    and end_min <= query_details['end_min']
+                    and query_details['end_max'] <= end_max):
+                continue
+            size = region_end - region_start
+            if best_size is None or size < best_size:
+                best_size = size
+                best_query_args = item['queryArgs']['S'].rsplit('/', 1)[1]
+        last_key = response.get('LastEvaluatedKey')
+        kwargs['ExclusiveStartKey'] = last_key
+    return best_query_args
+
+
+def get_dataset_version(dataset):
+    # Changes whenever the dataset is resubmitted, through its update time,
+    # or any of its vcfs is replaced, through their eTags. Whether a vcf's
+    # indexes can be used doesn't change what the query finds.
+    dataset_json = json.dumps({
+        key: value
+        for key, value in dataset.items()
+        if key != 'index_etags'
+    }, sort_keys=True)
+    return hashlib.sha256(dataset_json.encode()).hexdigest()
+
+
+def get_allele_key(query_details):
+    """
+    Returns a key for the query ignoring its region, shared by every region
+    a detailed result could be cut down to.
+    """
+    return get_query_key(query_details, RANGE_DETAILS)
+
+
+def get_query_key(query_details, ignored_details=()):
+    """
+    Returns a key for the allele query alone, as one stored response can
+    answer it for any includeDatasetResponses and most sampleFields.
+    """
+    allele_query = {
+        detail: value
+        for detail, value in query_details.items()
+        if detail not in ('include_datasets', 'sample_fields')
+        and detail not in ignored_details
+    }
+    query_json = json.dumps(allele_query, sort_keys=True)
+    return hashlib.sha256(query_json.encode()).hexdigest()
+
+
+def get_indexed_page(page_index, include_datasets, sample_fields,
+                     page_details):
+    """
+    Reads one page of a response from the sorted copy of its variants,
+    returning None if the stored response can't answer the query.
+    """
+    offsets = decode_samples(page_index['M']['offsets']['S']).tolist()
+    location = page_index['M']['location']['S']
+    chunk_size = int(page_index['M']['chunkSize']['N'])
+    num_variants = int(page_index['M']['variantCount']['N'])
+    page_size = page_details['page_size']
+    if page_size is None:
+        page_size = num_variants
+    page = page_details['page']
+    skip = min((page-1) * page_size, num_variants)
+    final_index = min(page * page_size, num_variants)
+    first_chunk = skip // chunk_size
+    last_chunk = max(first_chunk, -(-final_index // chunk_size))
+    print(f"Reading annotations [{skip}:{final_index}] of {num_variants}"
+          f" in chunks [{first_chunk}:{last_chunk}] from {location}")
+    if first_chunk == 0:
+        body = s3.get_object(CACHE_BUCKET, location,
+                             (0, offsets[last_chunk])).read()
+        head_body = body[:offsets[0]]
+        chunks_body = body[offsets[0]:]
+    else:
+        head_body = s3.get_object(CACHE_BUCKET, location,
+                                  (0, offsets[0])).read()
+        chunks_body = b''
+        if last_chunk > first_chunk:
+            chunks_body = s3.get_object(
+                CACHE_BUCKET, location,
+                (offsets[first_chunk], offsets[last_chunk])).read()
+    head = json.loads(gzip.decompress(head_body))
+    response = reuse_response(head, include_datasets, sample_fields)
+    if response is None or not response['include']:
+        return response
+    variants = []
+    sample_rows = {}
+    chunk_start = offsets[first_chunk]
+    for chunk_end in offsets[first_chunk+1:last_chunk+1]:
+        chunk = json.loads(gzip.decompress(
+            chunks_body[chunk_start - offsets[first_chunk]:
+                        chunk_end - offsets[first_chunk]]))
+        variants += chunk['variants']
+        sample_rows.update(zip(chunk.get('samples', []),
+                               chunk.get('sampleDetails', [])))
+        chunk_start = chunk_end
+    chunk_skip = first_chunk * chunk_size
+    info = dict(
+        head['info'],
+        variants=variants[skip - chunk_skip:final_index - chunk_skip],
+        pages=math.ceil(num_variants / page_size),
+    )
+    if 'sampleDetails' in info:
+        info['variants'], info['sampleDetails'] = number_page_samples(
+            info['variants'], sample_rows)
+    return reuse_response(dict(head, info=info), include_datasets,
+                          sample_fields)
+
+
+def get_page_attribute(page_details):
+    order = 'desc' if page_details['desc'] else 'asc'
+    return f'{PAGE_PREFIX}{order}/{page_details["sortby"]}'
+
+
+def get_stored(dataset_id, query_args, dataset_version):
+    cache_key = (dataset_id, query_args)
+    stored = response_cache.get(cache_key, dataset_version)
+    if stored is None:
+        item = get_cache_item(dataset_id, query_args, dataset_version)
+        if item is not None:
+            stored = read_stored(dataset_id, query_args, dataset_version,
+                                 item)
+    return stored
+
+
+def get_subregion(dataset, query_details, details):
+    """
+    Rebuilds a detailed result for a region from the stored details of a
+    query of a larger region containing it. The stored variants are the
+    hits of that query, so they are matched against this one the same way
+    performQuery matches records.
+    """
+    find_hits = get_hit_finder(query_details['reference_bases'],
+                               query_details['end_min'],
+                               query_details['end_max'],
+                               query_details['alternate_bases'],
+                               query_details['variant_type'])
+
+    def in_region(variant):
+        pos, ref, alt = variant_pattern.fullmatch(variant).groups()
+        pos = int(pos)
+        return (query_details['region_start'] <= pos
+                <= query_details['region_end']
+                and bool(find_hits(pos, ref, alt)[1]))
+
+    call_counts = {
+        variant: call_count
+        for variant, call_count in details['callCounts'].items()
+        if in_region(variant)
+    }
+    variants = defaultdict(dict)
+    for variant, location_samples in details['samples'].items():
+        if not in_region(variant):
+            continue
+        for vcf_location, samples in location_samples.items():
+            variants[variant][vcf_location] = decode_samples(samples)
+    call_count = sum(call_counts.values())
+    # performQuery marks a result as existing once it has any calls, and
+    # every hit with calls is in the stored call counts.
+    exists = call_count > 0
+    return {
+        'response': build_response(dataset, query_details, exists,
+                                   call_count, variants),
+        'details': get_details(variants, call_counts),
+    }
+
+
+def get_details(variants, variant_call_counts):
+    """
+    What a detailed result needs to be cut down to a smaller region.
+    """
+    return {
+        'callCounts': dict(variant_call_counts),
+        'samples': {
+            variant: {
+                vcf_location: encode_samples(samples)
+                for vcf_location, samples in location_samples.items()
+            }
+            for variant, location_samples in variants.items()
+        },
+    }
 
 
 def get_frequency(samples, total_samples):
@@ -119,23 +564,142 @@ def get_frequency(samples, total_samples):
     return rounded
 
 
-def get_annotations(annotation_location, variants):
+def add_spilled_samples(spilled_samples, results):
+    """
+    Merges variant samples that performQuery uploaded because its response
+    was too large, decoding a line at a time.
+    """
+    streaming_body = s3.get_object(spilled_samples['bucket'],
+                                   spilled_samples['key'])
+    for line in streaming_body.iter_lines():
+        result_index, variant, samples = line.decode().split('\t')
+        results[int(result_index)]['variant_samples'][variant] = (
+            decode_samples(samples))
+
+
+def get_manifest(vcf_location):
+    """
+    Returns the manifest of the sample metadata summariseVcf built for a
+    vcf. A manifest checked within MANIFEST_CHECK_SECONDS is used again,
+    and after that it is only downloaded again if its eTag has changed.
+    """
+    now = time.time()
+    checked, etag, manifest = manifests.get(vcf_location, (0, None, None))
+    if now - checked < MANIFEST_CHECK_SECONDS:
+        return manifest
+    changed = s3.get_changed_object(INDEX_BUCKET,
+                                    get_manifest_key(vcf_location), etag)
+    if changed is not None:
+        etag, streaming_body = changed
+        manifest = json.loads(streaming_body.read())
+    manifests[vcf_location] = (now, etag, manifest)
+    return manifest
+
+
+def get_metadata_column(vcf_location, build, field):
+    column = metadata_cache.get((vcf_location, field), build)
+    if column is not None:
+        return column
+    codes_key, values_key = get_column_keys(vcf_location, build, field)
+    # Builds are named by their contents, so a file a concurrent query has
+    # just downloaded is still correct. Each vcf's file is its own, so
+    # evicting one doesn't remove another's.
+    path = os.path.join(METADATA_DIR,
+                        hashlib.md5(codes_key.encode()).hexdigest() + '.npy')
+    if not os.path.exists(path):
+        os.makedirs(METADATA_DIR, exist_ok=True)
+        streaming_body = s3.get_object(INDEX_BUCKET, codes_key)
+        # Queries of a batch can download the same column at once
+        part_path = f'{path}.{threading.get_ident()}.part'
+        with open(part_path, 'wb') as codes_file:
+            shutil.copyfileobj(streaming_body, codes_file)
+        os.rename(part_path, path)
+    codes = np.load(path, mmap_mode='r')
+    values_body = s3.get_object(INDEX_BUCKET, values_key).read()
+    column = (codes, json.loads(values_body))
+    metadata_cache.put((vcf_location, field), column,
+                       codes.nbytes + len(values_body), build)
+    return column
+
+
+def get_metadata_columns(vcf_location, fields):
+    """
+    Loads the requested columns of the sample metadata summariseVcf built
+    for a vcf, as arrays of codes and the values they index. Returns None
+    if there is no build or a field couldn't be built.
+    """
+    try:
+        manifest = get_manifest(vcf_location)
+    except ClientError as error:
+        print(json.dumps(error.response, default=str))
+        return None
+    stored_fields = set(manifest['fields'])
+    columns = []
+    for field in fields:
+        if field in stored_fields:
+            columns.append(get_metadata_column(vcf_location,
+                                               manifest['build'], field))
+        elif field in NORMALISED_FIELDS:
+            # Had values that couldn't be cleaned up, the csv will show why
+            return None
+        else:
+            # Not in the csv
+            sample_count = manifest['sampleCount']
+            columns.append((np.zeros(sample_count, dtype=np.int32),
+                            [None] if sample_count else []))
+    return columns
+
+
+def get_sample_columns(vcf_location, fields):
+    """
+    Returns the cleaned up values of each field of a vcf's samples as an
+    array of codes and the values they index, in the order they first
+    appear. Returns None if its metadata can't be accessed.
+    """
+    columns = get_metadata_columns(vcf_location, fields)
+    if columns is not None:
+        return columns
+    bucket, key = get_metadata_csv(vcf_location)
+    try:
+        streaming_body = s3.get_object(bucket, key)
+    except ClientError as error:
+        print(error.response)
+        return None
+    iterator = (row.decode('utf-8')
+                for row in streaming_body.iter_lines())
+    reader = csv.DictReader(iterator)
+    print(f"Found csv with headers: {reader.fieldnames}")
+    print(f"Extracting {fields}")
+    samples = [
+        [
+            sample.get(METADATA_TRANSLATIONS.get(field, field))
+            for field in fields
+        ]
+        for sample in reader
+    ]
+    return [
+        encode_column(normalise(field, [sample[i] for sample in samples],
+                                country_codes))
+        for i, field in enumerate(fields)
+    ]
+
+
+def get_annotations(annotation_location, annotation_index, variants):
     annotations = []
     covered_variants = set()
-    if annotation_location:
-        bucket, key = get_bucket_and_key(annotation_location)
-        streaming_body = s3.get_object(bucket, key)
-        iterator = (row.decode('utf-8') for row in streaming_body.iter_lines())
-        reader = csv.DictReader(iterator, delimiter='\t')
-        for row in reader:
-            if row['Variant'] in variants:
-                annotations.append({
-                    metadata: value
-                    for metadata, value in row.items()
-                    if (value not in {'.', ''}
-                        and metadata in EXTRA_ANNOTATION_FIELDS)
-                })
-                covered_variants.add(row['Variant'])
+    rows = None
+    if annotation_index:
+        rows = get_indexed_annotations(annotation_index, variants)
+    if rows is None and annotation_location:
+        rows = scan_annotations(annotation_location, variants)
+    for row in rows or []:
+        annotations.append({
+            metadata: value
+            for metadata, value in row.items()
+            if (value not in {'.', ''}
+                and metadata in EXTRA_ANNOTATION_FIELDS)
+        })
+        covered_variants.add(row['Variant'])
     annotations += [
         {
             'Variant': variant,
@@ -153,18 +717,242 @@ def get_bucket_and_key(s3_location):
     return bucket, key
 
 
-def perform_query(region, reference_bases, end_min, end_max, alternate_bases,
-                  variant_type, include_details, vcf_location, responses):
-    payload = json.dumps({
-        'region': region,
-        'reference_bases': reference_bases,
-        'end_min': end_min,
-        'end_max': end_max,
-        'alternate_bases': alternate_bases,
-        'variant_type': variant_type,
-        'include_details': include_details,
-        'vcf_location': vcf_location,
-    })
+def get_indexed_annotations(index_key, variants):
+    """
+    Reads the annotation rows of the variants from the position sorted
+    blocks submitDataset built, fetching only the blocks that could hold
+    them and keeping only the columns that are returned. Returns None if
+    the index can't be read, so the tsv can be scanned instead.
+    """
+    try:
+        index = annotation_index_cache.get(index_key)
+        if index is None:
+            index_body = s3.get_object(INDEX_BUCKET, index_key).read()
+            index = json.loads(index_body)
+            # Indexes are named by their contents, so never go out of date
+            annotation_index_cache.put(index_key, index, len(index_body))
+        positions = sorted({
+            int(variant_pattern.fullmatch(variant).group(1))
+            for variant in variants
+        })
+        blocks = index['blocks']
+        byte_ranges = get_block_ranges(blocks, positions,
+                                       ANNOTATION_RANGE_GAP)
+        if len(byte_ranges) > MAXIMUM_ANNOTATION_RANGES:
+            byte_ranges = [(
+                byte_ranges[0][0],
+                byte_ranges[-1][1],
+                [i for byte_range in byte_ranges for i in byte_range[2]],
+            )]
+        block_bodies = []
+        for start, end, block_indexes in byte_ranges:
+            body = s3.get_object(INDEX_BUCKET, index['blocksKey'],
+                                 (start, end)).read()
+            for i in block_indexes:
+                _, _, offset, length = blocks[i]
+                block_bodies.append(
+                    body[offset - start:offset - start + length])
+    except ClientError as error:
+        print(json.dumps(error.response, default=str))
+        print("Could not read the annotation index, scanning the tsv.")
+        return None
+    # csv.DictReader gives repeated columns the last value, but keeps the
+    # position of the first.
+    column_indexes = {}
+    for i, field in enumerate(index['fields']):
+        column_indexes[field] = i
+    columns = [
+        (field, i) for field, i in column_indexes.items()
+        if field in EXTRA_ANNOTATION_FIELDS
+    ]
+    variant_index = index['variantIndex']
+    rows = []
+    for body in block_bodies:
+        for row_number, row in read_block(body):
+            if row[variant_index] in variants:
+                rows.append((row_number, {
+                    field: row[i] if i < len(row) else None
+                    for field, i in columns
+                }))
+    print(f"Read {len(rows)} annotations from {len(block_bodies)} of"
+          f" {len(blocks)} blocks in {len(byte_ranges)} requests")
+    rows.sort(key=itemgetter(0))
+    return [row for _, row in rows]
+
+
+def get_batches(vcf_locations, index_etags, region_start, region_end):
+    records_per_batch = TARGET_SPLIT_RECORDS * max(
+        1, int(TARGET_INVOCATION_SECONDS / ESTIMATED_SPLIT_SECONDS))
+    batches = []
+    all_densities = get_densities(vcf_locations, region_start, region_end)
+    for vcf_location, chrom in vcf_locations.items():
+        densities = all_densities[vcf_location]
+        if densities is None:
+            splits = get_fixed_splits(region_start, region_end)
+        else:
+            splits = plan_splits(densities, region_start, region_end,
+                                 TARGET_SPLIT_RECORDS)
+        # Keep splits of a vcf together so they can be scanned in one pass
+        batch = []
+        batch_records = 0
+        for split_start, split_end, records in splits:
+            batch.append({
+                'vcf_location': vcf_location,
+                'region': '{}:{}-{}'.format(chrom, split_start, split_end),
+                'vcf_etag': index_etags.get(vcf_location),
+            })
+            batch_records += records
+            if batch_records >= records_per_batch:
+                batches.append(batch)
+                batch = []
+                batch_records = 0
+        if batch:
+            batches.append(batch)
+    return batches
+
+
+def count_dates(codes, values, date_codes, dates):
+    """
+    Counts the samples with each pair of values and dates, grouped by value
+    in the order values first appear, then sorted by date.
+    """
+    pair_counts = np.bincount(
+        codes * len(dates) + date_codes,
+        minlength=len(values) * len(dates),
+    ).reshape(len(values), len(dates))
+    date_order = sorted(range(len(dates)), key=lambda i: dates[i])
+    date_counts = defaultdict(list)
+    for value, counts in zip(values, pair_counts):
+        for date_i in date_order:
+            if counts[date_i]:
+                date_counts[value].append({dates[date_i]: int(counts[date_i])})
+    return date_counts
+
+
+def count_values(codes, values):
+    """
+    Returns each value with its number of samples, in the order the values
+    first appear.
+    """
+    counts = np.bincount(codes, minlength=len(values))
+    return [
+        (value, int(count))
+        for value, count in zip(values, counts)
+        if count
+    ]
+
+
+def get_vcf_locations(dataset, empty_vcfs):
+    return {
+        vcf_location: chrom
+        for vcf_location, chrom in dataset['vcf_locations'].items()
+        if vcf_location not in empty_vcfs
+    }
+
+
+def get_densities(vcf_locations, region_start, region_end):
+    """
+    Returns the record densities of the summarised slices of each vcf's
+    chromosome that overlap the region, or None for a vcf if they don't
+    cover all of it. Densities are kept between invocations by their eTag,
+    and the rest are read concurrently.
+    """
+    all_slices = {}
+    with FanOut('Record density lists', DENSITY_CONCURRENCY) as fan_out:
+        for vcf_location, chrom in vcf_locations.items():
+            fan_out.submit(partial(list_densities, vcf_location, chrom,
+                                   region_start, region_end),
+                           error_result=(vcf_location, None))
+        for vcf_location, slices in fan_out.results():
+            all_slices[vcf_location] = slices
+    densities = {}
+    to_load = set()
+    for slices in all_slices.values():
+        for key, etag in slices or ():
+            density = density_cache.get(key, etag)
+            if density is None:
+                to_load.add((key, etag))
+            else:
+                densities[key] = density
+    if to_load:
+        with FanOut('Record densities', DENSITY_CONCURRENCY) as fan_out:
+            for key, etag in to_load:
+                fan_out.submit(partial(load_density, key, etag),
+                               error_result=(key, None))
+            for key, density in fan_out.results():
+                if density is not None:
+                    densities[key] = density
+    all_densities = {}
+    for vcf_location, slices in all_slices.items():
+        if slices is None or any(key not in densities for key, _ in slices):
+            all_densities[vcf_location] = None
+        else:
+            all_densities[vcf_location] = [densities[key]
+                                           for key, _ in slices]
+    return all_densities
+
+
+def list_densities(vcf_location, chrom, region_start, region_end):
+    """
+    Returns the key and eTag of the record densities of the summarised
+    slices overlapping the region, in order, or None if they don't cover
+    all of it.
+    """
+    if not vcf_location.startswith('s3://'):
+        return vcf_location, None
+    kwargs = {
+        'Bucket': INDEX_BUCKET,
+        'Prefix': get_density_prefix(vcf_location, chrom),
+    }
+    slices = []
+    continuation_token = True
+    while continuation_token:
+        print(f"Calling s3.list_objects_v2 with kwargs {json.dumps(kwargs)}")
+        response = s3.client.list_objects_v2(**kwargs)
+        contents = response.get('Contents', [])
+        print(f"Received {len(contents)} record density keys")
+        for obj in contents:
+            start, end = parse_density_key(obj['Key'])
+            if start <= region_end and end >= region_start:
+                slices.append((start, end, obj['Key'], obj['ETag']))
+        continuation_token = response.get('NextContinuationToken')
+        kwargs['ContinuationToken'] = continuation_token
+    slices.sort()
+    covered_to = region_start - 1
+    for start, end, _, _ in slices:
+        if start > covered_to + 1:
+            break
+        covered_to = max(covered_to, end)
+    if covered_to < region_end:
+        print(f"Record densities don't cover {chrom}:{region_start}-"
+              f"{region_end} in {vcf_location}, using fixed splits")
+        return vcf_location, None
+    return vcf_location, [(key, etag) for _, _, key, etag in slices]
+
+
+def load_density(key, etag):
+    body = s3.get_object(INDEX_BUCKET, key).read()
+    density = json.loads(body)
+    density_cache.put(key, density, len(body), etag)
+    return key, density
+
+
+def get_fixed_splits(region_start, region_end):
+    splits = []
+    split_start = region_start
+    while split_start <= region_end:
+        split_end = min(split_start + SPLIT_SIZE - 1, region_end)
+        splits.append((split_start, split_end, TARGET_SPLIT_RECORDS))
+        split_start += SPLIT_SIZE
+    return splits
+
+
+def invoke_perform_query(event, num_results):
+    """
+    Invokes performQuery, returning its results with their samples
+    decoded.
+    """
+    payload = json.dumps(dict(event, sample_encoding=SAMPLE_ENCODING))
     print("Invoking {lambda_name} with payload: {payload}".format(
         lambda_name=PERFORM_QUERY, payload=payload))
     response = aws_lambda.invoke(
@@ -172,13 +960,70 @@ def perform_query(region, reference_bases, end_min, end_max, alternate_bases,
         Payload=payload,
     )
     response_json = response['Payload'].read()
-    print("vcf_location='{vcf}', region='{region}':"
-          " received payload: {payload}".format(
-              vcf=vcf_location, region=region, payload=response_json))
+    print("{num} work items: received payload: {payload}".format(
+        num=len(event['work_items']), payload=response_json))
     response_dict = json.loads(response_json)
-    # For separating samples by vcf
-    response_dict['vcf_location'] = vcf_location
-    responses.put(response_dict)
+    if response_dict.get('cancelled'):
+        results = [{'cancelled': True} for _ in range(num_results)]
+    else:
+        # If the function errored out, there will be no results
+        results = response_dict.get('results') or [{} for _ in
+                                                   range(num_results)]
+    varint_encoded = (response_dict.get('sample_encoding')
+                      == VARINT_ENCODING)
+    for result in results:
+        if varint_encoded and 'variant_samples' in result:
+            result['variant_samples'] = decode_variant_samples(
+                result['variant_samples'])
+    if 'spilled_samples' in response_dict:
+        add_spilled_samples(response_dict['spilled_samples'], results)
+    return results
+
+
+def perform_queries(work_items, queries, cancellation):
+    """
+    Runs a batch of splits in a performQuery invocation that evaluates
+    several allele queries in one pass, returning a list of each query's
+    results for each split.
+    """
+    if not cancellation.should_dispatch():
+        return [[{'cancelled': True} for _ in queries] for _ in work_items]
+    results = invoke_perform_query({
+        'work_items': work_items,
+        'queries': queries,
+        'cancel_keys': cancellation.child_keys,
+    }, len(work_items) * len(queries))
+    split_results = []
+    for i, work_item in enumerate(work_items):
+        item_results = results[i * len(queries):(i + 1) * len(queries)]
+        for result in item_results:
+            result['vcf_location'] = work_item['vcf_location']
+        split_results.append(item_results)
+    return split_results
+
+
+def perform_group(work_items, query_indexes, queries, cancellation):
+    return query_indexes, perform_queries(work_items, queries, cancellation)
+
+
+def number_page_samples(variants, sample_details):
+    """
+    Returns the variants of a page with their samples numbered by their
+    place in the page's own sample details, along with those details. A
+    page only holds the details of its own variants' samples. sample_details
+    gives the details of each sample by its number in the full response.
+    """
+    samples = sorted(set(itertools.chain.from_iterable(
+        variant['samples'] for variant in variants)))
+    numbers = {sample: number for number, sample in enumerate(samples)}
+    return (
+        [
+            dict(variant, samples=[numbers[sample]
+                                   for sample in variant['samples']])
+            for variant in variants
+        ],
+        [sample_details[sample] for sample in samples],
+    )
 
 
 def process_page(response, page_details):
@@ -191,320 +1036,707 @@ def process_page(response, page_details):
         page_size = num_variants
     page = page_details['page']
     print(f"Sorting by {sortby}, {'descending' if desc else 'ascending'}")
-    variants.sort(key=itemgetter(sortby), reverse=desc)
+    variants = sorted(variants, key=itemgetter(sortby), reverse=desc)
     skip = (page-1) * page_size
     final_index = page * page_size
     print(f"Restricting {num_variants} annotations to the range"
           f" [{skip}:{final_index}]")
-    response['info'].update({
-        'variants': variants[skip:final_index],
-        'pages': math.ceil(num_variants / page_size),
-    })
+    # The full response may be cached, so is left untouched
+    info = dict(
+        response['info'],
+        variants=variants[skip:final_index],
+        pages=math.ceil(num_variants / page_size),
+    )
+    if 'sampleDetails' in info:
+        info['variants'], info['sampleDetails'] = number_page_samples(
+            info['variants'], info['sampleDetails'])
+    return dict(response, info=info)
+
+
+def project_sample_fields(response, sample_fields):
+    info = response['info']
+    stored_fields = info.get('sampleFields') or []
+    if sample_fields == stored_fields:
+        return response
+    info = {
+        key: value
+        for key, value in info.items()
+        if set(sample_fields) >= SAMPLE_FIELD_COUNTS.get(key, set())
+    }
+    if sample_fields:
+        field_indexes = [stored_fields.index(field) for field in sample_fields]
+        info['sampleFields'] = sample_fields
+        info['sampleDetails'] = [
+            [sample[i] for i in field_indexes]
+            for sample in info['sampleDetails']
+        ]
+    else:
+        del info['sampleFields']
+        del info['sampleDetails']
+        info['variants'] = [
+            {
+                key: value
+                for key, value in variant.items()
+                if key != 'samples'
+            }
+            for variant in info['variants']
+        ]
+    return dict(response, info=info)
 
 
 def process_samples(variants, fields):
     vcf_offsets = {}
-    all_sample_details = []
-    included_samples = set()
+    # For each field, the codes of each vcf's samples and the code of
+    # each value, in the order the values first appear
+    field_codes = [[] for _ in fields]
+    field_values = [{} for _ in fields]
+    sample_count = 0
     uncompressed_variants = {}
 
     for variant, location_samples in variants.items():
-        variant_samples = set()
+        variant_samples = []
         for vcf_location, sample_indexes in location_samples.items():
             if vcf_location not in vcf_offsets:
-                bucket, key = get_bucket_and_key(vcf_location)
-                key = f'{key.split(".")[0]}.csv'
-                try:
-                    streaming_body = s3.get_object(bucket, key)
-                except ClientError as error:
-                    print(error.response)
+                columns = get_sample_columns(vcf_location, fields)
+                if columns is None:
                     # Could not access sample metadata, skip
                     offset = -1
                 else:
-                    offset = len(all_sample_details)
-                    iterator = (row.decode('utf-8')
-                                for row in streaming_body.iter_lines())
-                    reader = csv.DictReader(iterator)
-                    print(f"Found csv with headers: {reader.fieldnames}")
-                    print(f"Extracting {fields}")
-                    all_sample_details += [
-                        [
-                            sample.get(METADATA_TRANSLATIONS.get(field, field))
-                            for field in fields
-                        ]
-                        for sample in reader
-                    ]
+                    offset = sample_count
+                    for (codes, values), all_codes, value_codes in zip(
+                            columns, field_codes, field_values):
+                        new_codes = np.array([
+                            value_codes.setdefault(value, len(value_codes))
+                            for value in values
+                        ], dtype=np.int64)
+                        all_codes.append(new_codes[codes])
+                    sample_count += len(columns[0][0])
                 vcf_offsets.update({vcf_location: offset})
             else:
                 offset = vcf_offsets[vcf_location]
             if offset == -1:  # Couldn't access this metadata
                 continue
-            variant_samples.update(
-                s_i + offset
-                for s_i in sample_indexes
-            )
-        uncompressed_variants[variant] = variant_samples
-        included_samples |= variant_samples
+            variant_samples.append(np.asarray(sample_indexes,
+                                              dtype=np.int64) + offset)
+        uncompressed_variants[variant] = (
+            np.unique(np.concatenate(variant_samples)) if variant_samples
+            else np.empty(0, dtype=np.int64))
 
+    field_codes = [
+        np.concatenate(all_codes) if all_codes else np.empty(0, dtype=np.int64)
+        for all_codes in field_codes
+    ]
+    field_values = [list(value_codes) for value_codes in field_values]
     extra_fields = {}
 
     for field_i, field in enumerate(fields):
         if field == 'Location':
-            # Convert to Country only
-            for sample in all_sample_details:
-                location = sample[field_i]
-                if location and isinstance(location, str):
-                    # Clean data of known errors
-                    country = location.split('/')[0].strip(' \u200e').lower()
-                    sample[field_i] = country_codes[country]
-                else:
-                    sample[field_i] = None
-            location_counts_dict = Counter(
-                sample[field_i]
-                for sample in all_sample_details
-            )
             extra_fields['locationCounts'] = [
                 {
                     location: count,
                 }
-                for location, count in location_counts_dict.items()
+                for location, count in count_values(field_codes[field_i],
+                                                    field_values[field_i])
             ]
         elif field == 'SampleCollectionDate':
-            # Convert to months only
-            for sample in all_sample_details:
-                date = sample[field_i]
-                if date and isinstance(date, str) and len(date) >= 7:
-                    sample[field_i] = date[:7]
-                else:
-                    sample[field_i] = "Date Missing"
-            date_counts_dict = Counter(
-                sample[field_i]
-                for sample in all_sample_details
-            )
             extra_fields['dateCounts'] = sorted(
                 [
                     {
                         date: count,
                     }
-                    for date, count in date_counts_dict.items()
+                    for date, count in count_values(field_codes[field_i],
+                                                    field_values[field_i])
                 ],
                 key=lambda x: list(x.keys())[0]
             )
         elif field == 'State':
-            # Convert to Country / State only
-            for sample in all_sample_details:
-                location = sample[field_i]
-                if location and isinstance(location, str):
-                    sample[field_i] = '/'.join(location.split('/')[0:2]).strip(' \u200e').lower()
-                else:
-                    sample[field_i] = None
-            state_counts_dict = Counter(
-                sample[field_i]
-                for sample in all_sample_details
-            )
             extra_fields['stateCounts'] = [
                 {
                     state: count,
                 }
-                for state, count in state_counts_dict.items()
+                for state, count in count_values(field_codes[field_i],
+                                                 field_values[field_i])
             ]
 
     if {'SampleCollectionDate', 'Location'} <= set(fields):
         location_i = fields.index('Location')
         date_i = fields.index('SampleCollectionDate')
-        location_date_counts_dict = Counter(
-            (sample[location_i], sample[date_i])
-            for sample in all_sample_details
-        )
-        location_date_counts = defaultdict(list)
-        for (loc, date), count in location_date_counts_dict.items():
-            location_date_counts[loc].append({date: count})
-        for date_counts in location_date_counts.values():
-            date_counts.sort(key=lambda x: list(x.keys())[0])
-        extra_fields['locationDateCounts'] = location_date_counts
+        extra_fields['locationDateCounts'] = count_dates(
+            field_codes[location_i], field_values[location_i],
+            field_codes[date_i], field_values[date_i])
 
     if {'SampleCollectionDate', 'State'} <= set(fields):
         state_i = fields.index('State')
         date_i = fields.index('SampleCollectionDate')
-        state_date_counts_dict = Counter(
-            (sample[state_i], sample[date_i])
-            for sample in all_sample_details
-        )
-        state_date_counts = defaultdict(list)
-        for (state, date), count in state_date_counts_dict.items():
-            state_date_counts[state].append({date: count})
-        for date_counts in state_date_counts.values():
-            date_counts.sort(key=lambda x: list(x.keys())[0])
-        extra_fields['stateDateCounts'] = state_date_counts
-
-    compression_mapping = []
-    offset = 0
-    for i in range(len(all_sample_details)):
-        if i in included_samples:
-            new_index = i - offset
-        else:
-            new_index = -1
-            offset += 1
-        compression_mapping.append(new_index)
+        extra_fields['stateDateCounts'] = count_dates(
+            field_codes[state_i], field_values[state_i],
+            field_codes[date_i], field_values[date_i])
+
+    included = np.zeros(sample_count, dtype=bool)
+    for sample_indexes in uncompressed_variants.values():
+        included[sample_indexes] = True
+    compression_mapping = np.where(included, np.cumsum(included) - 1, -1)
 
     compressed_variants = {
-        variant: [
-            compression_mapping[s_i]
-            for s_i in sample_indexes
-        ]
+        variant: compression_mapping[sample_indexes].tolist()
         for variant, sample_indexes in uncompressed_variants.items()
     }
+    included_indexes = np.flatnonzero(included)
     sample_details = [
-        sample
-        for index, sample in enumerate(all_sample_details)
-        if compression_mapping[index] != -1
+        list(sample)
+        for sample in zip(*(
+            np.array(values, dtype=object)[codes[included_indexes]].tolist()
+            for codes, values in zip(field_codes, field_values)
+        ))
     ]
     return sample_details, compressed_variants, extra_fields
 
 
-def run_queries(dataset, query_details):
-    responses = queue.Queue()
-    region_start = query_details['region_start']
-    region_end = query_details['region_end']
-    end_min = query_details['end_min']
-    end_max = query_details['end_max']
-    reference_bases = query_details['reference_bases']
-    alternate_bases = query_details['alternate_bases']
-    variant_type = query_details['variant_type']
-    include_datasets = query_details['include_datasets']
-    sample_fields = query_details['sample_fields']
-    check_all = include_datasets in ('HIT', 'ALL')
-    kwargs = {
-        'reference_bases': reference_bases,
-        'end_min': end_min,
-        'end_max': end_max,
-        'alternate_bases': alternate_bases,
-        'variant_type': variant_type,
+def run_batch_queries(dataset, all_query_details, cancellation,
+                      all_empty_vcfs):
+    """
+    Queries the dataset's vcfs for several allele queries, scanning queries
+    with nearby regions together in a single pass, and leaving out the vcfs
+    that have no records any query of the group could match. Returns a
+    stored result for each query, or None if the queries are cancelled
+    before the results are complete.
+    """
+    queries = []
+    for query_details in all_query_details:
+        queries.append({
+            detail: query_details[detail]
+            for detail in ('reference_bases', 'end_min', 'end_max',
+                           'alternate_bases', 'variant_type',
+                           'region_start', 'region_end')
+        })
         # Don't bother recording details from MISS, they'll all be 0s
-        'include_details': check_all,
-        'responses': responses,
+        queries[-1]['include_details'] = (query_details['include_datasets']
+                                          in ('HIT', 'ALL'))
+    fan_out = FanOut('performQuery', PERFORM_QUERY_CONCURRENCY)
+    num_splits = 0
+    for group_start, group_end, query_indexes in group_queries(queries):
+        group = [queries[i] for i in query_indexes]
+        empty_vcfs = set.intersection(*(all_empty_vcfs[i]
+                                        for i in query_indexes))
+        for batch in get_batches(get_vcf_locations(dataset, empty_vcfs),
+                                 dataset['index_etags'], group_start,
+                                 group_end):
+            num_splits += len(batch)
+            fan_out.submit(
+                partial(perform_group, batch, query_indexes, group,
+                        cancellation),
+                error_result=(query_indexes,
+                              [[{} for _ in query_indexes] for _ in batch]))
+    processed = 0
+    all_totals = [new_totals() for _ in queries]
+    with fan_out:
+        for query_indexes, results in fan_out.results(
+                stop=cancellation.is_cancelled):
+            for split_results in results:
+                processed += 1
+                for i, response in zip(query_indexes, split_results):
+                    if response.get('cancelled'):
+                        return None
+                    add_to_totals(all_totals[i], response,
+                                  queries[i]['include_details'])
+            if all(totals['exists'] and not query['include_details']
+                   for totals, query in zip(all_totals, queries)):
+                break
+    if processed < num_splits:
+        if cancellation.is_cancelled():
+            return None
+        cancellation.cancel_children()
+    return [
+        get_stored_result(dataset, query_details, totals)
+        for query_details, totals in zip(all_query_details, all_totals)
+    ]
+
+
+def new_totals():
+    return {
+        'all_alleles_count': 0,
+        'call_count': 0,
+        'exists': False,
+        'variant_call_counts': Counter(),
+        # The sorted array of samples with each variant in each vcf
+        'variants': defaultdict(dict),
     }
-    threads = []
-    split_start = region_start
-    vcf_locations = dataset['vcf_locations']
-    while split_start <= region_end:
-        split_end = min(split_start + SPLIT_SIZE - 1, region_end)
-        for vcf_location, chrom in vcf_locations.items():
-            kwargs['region'] = '{}:{}-{}'.format(chrom, split_start,
-                                                 split_end)
-            kwargs['vcf_location'] = vcf_location
-            t = threading.Thread(target=perform_query,
-                                 kwargs=kwargs)
-            t.start()
-            threads.append(t)
-        split_start += SPLIT_SIZE
 
-    num_threads = len(threads)
-    processed = 0
-    all_alleles_count = 0
-    variants = defaultdict(lambda: defaultdict(set))
-    call_count = 0
-    vcf_samples = defaultdict(set)
-    exists = False
-    while processed < num_threads and (check_all or not exists):
-        response = responses.get()
-        processed += 1
-        if 'exists' not in response:
-            # function errored out, ignore
-            continue
-        exists_in_split = response['exists']
-        if exists_in_split:
-            exists = True
-            if check_all:
-                all_alleles_count += response['all_alleles_count']
-                call_count += response['call_count']
-                vcf_location = response['vcf_location']
-                for variant, samples in response['variant_samples'].items():
-                    variants[variant][vcf_location].update(samples)
-                    vcf_samples[vcf_location].update(samples)
-    dataset_sample_count = dataset['sample_count']
-    if (include_datasets == 'ALL' or (include_datasets == 'HIT' and exists)
-            or (include_datasets == 'MISS' and not exists)):
-        annotations = get_annotations(dataset['annotation_location'], variants.keys())
-        variant_pattern = re.compile('([0-9]+)(.+)>(.+)')
-        variant_codes = []
-        for annotation in annotations:
-            variant_code = annotation.pop('Variant')
-            variant_codes.append(variant_code)
-            pos, ref, alt = variant_pattern.fullmatch(variant_code).groups()
-            variant_sample_count = sum(
-                len(s) for s in variants[variant_code].values()
-            )
-            annotation.update({
-                'pos': int(pos),
-                'ref': ref,
-                'alt': alt,
-                'sampleCount': variant_sample_count,
-                'frequency': get_frequency(variant_sample_count, dataset_sample_count),
+
+def add_to_totals(totals, response, check_all):
+    if 'exists' not in response:
+        # function errored out, ignore
+        return
+    if response['exists']:
+        totals['exists'] = True
+        if check_all:
+            totals['all_alleles_count'] += response['all_alleles_count']
+            totals['call_count'] += response['call_count']
+            totals['variant_call_counts'].update(
+                response['variant_call_counts'])
+            vcf_location = response['vcf_location']
+            for variant, samples in response['variant_samples'].items():
+                # Lists when performQuery sent them as json
+                samples = np.asarray(samples, dtype=np.int64)
+                location_samples = totals['variants'][variant]
+                if vcf_location in location_samples:
+                    samples = np.union1d(location_samples[vcf_location],
+                                         samples)
+                else:
+                    samples = np.unique(samples)
+                location_samples[vcf_location] = samples
+
+
+def get_stored_result(dataset, query_details, totals):
+    check_all = query_details['include_datasets'] in ('HIT', 'ALL')
+    return {
+        'response': build_response(dataset, query_details, totals['exists'],
+                                   totals['call_count'], totals['variants']),
+        'details': (get_details(totals['variants'],
+                                totals['variant_call_counts'])
+                    if check_all else None),
+    }
+
+
+def group_queries(queries):
+    """
+    Groups queries whose regions are within BATCH_REGION_GAP of each other,
+    returning the region covering each group and the indexes of its
+    queries.
+    """
+    groups = []
+    for i in sorted(range(len(queries)),
+                    key=lambda i: queries[i]['region_start']):
+        region_start = queries[i]['region_start']
+        region_end = queries[i]['region_end']
+        if groups and region_start <= groups[-1][1] + BATCH_REGION_GAP:
+            groups[-1][1] = max(groups[-1][1], region_end)
+            groups[-1][2].append(i)
+        else:
+            groups.append([region_start, region_end, [i]])
+    return [tuple(group) for group in groups]
+
+
+def index_cached_pages(dataset_id, query_args, dataset_version,
+                       page_details):
+    """
+    Stores a sorted copy of a cached response for paging, if it is stored
+    in S3 and doesn't already have one.
+    """
+    item = get_cache_item(dataset_id, query_args, dataset_version,
+                          page_details)
+    if (item is None or 'queryLocation' not in item
+            or get_page_attribute(page_details) in item):
+        print("Cache entry doesn't need indexing")
+        return
+    stored = read_stored(dataset_id, query_args, dataset_version, item)
+    if stored is not None:
+        index_pages(dataset_id, query_args, dataset_version,
+                    stored['response'], page_details)
+
+
+def index_pages(dataset_id, query_args, dataset_version, response,
+                page_details):
+    """
+    Stores a copy of a response with its variants sorted for paging, in
+    compressed chunks after the compressed rest of the response, and
+    records where each chunk starts in the response's cache item. Each
+    chunk holds the details of its own variants' samples, so reading a
+    page doesn't mean reading the details of every sample.
+    """
+    info = response['info']
+    variants = sorted(info['variants'],
+                      key=itemgetter(page_details['sortby']),
+                      reverse=page_details['desc'])
+    head_info = dict(info, variants=[])
+    if 'sampleDetails' in info:
+        head_info['sampleDetails'] = []
+    sections = [dict(response, info=head_info)]
+    for chunk_start in range(0, len(variants), PAGE_CHUNK_SIZE):
+        chunk_variants = variants[chunk_start:chunk_start+PAGE_CHUNK_SIZE]
+        chunk = {
+            'variants': chunk_variants,
+        }
+        if 'sampleDetails' in info:
+            samples = sorted(set(itertools.chain.from_iterable(
+                variant['samples'] for variant in chunk_variants)))
+            chunk.update({
+                'samples': samples,
+                'sampleDetails': [info['sampleDetails'][sample]
+                                  for sample in samples],
             })
-        sample_count = sum(len(samples)
-                           for samples in vcf_samples.values())
-        response_dict = {
-            'include': True,
-            'datasetId': dataset['dataset_id'],
-            'exists': exists,
-            # Note not allelic frequency, only sample frequency
-            'frequency': get_frequency(sample_count, dataset_sample_count),
-            'variantCount': len(variants),
-            'callCount': call_count,
-            'sampleCount': sample_count,
-            'note': None,
-            'externalUrl': None,
-            'info': {
-                'description': dataset['description'],
-                'name': dataset['name'],
-                'datasetSampleCount': dataset_sample_count,
-                'variants': annotations,
-                'totalEntries': len(annotations),
+        sections.append(chunk)
+    sections = [
+        gzip.compress(json.dumps(section).encode(),
+                      compresslevel=CACHE_COMPRESS_LEVEL)
+        for section in sections
+    ]
+    offsets = list(itertools.accumulate(len(section)
+                                        for section in sections))
+    encoded_offsets = encode_samples(offsets)
+    if len(encoded_offsets) > MAXIMUM_PAGE_INDEX_SIZE:
+        print(f"Too many annotations to index ({len(variants)})")
+        return
+    body = b''.join(sections)
+    digest = hashlib.sha256(body).hexdigest()
+    key = f'{dataset_id}/{query_args}.{digest}.pages'
+    s3.put_object(CACHE_BUCKET, key, body)
+    kwargs = {
+        'TableName': CACHE_TABLE,
+        'Key': {
+            'datasetId': {
+                'S': dataset_id
             },
-            'error': None,
+            'queryArgs': {
+                'S': query_args,
+            },
+        },
+        'UpdateExpression': 'SET #page=:page',
+        'ExpressionAttributeNames': {
+            '#page': get_page_attribute(page_details),
+        },
+        'ExpressionAttributeValues': {
+            ':page': {
+                'M': {
+                    'location': {
+                        'S': key,
+                    },
+                    'offsets': {
+                        'S': encoded_offsets,
+                    },
+                    'chunkSize': {
+                        'N': str(PAGE_CHUNK_SIZE),
+                    },
+                    'variantCount': {
+                        'N': str(len(variants)),
+                    },
+                },
+            },
+            ':datasetVersion': {
+                'S': dataset_version,
+            },
+        },
+        # Don't bring back an entry that has since been replaced or flushed
+        'ConditionExpression': ('attribute_exists(queryLocation)'
+                                ' AND datasetVersion = :datasetVersion'),
+    }
+    print(f"Calling dynamodb.update_item with kwargs {json.dumps(kwargs)}")
+    try:
+        dynamodb_response = dynamodb.update_item(**kwargs)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            print("Cache entry is no longer stored in S3, not indexing.")
+            return
+        else:
+            raise e
+    print(f"Received response {json.dumps(dynamodb_response, default=str)}")
+
+
+def put_cache_item(item):
+    kwargs = {
+        'TableName': CACHE_TABLE,
+        'Item': item,
+    }
+    print("Calling dynamodb.put_item with kwargs"
+          f" {json.dumps(kwargs, default=describe_bytes)}")
+    dynamodb_response = dynamodb.put_item(**kwargs)
+    response_string = json.dumps(dynamodb_response, default=str)
+    print(f"Received response {response_string}")
+
+
+def read_stored(dataset_id, query_args, dataset_version, item):
+    response_body = get_cached(item)
+    if response_body is None:
+        return None
+    stored = json.loads(response_body)
+    if 'response' not in stored:
+        # Stored before results kept their details
+        stored = {
+            'response': stored,
+            'details': None,
         }
-        if sample_fields:
-            (sample_details, compressed_variants,
-             extra_fields) = process_samples(variants, sample_fields)
-            response_dict['info'].update({
-                'sampleFields': sample_fields,
-                'sampleDetails': sample_details,
-            })
-            response_dict['info'].update(extra_fields)
-            for code, variant in zip(variant_codes,
-                                     response_dict['info']['variants']):
-                variant['samples'] = compressed_variants[code]
-    else:
-        response_dict = {
+    response_cache.put((dataset_id, query_args), stored, len(response_body),
+                       dataset_version)
+    return stored
+
+
+def request_page_index(dataset_id, query_args, dataset_version,
+                       page_details):
+    """
+    Has another invocation of this function store a sorted copy of a
+    cached response, rather than holding up this response while it does.
+    """
+    payload = json.dumps({
+        'index_pages': {
+            'dataset_id': dataset_id,
+            'query_args': query_args,
+            'dataset_version': dataset_version,
+            'page_details': page_details,
+        },
+    })
+    function_name = os.environ['AWS_LAMBDA_FUNCTION_NAME']
+    print(f"Invoking {function_name} asynchronously with payload: {payload}")
+    response = aws_lambda.invoke(
+        FunctionName=function_name,
+        InvocationType='Event',
+        Payload=payload,
+    )
+    print(f"Received status code {response['StatusCode']}")
+
+
+def remove_column_file(column):
+    try:
+        os.remove(column[0].filename)
+    except FileNotFoundError:
+        # Concurrent queries loaded the same column, and the other copy
+        # has already been removed
+        pass
+
+
+def reuse_response(response, include_datasets, sample_fields):
+    """
+    Answers a query from the stored response to the same allele query,
+    which may have been made with different includeDatasetResponses or
+    sampleFields. Returns None if it can't be answered.
+    """
+    exists = response['exists']
+    include = (include_datasets == 'ALL'
+               or (include_datasets == 'HIT' and exists)
+               or (include_datasets == 'MISS' and not exists))
+    if not include:
+        return {
             'include': False,
             'exists': exists,
         }
-    return response_dict
+    # A MISS response that is included has no hits, so has all the details
+    # a HIT or ALL response would.
+    if not response['include']:
+        return None
+    stored_fields = response['info'].get('sampleFields') or []
+    if not set(sample_fields) <= set(stored_fields):
+        return None
+    return project_sample_fields(response, sample_fields)
 
 
-def split_query(dataset, query_details, page_details):
+def scan_annotations(annotation_location, variants):
+    bucket, key = get_bucket_and_key(annotation_location)
+    streaming_body = s3.get_object(bucket, key)
+    iterator = (row.decode('utf-8') for row in streaming_body.iter_lines())
+    reader = csv.DictReader(iterator, delimiter='\t')
+    return [row for row in reader if row['Variant'] in variants]
+
+
+def complete_query(dataset, query_details, page_details, plan):
+    """
+    Finishes answering a query planned by plan_query, once any stored
+    result it needed has been added under 'stored'.
+    """
+    if 'page' in plan:
+        return plan['page']
     dataset_id = dataset['dataset_id']
-    query_args = '&'.join(str(arg) for arg in query_details.values())
-    response = get_cached(dataset_id, query_args)
+    query_args = plan['query_args']
+    stored = plan['stored']
+    item = plan['item']
+    response = plan.get('response')
     if response is None:
-        response = run_queries(dataset, query_details)
-        cache_response(response, dataset_id, query_args)
+        response_body, item = cache_response(stored, dataset_id, query_args,
+                                             query_details,
+                                             plan['dataset_version'])
+        response_cache.put((dataset_id, query_args), stored,
+                           len(response_body), plan['dataset_version'])
+        response = reuse_response(stored['response'],
+                                  query_details['include_datasets'],
+                                  query_details['sample_fields'] or [])
     if response['include']:
-        process_page(response, page_details)
+        response = process_page(response, page_details)
+        # Entries in S3 are large enough that reading just one page of a
+        # sorted copy is quicker than loading the whole entry.
+        if (item is not None and 'queryLocation' in item
+                and get_page_attribute(page_details) not in item
+                and response['info']['pages'] > 1):
+            request_page_index(dataset_id, query_args,
+                               plan['dataset_version'], page_details)
     return response
 
 
+def plan_query(dataset, query_details, page_details):
+    """
+    Works out how much of a query the cache can answer. Returns a dict
+    holding the finished response under 'page', the stored result to
+    answer it from under 'stored', or the query details to query the vcfs
+    with under 'run_details'.
+    """
+    dataset_id = dataset['dataset_id']
+    include_datasets = query_details['include_datasets']
+    sample_fields = query_details['sample_fields'] or []
+    query_args = get_query_key(query_details)
+    dataset_version = get_dataset_version(dataset)
+    stored = response_cache.get((dataset_id, query_args), dataset_version)
+    item = None
+    if stored is None:
+        item = get_cache_item(dataset_id, query_args, dataset_version,
+                              page_details)
+        if item is not None:
+            page_index = item.get(get_page_attribute(page_details))
+            if page_index is not None:
+                response = get_indexed_page(page_index, include_datasets,
+                                            sample_fields, page_details)
+                if response is not None:
+                    return {
+                        'page': response,
+                    }
+            stored = read_stored(dataset_id, query_args, dataset_version,
+                                 item)
+    plan = {
+        'dataset_version': dataset_version,
+        'item': item,
+        'query_args': query_args,
+    }
+    if stored is not None:
+        response = reuse_response(stored['response'], include_datasets,
+                                  sample_fields)
+        if response is not None:
+            return dict(plan, response=response, stored=stored)
+    else:
+        covering_args = get_covering_query(dataset_id, query_details)
+        if covering_args is not None:
+            stored = get_stored(dataset_id, covering_args, dataset_version)
+        if stored is not None and stored['details'] is None:
+            stored = None
+    if stored is not None and stored['response']['include']:
+        # Keep the fields already stored so the new response can still
+        # answer the queries the old one could.
+        sample_fields_to_get = sample_fields + [
+            field
+            for field in stored['response']['info'].get('sampleFields', [])
+            if field not in sample_fields
+        ]
+    else:
+        sample_fields_to_get = sample_fields
+    new_query_details = dict(query_details,
+                             sample_fields=sample_fields_to_get or None)
+    if stored is not None and stored['details'] is not None:
+        # Everything needed is in a detailed result of this region or one
+        # containing it, so there's no need to query the vcfs again.
+        stored = get_subregion(dataset, dict(new_query_details,
+                                             include_datasets='ALL'),
+                               stored['details'])
+        return dict(plan, stored=stored)
+    return dict(plan, run_details=new_query_details)
+
+
+def split_queries(dataset, queries, cancellation):
+    """
+    Answers a batch of queries of the dataset, each a dict of its query
+    details, page details and the vcfs queryDatasets found it can't match
+    in. Queries the cache can't answer are run against the vcfs together.
+    """
+    with FanOut('Cache lookup', BATCH_CACHE_CONCURRENCY) as fan_out:
+        for i, query in enumerate(queries):
+            fan_out.submit(partial(plan_batch_query, dataset, query, i),
+                           error_result=(i, None))
+        plans = dict(fan_out.results())
+    runs = {}
+    for i, plan in plans.items():
+        if plan is not None and 'run_details' in plan:
+            run_key = json.dumps(plan['run_details'], sort_keys=True)
+            empty_vcfs = set(queries[i].get('empty_vcfs', []))
+            if run_key in runs:
+                runs[run_key][1].append(i)
+                runs[run_key][2].intersection_update(empty_vcfs)
+            else:
+                runs[run_key] = (plan['run_details'], [i], empty_vcfs)
+    print(f"{len(queries) - sum(len(run[1]) for run in runs.values())}"
+          f" of {len(queries)} queries answered from the cache,"
+          f" {len(runs)} to run")
+    if runs:
+        all_stored = run_batch_queries(
+            dataset, [run_details for run_details, _, _ in runs.values()],
+            cancellation,
+            [empty_vcfs for _, _, empty_vcfs in runs.values()])
+        if all_stored is None:
+            return None
+        for (_, indexes, _), stored in zip(runs.values(), all_stored):
+            for i in indexes:
+                plans[i]['stored'] = stored
+    with FanOut('Cache write', BATCH_CACHE_CONCURRENCY) as fan_out:
+        for i, query in enumerate(queries):
+            # Queries that couldn't be planned are left to fail like a
+            # query that errored out
+            if plans[i] is not None:
+                fan_out.submit(partial(complete_batch_query, dataset, query,
+                                       plans[i], i),
+                               error_result=(i, {}))
+        responses = dict(fan_out.results())
+    return [responses.get(i, {}) for i in range(len(queries))]
+
+
+def complete_batch_query(dataset, query, plan, i):
+    return i, complete_query(dataset, query['query_details'],
+                             query['page_details'], plan)
+
+
+def plan_batch_query(dataset, query, i):
+    return i, plan_query(dataset, query['query_details'],
+                         query['page_details'])
+
+
+def split_query(dataset, query_details, page_details, cancellation,
+                empty_vcfs=()):
+    plan = plan_query(dataset, query_details, page_details)
+    if 'run_details' in plan:
+        all_stored = run_batch_queries(dataset, [plan['run_details']],
+                                       cancellation, [set(empty_vcfs)])
+        if all_stored is None:
+            # Nothing is waiting for the answer, and it's incomplete so
+            # mustn't be cached.
+            return {
+                'cancelled': True,
+            }
+        plan['stored'] = all_stored[0]
+    return complete_query(dataset, query_details, page_details, plan)
+
+
 def lambda_handler(event, context):
     print('Event Received: {}'.format(json.dumps(event)))
+    if 'index_pages' in event:
+        index_cached_pages(**event['index_pages'])
+        return {}
     dataset = event['dataset']
-    query_details = event['query_details']
-    page_details = event['page_details']
-    response = split_query(
-        dataset=dataset,
-        query_details=query_details,
-        page_details=page_details,
-    )
+    all_query_details = [query['query_details']
+                         for query in event.get('queries', [])]
+    if 'query_details' in event:
+        all_query_details.append(event['query_details'])
+    # Splits are only left unfinished when no query records details, so
+    # otherwise performQuery has no marker of this invocation to watch for.
+    if any(query_details['include_datasets'] in ('HIT', 'ALL')
+           for query_details in all_query_details):
+        cancel_key = None
+    else:
+        cancel_key = get_cancel_key(context.function_name,
+                                    context.aws_request_id)
+    cancellation = Cancellation(RESPONSE_BUCKET, cancel_key,
+                                event.get('cancel_keys', []))
+    with cancellation:
+        if 'queries' in event:
+            responses = split_queries(dataset, event['queries'],
+                                      cancellation)
+            if responses is None:
+                response = {
+                    'cancelled': True,
+                }
+            else:
+                response = {
+                    'responses': responses,
+                }
+        else:
+            response = split_query(
+                dataset=dataset,
+                query_details=event['query_details'],
+                page_details=event['page_details'],
+                cancellation=cancellation,
+                empty_vcfs=event.get('empty_vcfs', []),
+            )
     response = check_size(response, context)
     print('Returning response: {}'.format(json.dumps(response)))
     return response
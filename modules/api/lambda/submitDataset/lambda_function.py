@@ -5,8 +5,10 @@ import re
 import subprocess
 
 import boto3
+from botocore.exceptions import ClientError
 
 from api_response import bad_request, bundle_response, missing_parameter
+from dataset_catalog import bump_catalog_version
 
 DATASETS_TABLE_NAME = os.environ['DATASETS_TABLE']
 FLUSH_CACHE_SNS_TOPIC_ARN = os.environ['FLUSH_CACHE_SNS_TOPIC_ARN']
@@ -15,9 +17,26 @@ SUMMARISE_DATASET_SNS_TOPIC_ARN = os.environ['SUMMARISE_DATASET_SNS_TOPIC_ARN']
 os.environ['PATH'] += ':' + os.environ['LAMBDA_TASK_ROOT']
 
 dynamodb = boto3.client('dynamodb')
+s3 = boto3.client('s3')
 sns = boto3.client('sns')
 
 
+def check_annotation_location(annotation_location):
+    delimiter_index = annotation_location.find('/', 5)
+    kwargs = {
+        'Bucket': annotation_location[5:delimiter_index],
+        'Key': annotation_location[delimiter_index + 1:],
+    }
+    print(f"Calling s3.head_object with kwargs {json.dumps(kwargs)}")
+    try:
+        response = s3.head_object(**kwargs)
+    except ClientError as error:
+        print(json.dumps(error.response, default=str))
+        return f"Could not access {annotation_location}."
+    print(f"Received response {json.dumps(response, default=str)}")
+    return ''
+
+
 def check_vcf_locations(locations):
     errors = []
     for location in locations:
@@ -84,7 +103,6 @@ def create_dataset(attributes):
         item['annotationLocation'] = {
             'S': annotation_location,
         }
-
     description = attributes.get('description')
     if description:
         item['description'] = {
@@ -147,15 +165,20 @@ def submit_dataset(body_dict, method):
         errors = check_vcf_locations(body_dict['vcfLocations'])
         if errors:
             return bad_request(errors)
-        summarise = True
-    else:
-        summarise = False
+    annotation_location = body_dict.get('annotationLocation')
+    if annotation_location:
+        error = check_annotation_location(annotation_location)
+        if error:
+            return bad_request(error)
     if new:
         create_dataset(body_dict)
     else:
         update_dataset(body_dict)
+    bump_catalog_version()
     dataset_id = body_dict['id']
-    if summarise:
+    # The vcfs are summarised and the annotations indexed asynchronously,
+    # as either can take longer than API Gateway waits.
+    if 'vcfLocations' in body_dict or annotation_location:
         summarise_dataset(dataset_id)
     flush_cache(dataset_id)
     return bundle_response(200, {})
@@ -181,12 +204,16 @@ def update_dataset(attributes):
         }
     }
     expression_attribute_names = {}
+    update_remove_expressions = []
 
     if 'annotationLocation' in attributes:
         update_set_expressions.append('annotationLocation=:annotationLocation')
         expression_attribute_values[':annotationLocation'] = {
             'S': attributes['annotationLocation'],
         }
+        # Until summariseDataset has indexed the file as it is now,
+        # splitQuery scans it
+        update_remove_expressions.append('annotationIndex')
 
     if 'name' in attributes:
         update_set_expressions.append('#name=:name')
@@ -238,6 +265,9 @@ def update_dataset(attributes):
         }
 
     update_expression = 'SET {}'.format(', '.join(update_set_expressions))
+    if update_remove_expressions:
+        update_expression += ' REMOVE {}'.format(
+            ', '.join(update_remove_expressions))
     kwargs = {
         'TableName': DATASETS_TABLE_NAME,
         'Key': {
@@ -0,0 +1 @@
+../../shared_resources/annotation_index.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../shared_resources/dataset_catalog.py
\ No newline at end of file
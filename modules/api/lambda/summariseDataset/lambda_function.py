@@ -3,8 +3,13 @@ import json
 import os
 
 import boto3
+from botocore.exceptions import ClientError
+
+from annotation_index import build_index, get_annotation_prefix
+from dataset_catalog import bump_catalog_version
 
 DATASETS_TABLE_NAME = os.environ['DATASETS_TABLE']
+INDEX_BUCKET = os.environ['INDEX_BUCKET']
 SUMMARISE_VCF_SNS_TOPIC_ARN = os.environ['SUMMARISE_VCF_SNS_TOPIC_ARN']
 VCF_SUMMARIES_TABLE_NAME = os.environ['VCF_SUMMARIES_TABLE']
 
@@ -21,24 +26,47 @@ s3 = boto3.client('s3')
 sns = boto3.client('sns')
 
 
-def get_etag(vcf_location):
-    if not vcf_location.startswith('s3://'):
-        return vcf_location
-    delimiter_index = vcf_location.find('/', 5)
-    kwargs = {
-        'Bucket': vcf_location[5:delimiter_index],
-        'Key': vcf_location[delimiter_index + 1:],
+def delete_stale_annotations(annotation_location, annotation_index):
+    """
+    Removes the indexes of earlier versions of an annotation file, once
+    the dataset no longer points at them.
+    """
+    list_kwargs = {
+        'Bucket': INDEX_BUCKET,
+        'Prefix': get_annotation_prefix(annotation_location),
     }
-    print(f"Calling s3.head_object with kwargs: {json.dumps(kwargs)}")
-    response = s3.head_object(**kwargs)
-    print(f"Received response: {json.dumps(response, default=str)}")
-    return response['ETag'].strip('"')
+    current_prefix = (annotation_index.rsplit('/', 1)[0] + '/'
+                      if annotation_index else None)
+    continuation_token = True
+    while continuation_token:
+        print("Calling s3.list_objects_v2 with kwargs"
+              f" {json.dumps(list_kwargs)}")
+        response = s3.list_objects_v2(**list_kwargs)
+        print(f"Received response {json.dumps(response, default=str)}")
+        keys = [
+            obj['Key'] for obj in response.get('Contents', [])
+            if not (current_prefix and obj['Key'].startswith(current_prefix))
+        ]
+        if keys:
+            kwargs = {
+                'Bucket': INDEX_BUCKET,
+                'Delete': {
+                    'Objects': [{'Key': key} for key in keys],
+                },
+            }
+            print(f"Calling s3.delete_objects with kwargs {json.dumps(kwargs)}")
+            delete_response = s3.delete_objects(**kwargs)
+            print("Received response"
+                  f" {json.dumps(delete_response, default=str)}")
+        continuation_token = response.get('NextContinuationToken')
+        list_kwargs['ContinuationToken'] = continuation_token
 
 
-def get_locations(dataset):
+def get_dataset(dataset):
     kwargs = {
         'TableName': DATASETS_TABLE_NAME,
-        'ProjectionExpression': 'vcfLocations',
+        'ProjectionExpression': ('vcfLocations,annotationLocation,'
+                                 'annotationIndex'),
         'ConsistentRead': True,
         'KeyConditionExpression': 'id = :id',
         'ExpressionAttributeValues': {
@@ -50,7 +78,21 @@ def get_locations(dataset):
     print("Querying table: {}".format(json.dumps(kwargs)))
     response = dynamodb.query(**kwargs)
     print("Received response: {}".format(json.dumps(response)))
-    return response['Items'][0].get('vcfLocations', {}).get('SS', [])
+    return response['Items'][0]
+
+
+def get_etag(vcf_location):
+    if not vcf_location.startswith('s3://'):
+        return vcf_location
+    delimiter_index = vcf_location.find('/', 5)
+    kwargs = {
+        'Bucket': vcf_location[5:delimiter_index],
+        'Key': vcf_location[delimiter_index + 1:],
+    }
+    print(f"Calling s3.head_object with kwargs: {json.dumps(kwargs)}")
+    response = s3.head_object(**kwargs)
+    print(f"Received response: {json.dumps(response, default=str)}")
+    return response['ETag'].strip('"')
 
 
 def get_locations_info(locations):
@@ -90,8 +132,102 @@ def get_locations_info(locations):
     return items
 
 
+def index_annotations(annotation_location):
+    """
+    Saves the annotation file sorted by position in blocks, so splitQuery
+    can read the rows of a few variants without scanning the whole file.
+    Returns the key of the index, or None if the file has no Variant
+    column and splitQuery should keep scanning it. Raises ClientError if
+    the file can't be read.
+    """
+    delimiter_index = annotation_location.find('/', 5)
+    kwargs = {
+        'Bucket': annotation_location[5:delimiter_index],
+        'Key': annotation_location[delimiter_index + 1:],
+    }
+    print(f"Calling s3.get_object with kwargs {json.dumps(kwargs)}")
+    response = s3.get_object(**kwargs)
+    print(f"Received response {json.dumps(response, default=str)}")
+    built = build_index(
+        (row.decode('utf-8') for row in response['Body'].iter_lines()),
+        annotation_location)
+    if built is None:
+        print(f"{annotation_location} has no Variant column, not indexing.")
+        return None
+    index, index_key, blocks_body = built
+    print(f"Indexed {index['rowCount']} annotations in"
+          f" {len(index['blocks'])} blocks")
+    put_index_object(index['blocksKey'], blocks_body)
+    # Written last so the index never points at missing blocks
+    put_index_object(index_key, json.dumps(index).encode())
+    return index_key
+
+
+def index_dataset_annotations(dataset_id, annotation_location):
+    try:
+        annotation_index = index_annotations(annotation_location)
+    except ClientError as error:
+        print(json.dumps(error.response, default=str))
+        print(f"Could not index {annotation_location}.")
+        return
+    # An empty index records that the file has no Variant column, so it
+    # isn't read again each time the dataset is summarised
+    if set_annotation_index(dataset_id, annotation_location,
+                            annotation_index or ''):
+        delete_stale_annotations(annotation_location, annotation_index)
+
+
+def put_index_object(key, body):
+    kwargs = {
+        'Bucket': INDEX_BUCKET,
+        'Key': key,
+    }
+    print(f"Calling s3.put_object with kwargs {json.dumps(kwargs)}")
+    kwargs['Body'] = body
+    response = s3.put_object(**kwargs)
+    print(f"Received response {json.dumps(response, default=str)}")
+
+
+def set_annotation_index(dataset_id, annotation_location, annotation_index):
+    """
+    Points the dataset at the index of its annotations, unless it has been
+    given other annotations since. Returns whether it was updated.
+    """
+    kwargs = {
+        'TableName': DATASETS_TABLE_NAME,
+        'Key': {
+            'id': {
+                'S': dataset_id,
+            },
+        },
+        'UpdateExpression': 'SET annotationIndex=:annotationIndex',
+        'ConditionExpression': 'annotationLocation = :annotationLocation',
+        'ExpressionAttributeValues': {
+            ':annotationIndex': {
+                'S': annotation_index,
+            },
+            ':annotationLocation': {
+                'S': annotation_location,
+            },
+        },
+    }
+    print('Updating item: {}'.format(json.dumps(kwargs)))
+    try:
+        dynamodb.update_item(**kwargs)
+    except ClientError as error:
+        if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            print("Dataset has different annotations, not updating.")
+            return False
+        raise error
+    return True
+
+
 def summarise_dataset(dataset):
-    vcf_locations = get_locations(dataset)
+    item = get_dataset(dataset)
+    annotation_location = item.get('annotationLocation', {}).get('S')
+    if annotation_location and 'annotationIndex' not in item:
+        index_dataset_annotations(dataset, annotation_location)
+    vcf_locations = item.get('vcfLocations', {}).get('SS', [])
     locations_info = get_locations_info(vcf_locations)
     new_locations = set(vcf_locations)
     counts = Counter()
@@ -114,6 +250,7 @@ def summarise_dataset(dataset):
     else:
         values = {':'+count: {'NULL': True} for count in COUNTS}
     update_dataset(dataset, values)
+    bump_catalog_version()
     for new_location in new_locations:
         summarise_vcf(new_location)
 
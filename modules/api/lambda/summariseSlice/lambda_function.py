@@ -8,8 +8,15 @@ import time
 import boto3
 from botocore.exceptions import ClientError
 
+from genotype_index import GenotypeIndexWriter, get_index_key
+from presence_bitmap import PresenceBitmapWriter, get_presence_key
+from record_density import get_density, get_density_key
+from tabix_reader import (can_read, get_info_value, get_reader,
+                          split_query_record)
+
 ASSEMBLY_GSI = os.environ['ASSEMBLY_GSI']
 DATASETS_TABLE_NAME = os.environ['DATASETS_TABLE']
+INDEX_BUCKET = os.environ['INDEX_BUCKET']
 SUMMARISE_DATASET_SNS_TOPIC_ARN = os.environ['SUMMARISE_DATASET_SNS_TOPIC_ARN']
 SUMMARISE_SLICE_SNS_TOPIC_ARN = os.environ['SUMMARISE_SLICE_SNS_TOPIC_ARN']
 VCF_SUMMARIES_TABLE_NAME = os.environ['VCF_SUMMARIES_TABLE']
@@ -24,6 +31,7 @@ MAX_SECONDS_BETWEEN_SAMPLES = 10
 os.environ['PATH'] += ':' + os.environ['LAMBDA_TASK_ROOT']
 
 dynamodb = boto3.client('dynamodb')
+s3 = boto3.client('s3')
 sns = boto3.client('sns')
 
 all_count_pattern = re.compile('[0-9]+')
@@ -80,12 +88,17 @@ def get_affected_datasets(location):
 
 def get_calls_and_variants(location, chrom, start, end, time_assigned,
                            gvcf=False):
-
+    if can_read(location):
+        return get_reader_calls_and_variants(location, chrom, start, end,
+                                             time_assigned)
     counts_process = get_counts_process(location, chrom, start, end,
                                         gvcf=gvcf)
     counts_handle = counts_process.stdout
+    index_writer = GenotypeIndexWriter()
+    presence_writer = PresenceBitmapWriter(start, end)
     call_count, variant_count, slices = sum_counts(counts_handle, start, end,
-                                                   time_assigned, gvcf=gvcf)
+                                                   time_assigned, index_writer,
+                                                   presence_writer, gvcf=gvcf)
     counts_handle.close()
     error_code = counts_process.wait(timeout=1)
     if error_code != 0 and not slices:  # complains when pipe is closed
@@ -93,20 +106,30 @@ def get_calls_and_variants(location, chrom, start, end, time_assigned,
             # Process errored out, could be because INFO tags aren't defined.
             # This happens in the case of gVCFs, so try again using only GT.
             print("Got error when querying, trying gVCF mode...")
-            call_count, variant_count, slices = get_calls_and_variants(
-                location, chrom, start, end, time_assigned, gvcf=True)
+            return get_calls_and_variants(location, chrom, start, end,
+                                          time_assigned, gvcf=True)
         else:
             assert error_code == 0, ("query returned error code"
                                      " {}".format(error_code))
+    if call_count is not None:
+        upload_genotype_index(location, chrom, start, end, index_writer)
+        upload_record_density(location, chrom, start, end,
+                              index_writer.positions)
+        upload_presence_bitmap(location, chrom, start, end, presence_writer)
     return call_count, variant_count, slices
 
 
 def get_counts_process(location, chrom, start, end, gvcf=False):
+    # GT is also needed to build the genotype index, so is always requested
+    if gvcf:
+        query_format = '%POS\t%REF\t%ALT\t[%GT,]\n'
+    else:
+        query_format = '%POS\t%REF\t%ALT\t%INFO/AN\t%INFO/AC\t[%GT,]\n'
     args = [
         'bcftools', 'query',
         '--regions', '{chrom}:{start}-{end}'.format(
             chrom=chrom, start=start, end=end),
-        '--format', '%POS\t[%GT,]\n' if gvcf else '%POS\t%INFO/AN\t%INFO/AC\n',
+        '--format', query_format,
         location
     ]
     query_process = subprocess.Popen(args, stdout=subprocess.PIPE, cwd='/tmp',
@@ -114,6 +137,40 @@ def get_counts_process(location, chrom, start, end, gvcf=False):
     return query_process
 
 
+def get_reader_calls_and_variants(location, chrom, start, end,
+                                  time_assigned):
+    reader = get_reader(location)
+    # bcftools fails when these aren't defined, which is what triggers gVCF
+    # mode when querying through it.
+    gvcf = not reader.has_info('AN', 'AC')
+    counts_lines = get_reader_counts(reader, chrom, start, end, gvcf)
+    index_writer = GenotypeIndexWriter()
+    presence_writer = PresenceBitmapWriter(start, end)
+    call_count, variant_count, slices = sum_counts(counts_lines, start, end,
+                                                   time_assigned, index_writer,
+                                                   presence_writer, gvcf=gvcf)
+    if call_count is not None:
+        upload_genotype_index(location, chrom, start, end, index_writer)
+        upload_record_density(location, chrom, start, end,
+                              index_writer.positions)
+        upload_presence_bitmap(location, chrom, start, end, presence_writer)
+    return call_count, variant_count, slices
+
+
+def get_reader_counts(reader, chrom, start, end, gvcf):
+    # Produces the same lines as the query from get_counts_process
+    for line in reader.fetch(chrom, start, end):
+        pos, ref, alt, info, genotypes = split_query_record(line)
+        fields = [pos, ref, alt]
+        if not gvcf:
+            fields += [
+                get_info_value(info, b'AN') or b'.',
+                get_info_value(info, b'AC') or b'.',
+            ]
+        fields.append(genotypes)
+        yield b'\t'.join(fields).decode() + '\n'
+
+
 def get_slices_to_complete(time_assigned, start_time, start, end, current_pos):
     """
     Calculate the number of slices that will be required to complete the task
@@ -198,7 +255,8 @@ def summarise_datasets(datasets):
         print('Received Response: {}'.format(json.dumps(response)))
 
 
-def sum_counts(counts_handle, start, end, time_assigned, gvcf=False):
+def sum_counts(counts_handle, start, end, time_assigned, index_writer,
+               presence_writer, gvcf=False):
     call_count = 0
     variant_count = 0
     records = 0
@@ -228,26 +286,73 @@ def sum_counts(counts_handle, start, end, time_assigned, gvcf=False):
                     return None, None, slices
         records += 1
 
+        reference, all_alts = record_parts[1:3]
+        genotype_str = record_parts[-1]
+        presence_writer.add_record(pos, reference, all_alts)
         if gvcf:
-            genotype_str = record_parts[1]
             # As AN is often not present, simply manually count all the calls
             calls = get_all_calls(genotype_str)
             call_count += len(calls)
             # Add number of unique non-reference calls to variant count
             call_set = set(calls)
             variant_count += len(call_set) - (1 if '0' in call_set else 0)
+            index_writer.add_record(pos, reference, all_alts, genotype_str)
         else:
-            call_num_str, alt_allele_num_str = (record_parts[1],
-                                                record_parts[2].rstrip('\r\n'))
+            call_num_str, alt_allele_num_str = record_parts[3:5]
             # Add the AN value to the call count
             call_count += int(call_num_str)
             # Add the total number of alt alleles with nonzero counts to variant
             # count
-            variant_count += sum(1 for alt in alt_allele_num_str.split(',')
-                                 if int(alt))
+            alt_counts = [int(alt) for alt in alt_allele_num_str.split(',')]
+            variant_count += sum(1 for alt in alt_counts if alt)
+            index_writer.add_record(pos, reference, all_alts, genotype_str,
+                                    total_count=int(call_num_str),
+                                    call_counts=alt_counts)
     return call_count, variant_count, None
 
 
+def upload_genotype_index(location, chrom, start, end, index_writer):
+    if not location.startswith('s3://'):
+        print("Genotype indexes are only built for vcfs in S3, skipping.")
+        return
+    kwargs = {
+        'Bucket': INDEX_BUCKET,
+        'Key': get_index_key(location, chrom, start, end),
+    }
+    print(f"Calling s3.put_object with kwargs {json.dumps(kwargs)}")
+    kwargs['Body'] = index_writer.to_bytes()
+    response = s3.put_object(**kwargs)
+    print(f"Received response {json.dumps(response, default=str)}")
+
+
+def upload_record_density(location, chrom, start, end, positions):
+    if not location.startswith('s3://'):
+        print("Record densities are only built for vcfs in S3, skipping.")
+        return
+    kwargs = {
+        'Bucket': INDEX_BUCKET,
+        'Key': get_density_key(location, chrom, start, end),
+    }
+    print(f"Calling s3.put_object with kwargs {json.dumps(kwargs)}")
+    kwargs['Body'] = get_density(positions, start, end)
+    response = s3.put_object(**kwargs)
+    print(f"Received response {json.dumps(response, default=str)}")
+
+
+def upload_presence_bitmap(location, chrom, start, end, presence_writer):
+    if not location.startswith('s3://'):
+        print("Presence bitmaps are only built for vcfs in S3, skipping.")
+        return
+    kwargs = {
+        'Bucket': INDEX_BUCKET,
+        'Key': get_presence_key(location, chrom, start, end),
+    }
+    print(f"Calling s3.put_object with kwargs {json.dumps(kwargs)}")
+    kwargs['Body'] = presence_writer.to_bytes()
+    response = s3.put_object(**kwargs)
+    print(f"Received response {json.dumps(response, default=str)}")
+
+
 def summarise_slice(location, region, slice_size_mbp, time_assigned):
     chrom, start_str = region.split(':')
     start = round(1000000 * float(start_str) + 1)
@@ -0,0 +1 @@
+../../shared_resources/presence_bitmap.py
\ No newline at end of file
@@ -1,11 +1,22 @@
+import csv
+import io
 import json
 import os
 import subprocess
 
 import boto3
 from botocore.exceptions import ClientError
+import numpy as np
 
-from chrom_matching import CHROMOSOMES, get_vcf_chromosomes, get_matching_chromosome
+from chrom_matching import (CHROMOSOME_LENGTHS_MBP, CHROMOSOMES,
+                            get_contig_map, get_matching_chromosome,
+                            get_vcf_chromosomes)
+from genotype_index import get_index_prefix
+from presence_bitmap import get_presence_prefix
+from record_density import get_density_prefix
+from sample_metadata import (build_columns, get_build, get_column_keys,
+                             get_manifest_key, get_metadata_csv,
+                             get_metadata_prefix)
 
 COUNTS = [
     'variantCount',
@@ -15,6 +26,8 @@ COUNTS = [
 
 MAX_SLICE_SIZE_MBP = 20
 
+COUNTRY_CODES_PATH = os.environ['LAMBDA_TASK_ROOT'] + '/country_codes.json'
+INDEX_BUCKET = os.environ['INDEX_BUCKET']
 SUMMARISE_SLICE_SNS_TOPIC_ARN = os.environ['SUMMARISE_SLICE_SNS_TOPIC_ARN']
 VCF_SUMMARIES_TABLE_NAME = os.environ['VCF_SUMMARIES_TABLE']
 
@@ -24,6 +37,45 @@ dynamodb = boto3.client('dynamodb')
 s3 = boto3.client('s3')
 sns = boto3.client('sns')
 
+with open(COUNTRY_CODES_PATH) as country_codes_json:
+    country_codes = json.load(country_codes_json)
+
+
+def delete_indexes(location):
+    if not location.startswith('s3://'):
+        return
+    for prefix in (get_index_prefix(location), get_density_prefix(location),
+                   get_presence_prefix(location),
+                   get_metadata_prefix(location)):
+        delete_prefix(prefix)
+
+
+def delete_prefix(prefix):
+    list_kwargs = {
+        'Bucket': INDEX_BUCKET,
+        'Prefix': prefix,
+    }
+    continuation_token = True
+    while continuation_token:
+        print("Calling s3.list_objects_v2 with kwargs"
+              f" {json.dumps(list_kwargs)}")
+        response = s3.list_objects_v2(**list_kwargs)
+        print(f"Received response {json.dumps(response, default=str)}")
+        keys = [obj['Key'] for obj in response.get('Contents', [])]
+        if keys:
+            kwargs = {
+                'Bucket': INDEX_BUCKET,
+                'Delete': {
+                    'Objects': [{'Key': key} for key in keys],
+                },
+            }
+            print(f"Calling s3.delete_objects with kwargs {json.dumps(kwargs)}")
+            delete_response = s3.delete_objects(**kwargs)
+            print("Received response"
+                  f" {json.dumps(delete_response, default=str)}")
+        continuation_token = response.get('NextContinuationToken')
+        list_kwargs['ContinuationToken'] = continuation_token
+
 
 def get_etag(vcf_location):
     if not vcf_location.startswith('s3://'):
@@ -57,8 +109,7 @@ def get_sample_count(location):
     raise ValueError("Incorrectly formatted file")
 
 
-def get_translated_regions(location):
-    vcf_chromosomes = get_vcf_chromosomes(location)
+def get_translated_regions(vcf_chromosomes):
     regions = []
     for target_chromosome in CHROMOSOMES:
         chromosome = get_matching_chromosome(vcf_chromosomes, target_chromosome)
@@ -66,7 +117,11 @@ def get_translated_regions(location):
             continue
         start = 0
         length, _ = vcf_chromosomes[chromosome]
-        length_mbp = length / 1000000
+        if length is None:
+            # Not in the header, so go by the reference's length
+            length_mbp = CHROMOSOME_LENGTHS_MBP[target_chromosome]
+        else:
+            length_mbp = length / 1000000
         while start < length_mbp:
             mbp_left = (length_mbp - start)
             region_size = min(MAX_SLICE_SIZE_MBP, mbp_left)
@@ -78,7 +133,7 @@ def get_translated_regions(location):
     return regions
 
 
-def mark_updating(location, vcf_regions, etag):
+def mark_updating(location, vcf_regions, etag, contig_map):
     kwargs = {
         'TableName': VCF_SUMMARIES_TABLE_NAME,
         'Key': {
@@ -86,7 +141,8 @@ def mark_updating(location, vcf_regions, etag):
                 'S': location,
             },
         },
-        'UpdateExpression': 'SET toUpdate=:toUpdate, eTag=:eTag'
+        'UpdateExpression': 'SET toUpdate=:toUpdate, eTag=:eTag,'
+                            ' contigs=:contigs'
                             ' REMOVE ' + ', '.join(COUNTS),
         'ExpressionAttributeValues': {
             ':toUpdate': {
@@ -95,6 +151,10 @@ def mark_updating(location, vcf_regions, etag):
             ':eTag': {
                 'S': etag,
             },
+            # Saves queryDatasets running bcftools to find the contigs
+            ':contigs': {
+                'S': json.dumps(contig_map, separators=(',', ':')),
+            },
         },
         'ConditionExpression': 'attribute_not_exists(toUpdate)',
     }
@@ -125,17 +185,76 @@ def publish_slice_updates(location, vcf_regions):
         print('Received Response: {}'.format(json.dumps(response)))
 
 
+def put_index_object(key, body):
+    kwargs = {
+        'Bucket': INDEX_BUCKET,
+        'Key': key,
+    }
+    print(f"Calling s3.put_object with kwargs {json.dumps(kwargs)}")
+    kwargs['Body'] = body
+    response = s3.put_object(**kwargs)
+    print(f"Received response {json.dumps(response, default=str)}")
+
+
 def summarise_vcf(location):
-    vcf_regions = get_translated_regions(location)
+    vcf_chromosomes = get_vcf_chromosomes(location)
+    vcf_regions = get_translated_regions(vcf_chromosomes)
     etag = get_etag(location)
-    start_update = mark_updating(location, vcf_regions, etag)
+    start_update = mark_updating(location, vcf_regions, etag,
+                                 get_contig_map(vcf_chromosomes))
     if not start_update:
         return
+    # Stale genotype indexes, record densities and presence bitmaps would
+    # give wrong answers, so remove them before the slices start writing new
+    # ones.
+    delete_indexes(location)
     sample_count = get_sample_count(location)
     update_sample_count(location, sample_count)
+    upload_sample_metadata(location)
     publish_slice_updates(location, vcf_regions)
 
 
+def upload_sample_metadata(location):
+    """
+    Saves the vcf's sample metadata as columns that splitQuery can load
+    without parsing and cleaning up the whole csv on every query.
+    """
+    if not location.startswith('s3://'):
+        print("Sample metadata is only built for vcfs in S3, skipping.")
+        return
+    bucket, key = get_metadata_csv(location)
+    kwargs = {
+        'Bucket': bucket,
+        'Key': key,
+    }
+    print(f"Calling s3.get_object with kwargs {json.dumps(kwargs)}")
+    try:
+        response = s3.get_object(**kwargs)
+    except ClientError as error:
+        print(json.dumps(error.response, default=str))
+        print("No sample metadata to build.")
+        return
+    print(f"Received response {json.dumps(response, default=str)}")
+    reader = csv.reader(row.decode('utf-8')
+                        for row in response['Body'].iter_lines())
+    fieldnames = next(reader, [])
+    rows = [row for row in reader if row]
+    columns = build_columns(fieldnames, rows, country_codes)
+    build = get_build(columns)
+    for field, (codes, values) in columns.items():
+        codes_key, values_key = get_column_keys(location, build, field)
+        codes_buffer = io.BytesIO()
+        np.save(codes_buffer, codes)
+        put_index_object(codes_key, codes_buffer.getvalue())
+        put_index_object(values_key, json.dumps(values).encode())
+    # Written last so queries never see a partly uploaded build
+    put_index_object(get_manifest_key(location), json.dumps({
+        'build': build,
+        'sampleCount': len(rows),
+        'fields': sorted(columns),
+    }).encode())
+
+
 def update_sample_count(location, sample_count):
     kwargs = {
         'TableName': VCF_SUMMARIES_TABLE_NAME,
@@ -0,0 +1 @@
+../../shared_resources/record_density.py
\ No newline at end of file
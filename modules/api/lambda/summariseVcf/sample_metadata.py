@@ -0,0 +1 @@
+../../shared_resources/sample_metadata.py
\ No newline at end of file
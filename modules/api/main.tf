@@ -11,11 +11,11 @@ module lambda-submitDataset {
   source = "../lambda"
 
   function_name = "submitDataset"
-  description = "Creates or updates a dataset and triggers summariseVcf."
+  description = "Creates or updates a dataset and triggers summariseDataset."
   handler = "lambda_function.lambda_handler"
   runtime = "python3.6"
   memory_size = 2048
-  timeout = 5
+  timeout = 28
   policy = {
     json = data.aws_iam_policy_document.lambda-submitDataset.json
   }
@@ -24,6 +24,7 @@ module lambda-submitDataset {
 
   environment = {
     variables = {
+      CATALOG_VERSION_TABLE = aws_dynamodb_table.catalog_version.name
       DATASETS_TABLE = aws_dynamodb_table.datasets.name
       FLUSH_CACHE_SNS_TOPIC_ARN = aws_sns_topic.flushCache.arn
       SUMMARISE_DATASET_SNS_TOPIC_ARN = aws_sns_topic.summariseDataset.arn
@@ -38,11 +39,11 @@ module "lambda-summariseDataset" {
   source = "../lambda"
 
   function_name = "summariseDataset"
-  description = "Calculates summary counts for a dataset."
+  description = "Indexes a dataset's annotations and calculates its summary counts."
   handler = "lambda_function.lambda_handler"
   runtime = "python3.6"
   memory_size = 2048
-  timeout = 10
+  timeout = 300
   policy = {
     json = data.aws_iam_policy_document.lambda-summariseDataset.json
   }
@@ -51,7 +52,9 @@ module "lambda-summariseDataset" {
 
   environment = {
     variables = {
+      CATALOG_VERSION_TABLE = aws_dynamodb_table.catalog_version.name
       DATASETS_TABLE = aws_dynamodb_table.datasets.name
+      INDEX_BUCKET = aws_s3_bucket.indexes.bucket
       SUMMARISE_VCF_SNS_TOPIC_ARN = aws_sns_topic.summariseVcf.arn
       VCF_SUMMARIES_TABLE = aws_dynamodb_table.vcf_summaries.name
     }
@@ -78,7 +81,9 @@ module "lambda-summariseVcf" {
 
   environment = {
     variables = {
+      INDEX_BUCKET = aws_s3_bucket.indexes.bucket
       SUMMARISE_SLICE_SNS_TOPIC_ARN = aws_sns_topic.summariseSlice.arn
+      VCF_READER = var.vcf-reader
       VCF_SUMMARIES_TABLE = aws_dynamodb_table.vcf_summaries.name
     }
   }
@@ -106,8 +111,10 @@ module "lambda-summariseSlice" {
     variables = {
       ASSEMBLY_GSI = [for gsi in aws_dynamodb_table.datasets.global_secondary_index : gsi.name][0]
       DATASETS_TABLE = aws_dynamodb_table.datasets.name
+      INDEX_BUCKET = aws_s3_bucket.indexes.bucket
       SUMMARISE_DATASET_SNS_TOPIC_ARN = aws_sns_topic.summariseDataset.arn
       SUMMARISE_SLICE_SNS_TOPIC_ARN = aws_sns_topic.summariseSlice.arn
+      VCF_READER = var.vcf-reader
       VCF_SUMMARIES_TABLE = aws_dynamodb_table.vcf_summaries.name
     }
   }
@@ -190,9 +197,13 @@ module "lambda-queryDatasets" {
   environment = {
     variables = {
       BEACON_ID = var.beacon-id
+      CATALOG_VERSION_TABLE = aws_dynamodb_table.catalog_version.name
       DATASETS_TABLE = aws_dynamodb_table.datasets.name
+      INDEX_BUCKET = aws_s3_bucket.indexes.bucket
       RESPONSE_BUCKET = aws_s3_bucket.large_response_bucket.bucket
       SPLIT_QUERY_LAMBDA = module.lambda-splitQuery.function_name
+      VCF_READER = var.vcf-reader
+      VCF_SUMMARIES_TABLE = aws_dynamodb_table.vcf_summaries.name
     }
   }
 }
@@ -219,8 +230,10 @@ module "lambda-splitQuery" {
     variables = {
       CACHE_BUCKET = aws_s3_bucket.cache.bucket
       CACHE_TABLE = aws_dynamodb_table.cache.name
+      INDEX_BUCKET = aws_s3_bucket.indexes.bucket
       PERFORM_QUERY_LAMBDA = module.lambda-performQuery.function_name
       RESPONSE_BUCKET = aws_s3_bucket.large_response_bucket.bucket
+      SAMPLE_ENCODING = var.sample-encoding
       SPLIT_SIZE = 300
     }
   }
@@ -243,4 +256,12 @@ module "lambda-performQuery" {
   }
   source_path = "${path.module}/lambda/performQuery"
   tags = var.common-tags
+
+  environment = {
+    variables = {
+      INDEX_BUCKET = aws_s3_bucket.indexes.bucket
+      RESPONSE_BUCKET = aws_s3_bucket.large_response_bucket.bucket
+      VCF_READER = var.vcf-reader
+    }
+  }
 }
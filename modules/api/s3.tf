@@ -4,6 +4,12 @@ resource aws_s3_bucket cache {
   tags = var.common-tags
 }
 
+resource aws_s3_bucket indexes {
+  bucket_prefix = "beacon-indexes"
+  force_destroy = true
+  tags = var.common-tags
+}
+
 resource aws_s3_bucket large_response_bucket {
   bucket_prefix = "beacon-large-responses"
   force_destroy = true
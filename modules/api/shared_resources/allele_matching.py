@@ -0,0 +1,216 @@
+import re
+
+
+IUPAC_AMBIGUITY_CODES = {
+    'A': {
+        'A',
+    },
+    'C': {
+        'C',
+    },
+    'G': {
+        'G',
+    },
+    'T': {
+        'T',
+    },
+    'U': {
+        'T',
+    },
+    'M': {
+        'A',
+        'C',
+    },
+    'R': {
+        'A',
+        'G',
+    },
+    'W': {
+        'A',
+        'T'
+    },
+    'S': {
+        'C',
+        'G',
+    },
+    'Y': {
+        'C',
+        'T',
+    },
+    'K': {
+        'T',
+        'G',
+    },
+    'V': {
+        'A',
+        'C',
+        'G',
+    },
+    'H': {
+        'A',
+        'C',
+        'T',
+    },
+    'D': {
+        'T',
+        'A',
+        'G',
+    },
+    'B': {
+        'T',
+        'C',
+        'G',
+    },
+    'N': {
+        'T',
+        'A',
+        'C',
+        'G',
+    },
+}
+
+BASE_MASKS = {
+    'A': 1,
+    'C': 2,
+    'G': 4,
+    'T': 8,
+}
+
+IUPAC_MASKS = {
+    code: sum(BASE_MASKS[base] for base in bases)
+    for code, bases in IUPAC_AMBIGUITY_CODES.items()
+}
+
+IUPAC_MATCHES = {
+    code1: {
+        code2 for code2, mask2 in IUPAC_MASKS.items()
+        if mask1 & mask2
+    } for code1, mask1 in IUPAC_MASKS.items()
+}
+
+regular_alt = re.compile(f'[{"".join(IUPAC_AMBIGUITY_CODES.keys())}]+')
+
+
+def truncate_ref_alt(ref, alt):
+    if regular_alt.fullmatch(alt):
+        # Just a sequence of IUPAC characters
+        suffix_len = 0
+        max_suffix = 1 - min(len(ref), len(alt))
+        while (suffix_len > max_suffix
+               and ref[suffix_len-1] == alt[suffix_len-1]):
+            suffix_len -= 1
+        if suffix_len:
+            return ref[:suffix_len], alt[:suffix_len]
+    return ref, alt
+
+
+def compile_code_matcher(code):
+    """
+    Returns a function testing whether a sequence could be the same as code,
+    with each position matching if their IUPAC masks share a base. This is
+    linear in the length of the sequence, rather than enumerating every
+    sequence that could match.
+    """
+    if code is None:
+        code = ''
+    pattern = re.compile(''.join(
+        '[{}]'.format(''.join(sorted(IUPAC_MATCHES[base])))
+        for base in code
+    ))
+
+    def matches(sequence):
+        return pattern.fullmatch(sequence.upper()) is not None
+
+    return matches
+
+
+def is_repeat(sequence, unit, min_repeats):
+    # Equivalent to re.fullmatch('(unit){min_repeats,}', sequence)
+    if not unit:
+        return not sequence
+    repeats, remainder = divmod(len(sequence), len(unit))
+    return (not remainder and repeats >= min_repeats
+            and sequence == unit * repeats)
+
+
+def get_hit_finder(reference_bases, end_min, end_max, alternate_bases,
+                   variant_type):
+    v_prefix = '<{}'.format(variant_type)
+    approx = reference_bases == 'N' and variant_type
+    reference_matches = compile_code_matcher(reference_bases)
+    alternate_matches = compile_code_matcher(alternate_bases)
+
+    def find_hits(pos, reference, all_alts):
+        ref_alts = [
+            truncate_ref_alt(reference, alt)
+            for alt in all_alts.split(',')
+        ]
+        hit_indexes = {
+            i for i, (ref, _) in enumerate(ref_alts)
+            if (end_min <= pos + len(ref) - 1 <= end_max
+                and approx or reference_matches(ref)
+                )
+        }
+        if not hit_indexes:
+            return ref_alts, hit_indexes
+
+        if alternate_bases is None:
+            if variant_type == 'DEL':
+                hit_indexes &= {
+                    i for i, (ref, alt) in enumerate(ref_alts)
+                    if (i in hit_indexes and (
+                        (alt.startswith(v_prefix)
+                         or alt == '<CN0>')
+                        if alt.startswith('<')
+                        else len(alt) < len(ref)))
+                }
+            elif variant_type == 'INS':
+                hit_indexes &= {
+                    i for i, (ref, alt) in enumerate(ref_alts)
+                    if (alt.startswith(v_prefix)
+                        if alt.startswith('<')
+                        else len(alt) > len(ref))
+                }
+            # The calculation of these gets shaky as we don't have the
+            # bases before ref, so these will only work in trivial cases
+            elif variant_type == 'DUP':
+                hit_indexes &= {
+                    i for i, (ref, alt) in enumerate(ref_alts)
+                    if ((alt.startswith(v_prefix)
+                         or (alt.startswith('<CN')
+                             and alt not in ('<CN0>', '<CN1>')))
+                        if alt.startswith('<')
+                        else is_repeat(alt, ref, 2))
+                }
+            elif variant_type == 'DUP:TANDEM':
+                hit_indexes &= {
+                    i for i, (ref, alt) in enumerate(ref_alts)
+                    if ((alt.startswith(v_prefix)
+                         or alt == '<CN2>')
+                        if alt.startswith('<')
+                        else alt == ref+ref)
+                }
+            elif variant_type == 'CNV':
+                hit_indexes &= {
+                    i for i, (ref, alt) in enumerate(ref_alts)
+                    if ((alt.startswith(v_prefix)
+                         or alt.startswith('<CN')
+                         or alt.startswith('<DEL')
+                         or alt.startswith('<DUP'))
+                        if alt.startswith('<')
+                        else alt == '.' or is_repeat(alt, ref, 0))
+                }
+            else:
+                # For structural variants that aren't otherwise recognisable
+                hit_indexes &= {
+                    i for i, (_, alt) in enumerate(ref_alts)
+                    if alt.startswith(v_prefix)
+                }
+        else:
+            hit_indexes &= {
+                i for i, (_, alt) in enumerate(ref_alts)
+                if alternate_matches(alt)
+            }
+        return ref_alts, hit_indexes
+
+    return find_hits
@@ -0,0 +1,123 @@
+import bisect
+import csv
+import gzip
+import hashlib
+import io
+import json
+import re
+
+
+# Uncompressed size at which a block of annotation rows is closed. Smaller
+# blocks mean less is read and parsed for each variant, but more ranges to
+# fetch when the variants are spread out.
+BLOCK_SIZE = 32 * 2**10
+KEY_FIELD = 'Variant'
+
+variant_pattern = re.compile('([0-9]+)(.+)>(.+)')
+
+
+def get_annotation_prefix(annotation_location):
+    return f'{annotation_location[5:]}/annotations/'
+
+
+def get_annotation_keys(annotation_location, build):
+    prefix = f'{get_annotation_prefix(annotation_location)}{build}/'
+    return f'{prefix}index.json', f'{prefix}blocks'
+
+
+def compress_block(text):
+    buffer = io.BytesIO()
+    # A fixed mtime keeps the output the same for the same rows
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as block_file:
+        block_file.write(text.encode())
+    return buffer.getvalue()
+
+
+def build_index(lines, annotation_location):
+    """
+    Converts the lines of an annotation tsv into blocks of rows sorted by
+    position, each compressed separately so it can be fetched with a range
+    request. Rows are stored with their row number so lookups can return
+    them in the tsv's order. Returns the index, its key and the blocks,
+    or None if the tsv has no Variant column.
+    """
+    reader = csv.reader(lines, delimiter='\t')
+    fieldnames = next(reader, [])
+    if KEY_FIELD not in fieldnames:
+        return None
+    # csv.DictReader keeps the last of any repeated column
+    variant_index = len(fieldnames) - 1 - fieldnames[::-1].index(KEY_FIELD)
+    rows = []
+    for row_number, row in enumerate(row for row in reader if row):
+        if variant_index >= len(row):
+            continue
+        match = variant_pattern.fullmatch(row[variant_index])
+        # Anything else can't match a queried variant
+        if match is not None:
+            rows.append((int(match.group(1)), row_number, row))
+    rows.sort(key=lambda row: row[:2])
+    build_hash = hashlib.sha256(json.dumps(fieldnames).encode())
+    blocks = []
+    block_bodies = []
+    offset = 0
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter='\t', lineterminator='\n')
+    first_pos = None
+    for i, (pos, row_number, row) in enumerate(rows):
+        if first_pos is None:
+            first_pos = pos
+        writer.writerow([row_number] + row)
+        if buffer.tell() >= BLOCK_SIZE or i == len(rows) - 1:
+            text = buffer.getvalue()
+            build_hash.update(text.encode())
+            body = compress_block(text)
+            blocks.append([first_pos, pos, offset, len(body)])
+            block_bodies.append(body)
+            offset += len(body)
+            buffer.seek(0)
+            buffer.truncate()
+            first_pos = None
+    index_key, blocks_key = get_annotation_keys(
+        annotation_location, build_hash.hexdigest()[:16])
+    index = {
+        'fields': fieldnames,
+        'variantIndex': variant_index,
+        'rowCount': len(rows),
+        'blocksKey': blocks_key,
+        'blocks': blocks,
+    }
+    return index, index_key, b''.join(block_bodies)
+
+
+def get_block_ranges(blocks, positions, max_gap):
+    """
+    Returns the byte ranges of the blocks that could hold any of the
+    positions, with blocks less than max_gap bytes apart read together,
+    as (start, end, block indexes) tuples in order.
+    """
+    last_positions = [block[1] for block in blocks]
+    block_indexes = set()
+    for pos in positions:
+        i = bisect.bisect_left(last_positions, pos)
+        # A position's rows can continue into following blocks
+        while i < len(blocks) and blocks[i][0] <= pos:
+            block_indexes.add(i)
+            i += 1
+    ranges = []
+    for i in sorted(block_indexes):
+        _, _, offset, length = blocks[i]
+        if ranges and offset - ranges[-1][1] <= max_gap:
+            ranges[-1][1] = offset + length
+            ranges[-1][2].append(i)
+        else:
+            ranges.append([offset, offset + length, [i]])
+    return [tuple(byte_range) for byte_range in ranges]
+
+
+def read_block(body):
+    """
+    Yields the row number and row of each annotation in a compressed block.
+    """
+    text = gzip.decompress(body).decode()
+    for row in csv.reader(io.StringIO(text), delimiter='\t'):
+        yield int(row[0]), row[1:]
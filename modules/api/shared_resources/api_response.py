@@ -16,10 +16,14 @@ def bad_request(data, extra_params=None):
 
 
 def bundle_response(status_code, body):
+    return bundle_serialised_response(status_code, json.dumps(body))
+
+
+def bundle_serialised_response(status_code, body):
     return {
         'statusCode': status_code,
         'headers': HEADERS,
-        'body': json.dumps(body),
+        'body': body,
     }
 
 
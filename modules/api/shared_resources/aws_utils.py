@@ -1,22 +1,58 @@
 import json
 
 import boto3
+from botocore.exceptions import ClientError
 
 
 class S3Client:
     def __init__(self):
         self.client = boto3.client('s3')
 
-    def get_object(self, bucket, key):
+    def get_object(self, bucket, key, byte_range=None):
         kwargs = {
             'Bucket': bucket,
             'Key': key,
         }
+        if byte_range is not None:
+            start, end = byte_range
+            kwargs['Range'] = f'bytes={start}-{end - 1}'
         print(f"Calling s3.get_object with kwargs: {json.dumps(kwargs)}")
         response = self.client.get_object(**kwargs)
         print(f"Received response: {json.dumps(response, default=str)}")
         return response['Body']
 
+    def get_changed_object(self, bucket, key, etag=None):
+        """
+        Returns the eTag and body of an object, or None if its eTag is
+        still etag.
+        """
+        kwargs = {
+            'Bucket': bucket,
+            'Key': key,
+        }
+        if etag is not None:
+            kwargs['IfNoneMatch'] = etag
+        print(f"Calling s3.get_object with kwargs: {json.dumps(kwargs)}")
+        try:
+            response = self.client.get_object(**kwargs)
+        except ClientError as error:
+            if error.response['Error']['Code'] == '304':
+                print("Object hasn't changed")
+                return None
+            raise error
+        print(f"Received response: {json.dumps(response, default=str)}")
+        return response['ETag'], response['Body']
+
+    def get_etag(self, bucket, key):
+        kwargs = {
+            'Bucket': bucket,
+            'Key': key,
+        }
+        print(f"Calling s3.head_object with kwargs: {json.dumps(kwargs)}")
+        response = self.client.head_object(**kwargs)
+        print(f"Received response: {json.dumps(response, default=str)}")
+        return response['ETag']
+
     def put_object(self, bucket, key, body):
         kwargs = {
             'Bucket': bucket,
@@ -28,11 +64,67 @@ class S3Client:
         s3_response = self.client.put_object(**kwargs)
         print(f"Received response {json.dumps(s3_response, default=str)}")
 
+    def create_multipart_upload(self, bucket, key):
+        kwargs = {
+            'Bucket': bucket,
+            'Key': key,
+        }
+        print("Calling s3.create_multipart_upload with kwargs:"
+              f" {json.dumps(kwargs)}")
+        response = self.client.create_multipart_upload(**kwargs)
+        print(f"Received response: {json.dumps(response, default=str)}")
+        return response['UploadId']
+
+    def upload_part(self, bucket, key, upload_id, part_number, body):
+        kwargs = {
+            'Bucket': bucket,
+            'Key': key,
+            'UploadId': upload_id,
+            'PartNumber': part_number,
+        }
+        print(f"Calling s3.upload_part with kwargs: {json.dumps(kwargs)}"
+              f" and {len(body)} byte body")
+        response = self.client.upload_part(Body=body, **kwargs)
+        print(f"Received response: {json.dumps(response, default=str)}")
+        return response['ETag']
+
+    def complete_multipart_upload(self, bucket, key, upload_id, etags):
+        kwargs = {
+            'Bucket': bucket,
+            'Key': key,
+            'UploadId': upload_id,
+            'MultipartUpload': {
+                'Parts': [
+                    {
+                        'ETag': etag,
+                        'PartNumber': part_number,
+                    }
+                    for part_number, etag in enumerate(etags, 1)
+                ],
+            },
+        }
+        print("Calling s3.complete_multipart_upload with kwargs:"
+              f" {json.dumps(kwargs)}")
+        response = self.client.complete_multipart_upload(**kwargs)
+        print(f"Received response: {json.dumps(response, default=str)}")
+
+    def abort_multipart_upload(self, bucket, key, upload_id):
+        kwargs = {
+            'Bucket': bucket,
+            'Key': key,
+            'UploadId': upload_id,
+        }
+        print("Calling s3.abort_multipart_upload with kwargs:"
+              f" {json.dumps(kwargs)}")
+        response = self.client.abort_multipart_upload(**kwargs)
+        print(f"Received response: {json.dumps(response, default=str)}")
+
     @staticmethod
     def truncate_body(body, head=100, tail=100):
+        # Bodies may be compressed, so don't expect them to be text
         if len(body) > head + tail + 16:
-            return (body[:head].decode()
+            return (body[:head].decode(errors='replace')
                     + f'...<{len(body) - head - tail} bytes>...'
-                    + body[-tail:].decode())
+                    + body[-tail:].decode(errors='replace'))
         else:
-            return body.decode()
+            return body.decode(errors='replace')
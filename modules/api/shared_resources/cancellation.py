@@ -0,0 +1,100 @@
+import json
+import threading
+
+import boto3
+from botocore.exceptions import ClientError
+
+# How often a running invocation first checks whether its work is still
+# wanted, doubling after each check up to MAX_CHECK_INTERVAL_SECONDS
+CHECK_INTERVAL_SECONDS = 0.5
+MAX_CHECK_INTERVAL_SECONDS = 4
+
+s3 = boto3.client('s3')
+
+
+def get_cancel_key(function_name, request_id):
+    return f'{function_name}/cancelled/{request_id}'
+
+
+class Cancellation:
+    """
+    Lets a fan-out of lambda invocations stop once its answer is known.
+    cancel_children leaves a marker at key in the bucket, and the
+    invocations given child_keys poll for it in a background thread while
+    the instance is entered. A marker at any of parent_keys means this
+    invocation's own work is no longer wanted. Markers expire with the
+    bucket's other objects. An invocation that will never cancel its
+    children is given no key, so they don't poll for a marker on its
+    account.
+    """
+    def __init__(self, bucket, key=None, parent_keys=()):
+        self.bucket = bucket
+        self.key = key
+        self.parent_keys = list(parent_keys)
+        self.cancelled = threading.Event()
+        self.children_cancelled = threading.Event()
+        self.stopped = threading.Event()
+        self.poller = None
+
+    def __enter__(self):
+        if self.parent_keys:
+            self.poller = threading.Thread(target=self._poll, daemon=True)
+            self.poller.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Lambda freezes threads between invocations, so don't leave one
+        # running into the next.
+        self.stopped.set()
+        if self.poller is not None:
+            self.poller.join()
+
+    @property
+    def child_keys(self):
+        return self.parent_keys + ([self.key] if self.key else [])
+
+    def cancel_children(self):
+        if self.key is None or self.children_cancelled.is_set():
+            return
+        self.children_cancelled.set()
+        kwargs = {
+            'Bucket': self.bucket,
+            'Key': self.key,
+        }
+        print(f"Calling s3.put_object with kwargs {json.dumps(kwargs)}")
+        response = s3.put_object(Body=b'', **kwargs)
+        print(f"Received response {json.dumps(response, default=str)}")
+
+    def is_cancelled(self):
+        return self.cancelled.is_set()
+
+    def should_dispatch(self):
+        return not (self.cancelled.is_set()
+                    or self.children_cancelled.is_set())
+
+    def _marker_exists(self, key):
+        kwargs = {
+            'Bucket': self.bucket,
+            'Key': key,
+        }
+        try:
+            s3.head_object(**kwargs)
+        except ClientError as error:
+            if error.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                # Carry on with the work rather than fail over a marker
+                print(f"Could not check for cancellation marker {key}:"
+                      f" {json.dumps(error.response, default=str)}")
+            return False
+        return True
+
+    def _poll(self):
+        # Most cancellations come soon after the fan-out starts, so checks
+        # become less frequent the longer the invocation runs.
+        interval = CHECK_INTERVAL_SECONDS
+        while not self.stopped.wait(interval):
+            for key in self.parent_keys:
+                if self._marker_exists(key):
+                    print(f"Found cancellation marker {key}, stopping")
+                    self.cancelled.set()
+                    return
+            interval = min(interval * 2, MAX_CHECK_INTERVAL_SECONDS)
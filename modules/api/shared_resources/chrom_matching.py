@@ -1,6 +1,7 @@
 import subprocess
 
 from lambda_utils import clear_tmp
+from tabix_reader import can_read, get_reader
 
 
 CHROMOSOME_ALIASES = {
@@ -41,6 +42,12 @@ CHROMOSOMES = CHROMOSOME_LENGTHS_MBP.keys()
 
 
 def get_vcf_chromosomes(vcf):
+    """
+    Returns the (length, records) of each contig with records, with a
+    length of None if the header doesn't give one.
+    """
+    if can_read(vcf):
+        return get_reader(vcf).get_contigs()
     args = [
         'bcftools', 'index',
         '--stats',
@@ -56,12 +63,35 @@ def get_vcf_chromosomes(vcf):
     output = {}
     for line in lines:
         contig, length_str, records_str = line.split('\t')
-        length = int(length_str)
+        length = None if length_str == '.' else int(length_str)
         records = int(records_str)
         output[contig] = (length, records)
     return output
 
 
+def get_contig_map(vcf_chromosomes):
+    """
+    Lists the contigs from get_vcf_chromosomes in order, as
+    [name, length, records, chromosome] with the chromosome each matches,
+    or None.
+    """
+    return [
+        [contig, length, records, _match_chromosome_name(contig)]
+        for contig, (length, records) in vcf_chromosomes.items()
+    ]
+
+
+def get_contig_chromosome(contig_map, target_chromosome):
+    """
+    Returns the first contig in a contig map that matches the chromosome,
+    as get_matching_chromosome would.
+    """
+    for contig, _, _, chromosome in contig_map:
+        if chromosome == target_chromosome:
+            return contig
+    return None
+
+
 def get_matching_chromosome(vcf_chromosomes, target_chromosome):
     for vcf_chrom in vcf_chromosomes:
         if _match_chromosome_name(vcf_chrom) == target_chromosome:
@@ -0,0 +1,46 @@
+import json
+import os
+
+import boto3
+
+CATALOG_VERSION_TABLE_NAME = os.environ['CATALOG_VERSION_TABLE']
+CATALOG_KEY = {
+    'catalog': {
+        'S': 'datasets',
+    },
+}
+
+dynamodb = boto3.client('dynamodb')
+
+
+def bump_catalog_version():
+    """
+    Tells queryDatasets containers that their cached dataset catalog is
+    out of date. Call after any change to what the assembly_index returns.
+    """
+    kwargs = {
+        'TableName': CATALOG_VERSION_TABLE_NAME,
+        'Key': CATALOG_KEY,
+        'UpdateExpression': 'ADD version :one',
+        'ExpressionAttributeValues': {
+            ':one': {
+                'N': '1',
+            },
+        },
+        'ReturnValues': 'UPDATED_NEW',
+    }
+    print(f"Calling dynamodb.update_item with kwargs {json.dumps(kwargs)}")
+    response = dynamodb.update_item(**kwargs)
+    print(f"Received response {json.dumps(response)}")
+
+
+def get_catalog_version():
+    kwargs = {
+        'TableName': CATALOG_VERSION_TABLE_NAME,
+        'Key': CATALOG_KEY,
+        'ConsistentRead': True,
+    }
+    print(f"Calling dynamodb.get_item with kwargs {json.dumps(kwargs)}")
+    response = dynamodb.get_item(**kwargs)
+    print(f"Received response {json.dumps(response)}")
+    return int(response.get('Item', {}).get('version', {}).get('N', 0))
@@ -0,0 +1,96 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import time
+import traceback
+
+import boto3
+from botocore.config import Config
+
+# How often a wait for results checks whether it should stop
+POLL_SECONDS = 0.5
+
+
+def get_lambda_client(concurrency):
+    """
+    Returns a lambda client with a connection for each call a FanOut of
+    the given concurrency can make at once. The default pool of 10 would
+    leave the rest of the calls waiting for a connection, or opening and
+    discarding their own.
+    """
+    return boto3.client('lambda',
+                        config=Config(max_pool_connections=concurrency))
+
+
+class FanOut:
+    """
+    Makes calls concurrently on a pool of at most concurrency threads, and
+    yields their results in the order they complete. Calls that haven't
+    started are dropped when the instance is exited, so stop reading
+    results once they're no longer needed.
+    """
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.futures = []
+        self.latencies = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.futures)
+
+    def close(self):
+        dropped = sum(future.cancel() for future in self.futures)
+        # Calls already running finish in their own time
+        self.executor.shutdown(wait=False)
+        self.log_latencies(dropped)
+
+    def log_latencies(self, dropped=0):
+        latencies = sorted(self.latencies)
+        if latencies:
+            summary = (f"median {latencies[len(latencies) // 2]:.3f}s,"
+                       f" 90th percentile"
+                       f" {latencies[int(0.9 * (len(latencies) - 1))]:.3f}s,"
+                       f" max {latencies[-1]:.3f}s")
+        else:
+            summary = "no latencies"
+        print(f"{self.name} fan-out of {len(self.futures)} calls with"
+              f" concurrency {self.concurrency}: {len(latencies)} completed"
+              f" ({summary}), {dropped} dropped")
+
+    def results(self, stop=None):
+        """
+        Yields the result of each call as it completes. A call that raised
+        yields the error_result it was submitted with. If stop is given, it
+        is checked as results arrive and at least every POLL_SECONDS, and
+        no more results are yielded once it returns True.
+        """
+        pending = set(self.futures)
+        while pending:
+            done, pending = wait(pending, timeout=POLL_SECONDS,
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                if stop is not None and stop():
+                    return
+                yield future.result()
+            if stop is not None and stop():
+                return
+
+    def submit(self, function, error_result=None):
+        self.futures.append(self.executor.submit(self._call, function,
+                                                 error_result))
+
+    def _call(self, function, error_result):
+        start = time.perf_counter()
+        try:
+            return function()
+        except Exception:
+            print(f"{self.name} call failed:")
+            traceback.print_exc()
+            return error_result
+        finally:
+            self.latencies.append(time.perf_counter() - start)
@@ -0,0 +1,173 @@
+import json
+import mmap
+import re
+import struct
+
+import numpy as np
+
+from genotypes import get_allele_carriers, parse_genotypes
+
+
+MAGIC = b'GTINDEX1'
+HEADER_LENGTH = struct.Struct('<Q')
+ALIGNMENT = 8
+
+ARRAY_DTYPES = {
+    # Per record
+    'positions': '<i4',
+    'total_counts': '<i8',
+    'allele_offsets': '<i8',
+    'text_offsets': '<i8',
+    # REF\tALT for each record, concatenated
+    'text': 'u1',
+    # Per alt allele
+    'call_counts': '<i8',
+    'carrier_offsets': '<i8',
+    # Sample indexes carrying each alt allele, concatenated
+    'carriers': '<i4',
+}
+
+index_key_pattern = re.compile('.*/([0-9]+)-([0-9]+)\\.gti')
+
+
+def get_index_key(vcf_location, chrom, start, end):
+    return f'{get_index_prefix(vcf_location, chrom)}{start}-{end}.gti'
+
+
+def get_index_prefix(vcf_location, chrom=None):
+    # Keep the source bucket in the key so identically named vcfs don't clash
+    prefix = f'{vcf_location[5:]}/genotypes/'
+    if chrom is not None:
+        prefix += f'{chrom}/'
+    return prefix
+
+
+def parse_index_key(key):
+    start, end = index_key_pattern.fullmatch(key).groups()
+    return int(start), int(end)
+
+
+def get_carriers(genotypes, num_alts):
+    """
+    Returns the sample indexes holding each alt allele, along with the
+    number of calls made for each allele and in total.
+    """
+    samples, alleles = parse_genotypes(genotypes)
+    carriers = [
+        get_allele_carriers(samples, alleles, alt_index + 1)
+        for alt_index in range(num_alts)
+    ]
+    call_counts = np.bincount(alleles, minlength=num_alts+1)[1:num_alts+1]
+    return carriers, call_counts.tolist(), len(alleles)
+
+
+class GenotypeIndexWriter:
+    def __init__(self, sample_count=0):
+        self.sample_count = sample_count
+        self.positions = []
+        self.total_counts = []
+        self.allele_offsets = [0]
+        self.text = bytearray()
+        self.text_offsets = [0]
+        self.call_counts = []
+        self.carrier_offsets = [0]
+        self.carriers = []
+
+    def add_record(self, pos, ref, all_alts, genotypes, total_count=None,
+                   call_counts=None):
+        alts = all_alts.split(',')
+        carriers, gt_call_counts, gt_total_count = get_carriers(genotypes,
+                                                                len(alts))
+        if total_count is None:
+            total_count = gt_total_count
+        if call_counts is None:
+            call_counts = gt_call_counts
+        if genotypes:
+            self.sample_count = max(self.sample_count,
+                                    genotypes.rstrip(',\r\n').count(',') + 1)
+        self.positions.append(pos)
+        self.total_counts.append(total_count)
+        self.allele_offsets.append(self.allele_offsets[-1] + len(alts))
+        self.text += f'{ref}\t{all_alts}'.encode()
+        self.text_offsets.append(len(self.text))
+        self.call_counts += call_counts
+        for allele_carriers in carriers:
+            self.carriers.append(allele_carriers.astype('<i4'))
+            self.carrier_offsets.append(self.carrier_offsets[-1]
+                                        + len(allele_carriers))
+
+    def to_bytes(self):
+        arrays = {
+            'positions': self.positions,
+            'total_counts': self.total_counts,
+            'allele_offsets': self.allele_offsets,
+            'text_offsets': self.text_offsets,
+            'text': self.text,
+            'call_counts': self.call_counts,
+            'carrier_offsets': self.carrier_offsets,
+            'carriers': (np.concatenate(self.carriers) if self.carriers
+                         else []),
+        }
+        encoded_arrays = {
+            name: np.asarray(values, dtype=ARRAY_DTYPES[name]).tobytes()
+            for name, values in arrays.items()
+        }
+        layout = {}
+        offset = 0
+        for name, encoded in encoded_arrays.items():
+            layout[name] = [offset, len(arrays[name])]
+            offset += _padded_length(len(encoded))
+        header = json.dumps({
+            'sample_count': self.sample_count,
+            'arrays': layout,
+        }).encode()
+        header += b' ' * (_padded_length(len(header)) - len(header))
+        body = bytearray(MAGIC)
+        body += HEADER_LENGTH.pack(len(header))
+        body += header
+        for encoded in encoded_arrays.values():
+            body += encoded
+            body += bytes(_padded_length(len(encoded)) - len(encoded))
+        return bytes(body)
+
+
+class GenotypeIndex:
+    """
+    Read-only view of a genotype index file, memory-mapped so only the
+    records and carriers that are queried get paged in.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as index_file:
+            self.buffer = mmap.mmap(index_file.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+        if self.buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a genotype index")
+        header_start = len(MAGIC) + HEADER_LENGTH.size
+        header_length, = HEADER_LENGTH.unpack_from(self.buffer, len(MAGIC))
+        header = json.loads(self.buffer[header_start:
+                                        header_start+header_length])
+        self.sample_count = header['sample_count']
+        data_start = header_start + header_length
+        for name, (offset, length) in header['arrays'].items():
+            setattr(self, name, np.frombuffer(
+                self.buffer, dtype=ARRAY_DTYPES[name], count=length,
+                offset=data_start + offset))
+
+    def records(self, first_bp, last_bp):
+        first = np.searchsorted(self.positions, first_bp, side='left')
+        last = np.searchsorted(self.positions, last_bp, side='right')
+        for i in range(first, last):
+            reference, all_alts = bytes(
+                self.text[self.text_offsets[i]:self.text_offsets[i+1]]
+            ).decode().split('\t')
+            yield (int(self.positions[i]), reference, all_alts,
+                   int(self.total_counts[i]), int(self.allele_offsets[i]))
+
+    def get_carriers(self, allele):
+        return self.carriers[self.carrier_offsets[allele]:
+                             self.carrier_offsets[allele+1]]
+
+
+def _padded_length(length):
+    return -(-length // ALIGNMENT) * ALIGNMENT
@@ -0,0 +1,68 @@
+import numpy as np
+
+
+COMMA = ord(',')
+DOT = ord('.')
+ZERO = ord('0')
+NINE = ord('9')
+
+
+def parse_genotypes(genotypes):
+    """
+    Parses a bcftools `[%GT,]` column in a single vectorised pass.
+    Returns two equal length arrays, the sample index and allele number of
+    every non-missing call. Allele number 0 is the reference.
+    """
+    if isinstance(genotypes, str):
+        genotypes = genotypes.encode()
+    raw = np.frombuffer(genotypes.rstrip(b',\r\n'), dtype=np.uint8)
+    if not len(raw):
+        return (np.empty(0, dtype=np.int32),
+                np.empty(0, dtype=np.int32))
+    haploid = _parse_haploid(raw)
+    if haploid is not None:
+        return haploid
+    is_digit = (raw >= ZERO) & (raw <= NINE)
+    sample_of_byte = np.cumsum(raw == COMMA, dtype=np.int32)
+    digit_positions = np.flatnonzero(is_digit)
+    if not len(digit_positions):
+        return (np.empty(0, dtype=np.int32),
+                np.empty(0, dtype=np.int32))
+    # A call starts at any digit that doesn't follow another digit
+    run_starts = np.ones(len(digit_positions), dtype=bool)
+    run_starts[1:] = np.diff(digit_positions) != 1
+    start_indexes = np.flatnonzero(run_starts)
+    digits = raw[digit_positions].astype(np.int64) - ZERO
+    if len(start_indexes) == len(digit_positions):
+        alleles = digits
+    else:
+        # Allele numbers with more than one digit
+        run_ids = np.cumsum(run_starts) - 1
+        end_indexes = np.append(start_indexes[1:], len(digit_positions)) - 1
+        exponents = end_indexes[run_ids] - np.arange(len(digit_positions))
+        alleles = np.add.reduceat(digits * 10 ** exponents, start_indexes)
+    samples = sample_of_byte[digit_positions[start_indexes]]
+    return samples, alleles.astype(np.int32)
+
+
+def get_allele_carriers(samples, alleles, allele):
+    """
+    Returns the sorted, unique indexes of samples with at least one call of
+    the given allele number.
+    """
+    return np.unique(samples[alleles == allele])
+
+
+def _parse_haploid(raw):
+    # Haploid calls are a single character each, so separators must be at
+    # every odd offset.
+    if len(raw) % 2 != 1:
+        return None
+    calls = raw[0::2]
+    if not (raw[1::2] == COMMA).all():
+        return None
+    called = calls != DOT
+    if not ((calls[called] >= ZERO) & (calls[called] <= NINE)).all():
+        return None
+    samples = np.flatnonzero(called).astype(np.int32)
+    return samples, calls[called].astype(np.int32) - ZERO
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+import threading
+
+
+class MemoryCache:
+    """
+    Least recently used cache that lives as long as the container, bounded
+    by the approximate size in bytes of what it holds. An entry stored with
+    a version is only returned when asked for with the same version. Safe
+    to share between threads. If given, on_remove is called with each value
+    the cache drops or declines to keep.
+    """
+    def __init__(self, name, max_size, on_remove=None):
+        self.name = name
+        self.max_size = max_size
+        self.on_remove = on_remove
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, version=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] != version:
+                print(f"{self.name} entry for {key} is out of date")
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                self._log('miss', key)
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self._log('hit', key)
+            return entry[1]
+
+    def put(self, key, value, size, version=None):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if size > self.max_size:
+                print(f"{self.name} entry for {key} is too large to keep")
+                if self.on_remove is not None:
+                    self.on_remove(value)
+                return
+            self.entries[key] = (version, value, size)
+            self.size += size
+            while self.size > self.max_size:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _log(self, event, key):
+        print(f"{self.name} {event} for {key}: {self.hits} hits,"
+              f" {self.misses} misses, {self.evictions} evictions,"
+              f" {len(self.entries)} entries using {self.size} bytes")
+
+    def _remove(self, key):
+        _, value, size = self.entries.pop(key)
+        self.size -= size
+        if self.on_remove is not None:
+            self.on_remove(value)
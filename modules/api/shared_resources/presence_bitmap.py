@@ -0,0 +1,145 @@
+import gzip
+import re
+
+# The bases each IUPAC code in an alt could stand for, as performQuery
+# matches them
+IUPAC_BASES = {
+    'A': 'A',
+    'C': 'C',
+    'G': 'G',
+    'T': 'T',
+    'U': 'T',
+    'M': 'AC',
+    'R': 'AG',
+    'W': 'AT',
+    'S': 'CG',
+    'Y': 'CT',
+    'K': 'GT',
+    'V': 'ACG',
+    'H': 'ACT',
+    'D': 'AGT',
+    'B': 'CGT',
+    'N': 'ACGT',
+}
+
+# Bitmaps of the positions where a record starts, then of the positions
+# where a record has a single base alt that could be each base.
+BITMAP_NAMES = ('positions', 'A', 'C', 'G', 'T')
+
+presence_key_pattern = re.compile('.*/([0-9]+)-([0-9]+)\\.bin')
+regular_alt = re.compile(f'[{"".join(IUPAC_BASES)}]+')
+
+
+def get_presence_key(vcf_location, chrom, start, end):
+    return f'{get_presence_prefix(vcf_location, chrom)}{start}-{end}.bin'
+
+
+def get_presence_prefix(vcf_location, chrom=None):
+    prefix = f'{vcf_location[5:]}/presence/'
+    if chrom is not None:
+        prefix += f'{chrom}/'
+    return prefix
+
+
+def parse_presence_key(key):
+    start, end = presence_key_pattern.fullmatch(key).groups()
+    return int(start), int(end)
+
+
+def truncate_alt(ref, alt):
+    # Trims the suffix shared with ref the same way performQuery does
+    if regular_alt.fullmatch(alt):
+        suffix_len = 0
+        max_suffix = 1 - min(len(ref), len(alt))
+        while (suffix_len > max_suffix
+               and ref[suffix_len-1] == alt[suffix_len-1]):
+            suffix_len -= 1
+        if suffix_len:
+            return alt[:suffix_len]
+    return alt
+
+
+def any_set(bitmap, first, last):
+    """
+    Returns whether any bit from first to last inclusive is set in the
+    bitmap, which holds the bits of each byte most significant first.
+    """
+    first_byte = first // 8
+    value = int.from_bytes(bitmap[first_byte:last // 8 + 1], 'big')
+    width = (last // 8 + 1 - first_byte) * 8
+    value >>= width - 1 - (last - first_byte * 8)
+    return value & ((1 << (last - first + 1)) - 1) != 0
+
+
+class PresenceBitmapWriter:
+    """
+    Records which positions of a summarised slice have records, and which
+    single base alts they have, so queries for anything else can be
+    answered without reading the vcf.
+    """
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        num_bytes = (end - start) // 8 + 1
+        self.bitmaps = {name: bytearray(num_bytes) for name in BITMAP_NAMES}
+
+    def add_record(self, pos, reference, all_alts):
+        if not self.start <= pos <= self.end:
+            return
+        offset = pos - self.start
+        byte_index = offset // 8
+        bit = 0x80 >> (offset % 8)
+        self.bitmaps['positions'][byte_index] |= bit
+        for alt in all_alts.split(','):
+            alt = truncate_alt(reference, alt).upper()
+            if len(alt) == 1:
+                for base in IUPAC_BASES.get(alt, ''):
+                    self.bitmaps[base][byte_index] |= bit
+
+    def to_bytes(self):
+        return gzip.compress(b''.join(bytes(self.bitmaps[name])
+                                      for name in BITMAP_NAMES))
+
+
+class PresenceBitmap:
+    """
+    The presence bitmaps of the summarised slices of a vcf's chromosome,
+    added as (start, end, body) in any order.
+    """
+    def __init__(self, slices):
+        self.slices = []
+        for start, end, body in sorted(slices):
+            bitmaps_bytes = gzip.decompress(body)
+            num_bytes = len(bitmaps_bytes) // len(BITMAP_NAMES)
+            self.slices.append((start, end, {
+                name: bitmaps_bytes[i * num_bytes:(i + 1) * num_bytes]
+                for i, name in enumerate(BITMAP_NAMES)
+            }))
+        self.size = sum(len(bitmap) for _, _, bitmaps in self.slices
+                        for bitmap in bitmaps.values())
+
+    def may_match(self, region_start, region_end, alternate_bases):
+        """
+        Returns False only if no record starting from region_start to
+        region_end could have an alt matching alternate_bases, or any alt
+        if alternate_bases is None. Parts of the region no slice covers
+        could have anything.
+        """
+        if alternate_bases is not None and len(alternate_bases) == 1:
+            names = IUPAC_BASES.get(alternate_bases, 'ACGT')
+        else:
+            names = ('positions',)
+        covered_to = region_start - 1
+        for start, end, bitmaps in self.slices:
+            if end < region_start:
+                continue
+            if start > covered_to + 1:
+                return True
+            first = max(start, region_start) - start
+            last = min(end, region_end) - start
+            if any(any_set(bitmaps[name], first, last) for name in names):
+                return True
+            covered_to = max(covered_to, end)
+            if covered_to >= region_end:
+                return False
+        return True
@@ -0,0 +1,83 @@
+import json
+import re
+
+import numpy as np
+
+
+# Width in bp of each bin of the record position histogram
+BIN_SIZE = 100
+
+density_key_pattern = re.compile('.*/([0-9]+)-([0-9]+)\\.json')
+
+
+def get_density_key(vcf_location, chrom, start, end):
+    return f'{get_density_prefix(vcf_location, chrom)}{start}-{end}.json'
+
+
+def get_density_prefix(vcf_location, chrom=None):
+    prefix = f'{vcf_location[5:]}/density/'
+    if chrom is not None:
+        prefix += f'{chrom}/'
+    return prefix
+
+
+def parse_density_key(key):
+    start, end = density_key_pattern.fullmatch(key).groups()
+    return int(start), int(end)
+
+
+def get_density(positions, start, end, bin_size=BIN_SIZE):
+    """
+    Returns the serialised histogram of records starting in each bin of a
+    summarised slice, only listing bins that have records.
+    """
+    bin_numbers = (np.asarray(positions, dtype=np.int64) - start) // bin_size
+    bins, counts = np.unique(bin_numbers, return_counts=True)
+    return json.dumps({
+        'start': start,
+        'end': end,
+        'bin_size': bin_size,
+        'bins': bins.tolist(),
+        'counts': counts.tolist(),
+    }).encode()
+
+
+def plan_splits(densities, first_bp, last_bp, target_records):
+    """
+    Divides first_bp-last_bp into splits of roughly target_records records
+    each, leaving out any stretch that the densities show has no records.
+    The densities must be sorted and cover the whole region. Returns a list
+    of (split_first_bp, split_last_bp, estimated_records).
+    """
+    splits = []
+    split_first_bp = None
+    split_last_bp = None
+    split_records = 0
+    for density in densities:
+        start = density['start']
+        bin_size = density['bin_size']
+        for bin_number, count in zip(density['bins'], density['counts']):
+            bin_first_bp = max(first_bp, start + bin_number * bin_size)
+            bin_last_bp = min(last_bp, density['end'],
+                              start + (bin_number + 1) * bin_size - 1)
+            if bin_first_bp > bin_last_bp:
+                continue
+            # Assume records are spread evenly through a partial bin
+            records = max(1, round(count * (bin_last_bp - bin_first_bp + 1)
+                                   / bin_size))
+            if (split_first_bp is not None
+                    and bin_first_bp != split_last_bp + 1):
+                # Don't let a split span bins known to be empty
+                splits.append((split_first_bp, split_last_bp, split_records))
+                split_first_bp = None
+            if split_first_bp is None:
+                split_first_bp = bin_first_bp
+                split_records = 0
+            split_last_bp = bin_last_bp
+            split_records += records
+            if split_records >= target_records:
+                splits.append((split_first_bp, split_last_bp, split_records))
+                split_first_bp = None
+    if split_first_bp is not None:
+        splits.append((split_first_bp, split_last_bp, split_records))
+    return splits
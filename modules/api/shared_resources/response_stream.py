@@ -0,0 +1,142 @@
+import json
+
+# S3 requires every part of an upload but the last to be at least 5 MiB
+PART_SIZE = 8 * 2**20
+# Objects are copied into a response in reads of this size
+READ_SIZE = 2**20
+
+
+class MultipartWriter:
+    """
+    Uploads an S3 object a part at a time as bytes are written to it, so
+    no more than a part of it is held in memory.
+    """
+    def __init__(self, s3, bucket, key):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.upload_id = s3.create_multipart_upload(bucket, key)
+        self.buffer = bytearray()
+        self.etags = []
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= PART_SIZE:
+            self.upload_buffer()
+
+    def upload_buffer(self):
+        self.etags.append(self.s3.upload_part(
+            self.bucket, self.key, self.upload_id, len(self.etags) + 1,
+            bytes(self.buffer)))
+        self.buffer = bytearray()
+
+    def close(self):
+        if self.buffer or not self.etags:
+            self.upload_buffer()
+        self.s3.complete_multipart_upload(self.bucket, self.key,
+                                          self.upload_id, self.etags)
+
+    def abort(self):
+        self.s3.abort_multipart_upload(self.bucket, self.key, self.upload_id)
+
+
+class StreamingResponse:
+    """
+    Builds a JSON object with a list field out of items that arrive in any
+    order, writing each one as soon as every item with an earlier key has
+    arrived. Items are given already serialised, or as the S3 object
+    holding their serialisation, which is copied in without being parsed.
+    The object is kept in memory until it grows past max_size, and from
+    then on written to an S3 multipart upload at bucket and key. An upload
+    is aborted if the instance is exited with an exception.
+    """
+    def __init__(self, s3, bucket, key, max_size, head, list_field,
+                 item_keys):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.max_size = max_size
+        self.order = sorted(item_keys)
+        self.next_index = 0
+        self.arrived = {}
+        self.num_items = 0
+        self.size = 0
+        self.chunks = []
+        self.writer = None
+        head_json = json.dumps(head)
+        self.write((head_json[:-1] + (', ' if head else '')
+                    + json.dumps(list_field) + ': ').encode())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is not None and self.writer is not None:
+            self.writer.abort()
+
+    def add(self, item_key, body=None):
+        """
+        Adds the serialised item of item_key, or leaves it out of the list
+        if body is None.
+        """
+        self.arrived[item_key] = body
+        self.write_arrived()
+
+    def add_s3(self, item_key, bucket, key):
+        """
+        Adds the item of item_key serialised in the S3 object at bucket and
+        key.
+        """
+        self.arrived[item_key] = (bucket, key)
+        self.write_arrived()
+
+    def finish(self, tail):
+        """
+        Closes the list, leaving out any items that haven't arrived, and
+        ends the object with the fields in tail. Returns the serialised
+        object, or None if it was uploaded to S3 instead.
+        """
+        for item_key in self.order[self.next_index:]:
+            if item_key in self.arrived:
+                self.write_item(self.arrived.pop(item_key))
+        self.next_index = len(self.order)
+        tail_json = json.dumps(tail)
+        self.write(((']' if self.num_items else 'null')
+                    + (', ' + tail_json[1:] if tail else '}')).encode())
+        if self.writer is not None:
+            self.writer.close()
+            print(f"Uploaded {self.size} byte response to S3")
+            return None
+        print(f"Response is {self.size} bytes")
+        return b''.join(self.chunks)
+
+    def write(self, data):
+        self.size += len(data)
+        if self.writer is not None:
+            self.writer.write(data)
+            return
+        self.chunks.append(data)
+        if self.size > self.max_size:
+            print("Response is too large, uploading to S3...")
+            self.writer = MultipartWriter(self.s3, self.bucket, self.key)
+            for chunk in self.chunks:
+                self.writer.write(chunk)
+            self.chunks = []
+
+    def write_arrived(self):
+        while (self.next_index < len(self.order)
+               and self.order[self.next_index] in self.arrived):
+            self.write_item(self.arrived.pop(self.order[self.next_index]))
+            self.next_index += 1
+
+    def write_item(self, item):
+        if item is None:
+            return
+        self.write(b', ' if self.num_items else b'[')
+        self.num_items += 1
+        if isinstance(item, bytes):
+            self.write(item)
+        else:
+            streaming_body = self.s3.get_object(*item)
+            for chunk in iter(lambda: streaming_body.read(READ_SIZE), b''):
+                self.write(chunk)
@@ -0,0 +1,65 @@
+import base64
+
+import numpy as np
+
+
+# How lists of sample indexes are sent from performQuery to splitQuery
+JSON_ENCODING = 'json'
+VARINT_ENCODING = 'varint'
+
+CONTINUATION_BIT = 0x80
+VALUE_BITS = 0x7f
+
+
+def encode_samples(sample_indexes):
+    """
+    Packs sample indexes into a base64 string of the LEB128 varints of the
+    gaps between them. Duplicates are dropped and order isn't kept.
+    """
+    values = np.sort(np.asarray(sample_indexes, dtype=np.int64))
+    if not len(values):
+        return ''
+    values = values[np.append(True, values[1:] != values[:-1])]
+    gaps = np.diff(values, prepend=0)
+    lengths = np.ones(len(gaps), dtype=np.int64)
+    remaining = gaps >> 7
+    while remaining.any():
+        lengths += remaining > 0
+        remaining >>= 7
+    starts = np.cumsum(lengths) - lengths
+    byte_numbers = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+    byte_gaps = np.repeat(gaps, lengths)
+    encoded = (byte_gaps >> (7 * byte_numbers)) & VALUE_BITS
+    encoded[byte_numbers < np.repeat(lengths, lengths) - 1] |= CONTINUATION_BIT
+    return base64.b64encode(encoded.astype(np.uint8).tobytes()).decode()
+
+
+def decode_samples(encoded):
+    """
+    Returns the sorted array of sample indexes packed by encode_samples.
+    """
+    raw = np.frombuffer(base64.b64decode(encoded), dtype=np.uint8)
+    if not len(raw):
+        return np.empty(0, dtype=np.int64)
+    ends = np.flatnonzero(raw < CONTINUATION_BIT)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts + 1
+    byte_numbers = np.arange(len(raw)) - np.repeat(starts, lengths)
+    values = (raw & VALUE_BITS).astype(np.int64) << (7 * byte_numbers)
+    return np.cumsum(np.add.reduceat(values, starts))
+
+
+def encode_variant_samples(variant_samples):
+    return {
+        variant: encode_samples(samples)
+        for variant, samples in variant_samples.items()
+    }
+
+
+def decode_variant_samples(variant_samples):
+    return {
+        variant: decode_samples(samples)
+        for variant, samples in variant_samples.items()
+    }
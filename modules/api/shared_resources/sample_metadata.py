@@ -0,0 +1,120 @@
+import hashlib
+import json
+
+import numpy as np
+
+
+# Sample fields that are read from a differently named csv column
+METADATA_TRANSLATIONS = {
+    'State': 'Location',
+}
+# Sample fields whose values are cleaned up before being counted
+NORMALISED_FIELDS = ('Location', 'SampleCollectionDate', 'State')
+
+
+def get_metadata_csv(vcf_location):
+    """
+    Returns the bucket and key of the csv of sample metadata kept
+    alongside a vcf.
+    """
+    delimiter_index = vcf_location.find('/', 5)
+    bucket = vcf_location[5:delimiter_index]
+    key = vcf_location[delimiter_index + 1:]
+    return bucket, f'{key.split(".")[0]}.csv'
+
+
+def get_metadata_prefix(vcf_location):
+    return f'{vcf_location[5:]}/metadata/'
+
+
+def get_manifest_key(vcf_location):
+    return f'{get_metadata_prefix(vcf_location)}columns.json'
+
+
+def get_column_keys(vcf_location, build, field):
+    field_hash = hashlib.sha256(field.encode()).hexdigest()[:16]
+    prefix = f'{get_metadata_prefix(vcf_location)}{build}/{field_hash}'
+    return f'{prefix}.npy', f'{prefix}.json'
+
+
+def normalise(field, values, country_codes):
+    """
+    Cleans up the values of a sample field read from a metadata csv, one
+    value per sample. Raises KeyError for a Location with an unknown
+    country.
+    """
+    if field == 'Location':
+        # Convert to Country only
+        return [
+            # Clean data of known errors
+            country_codes[
+                location.split('/')[0].strip(' \u200e').lower()]
+            if location and isinstance(location, str) else None
+            for location in values
+        ]
+    elif field == 'SampleCollectionDate':
+        # Convert to months only
+        return [
+            date[:7]
+            if date and isinstance(date, str) and len(date) >= 7
+            else "Date Missing"
+            for date in values
+        ]
+    elif field == 'State':
+        # Convert to Country / State only
+        return [
+            '/'.join(location.split('/')[0:2]).strip(' \u200e').lower()
+            if location and isinstance(location, str) else None
+            for location in values
+        ]
+    return values
+
+
+def encode_column(values):
+    """
+    Dictionary encodes a column, returning an array of codes and the table
+    of distinct values they index.
+    """
+    table = {}
+    codes = np.fromiter((table.setdefault(value, len(table))
+                         for value in values),
+                        dtype=np.int32, count=len(values))
+    return codes, list(table)
+
+
+def build_columns(fieldnames, rows, country_codes):
+    """
+    Returns the dictionary encoded columns of every sample field that can
+    be read from a metadata csv's rows, already normalised. Rows are lists
+    as read by csv.reader, with blank lines dropped as csv.DictReader does.
+    Fields that can't be normalised are left out, so queries still see the
+    error.
+    """
+    column_indexes = {name: i for i, name in enumerate(fieldnames)}
+    columns = {}
+    for field in set(fieldnames) | set(NORMALISED_FIELDS):
+        i = column_indexes.get(METADATA_TRANSLATIONS.get(field, field))
+        values = [
+            row[i] if i is not None and i < len(row) else None
+            for row in rows
+        ]
+        try:
+            values = normalise(field, values, country_codes)
+        except KeyError as error:
+            print(f"Could not normalise {field}: unknown value {error}")
+            continue
+        columns[field] = encode_column(values)
+    return columns
+
+
+def get_build(columns):
+    """
+    Identifies a set of columns by their contents, so files from different
+    builds never share a name.
+    """
+    build_hash = hashlib.sha256()
+    for field in sorted(columns):
+        codes, values = columns[field]
+        build_hash.update(json.dumps([field, values]).encode())
+        build_hash.update(codes.tobytes())
+    return build_hash.hexdigest()[:16]
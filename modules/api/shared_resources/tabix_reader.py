@@ -0,0 +1,378 @@
+import gzip
+import json
+import os
+import re
+import struct
+import time
+import zlib
+
+import boto3
+from botocore.exceptions import ClientError
+
+
+# Set to "python" to read vcfs in-process instead of through bcftools
+VCF_READER = os.environ.get('VCF_READER', 'bcftools')
+
+# gzip header, XLEN and the BC subfield holding the block size
+BLOCK_HEADER_SIZE = 18
+MAX_BLOCK_SIZE = 2**16
+HEADER_READ_SIZE = 2**20
+# An open reader's index is checked for changes once it was last checked
+# this long ago
+INDEX_CHECK_SECONDS = 10
+
+contig_pattern = re.compile(b'##contig=<(.*)>')
+info_id_pattern = re.compile(b'##INFO=<ID=([^,>]+)')
+contig_length_pattern = re.compile(b'(?:^|,)length=([0-9]+)')
+contig_id_pattern = re.compile(b'(?:^|,)ID=([^,>]+)')
+
+s3 = boto3.client('s3')
+
+# Opened readers are kept for the lifetime of the container
+open_readers = {}
+
+
+def can_read(location):
+    return VCF_READER == 'python' and location.startswith('s3://')
+
+
+def get_info_value(info, key):
+    prefix = key + b'='
+    for info_field in info.split(b';'):
+        if info_field.startswith(prefix):
+            return info_field[len(prefix):]
+    return None
+
+
+def get_reader(location):
+    reader = open_readers.get(location)
+    if reader is not None:
+        now = time.time()
+        if now - reader.index_checked >= INDEX_CHECK_SECONDS:
+            if reader.index_is_current():
+                reader.index_checked = now
+            else:
+                reader = None
+    if reader is None:
+        reader = TabixReader(location)
+        open_readers[location] = reader
+    return reader
+
+
+def split_query_record(line):
+    """
+    Splits a vcf record into the fields that
+    `bcftools query --format '%POS\t%REF\t%ALT\t%INFO\t[%GT,]'` would give.
+    """
+    fields = line.rstrip(b'\r\n').split(b'\t', 9)
+    pos, ref, alt, info = fields[1], fields[3], fields[4], fields[7]
+    if len(fields) < 10:
+        genotypes = b''
+    elif fields[8] == b'GT':
+        genotypes = fields[9].replace(b'\t', b',')
+    elif fields[8].startswith(b'GT:'):
+        genotypes = b','.join(sample.split(b':', 1)[0]
+                              for sample in fields[9].split(b'\t'))
+    else:
+        genotypes = b','.join(b'.' for _ in fields[9].split(b'\t'))
+    return pos, ref, alt, info, genotypes
+
+
+def split_site_record(line):
+    """
+    Splits a vcf record into POS, REF, ALT and INFO without touching the
+    sample columns.
+    """
+    fields = line.rstrip(b'\r\n').split(b'\t', 8)
+    return fields[1], fields[3], fields[4], fields[7]
+
+
+class S3File:
+    def __init__(self, location):
+        delimiter_index = location.find('/', 5)
+        self.bucket = location[5:delimiter_index]
+        self.key = location[delimiter_index + 1:]
+
+    def get(self, start=None, end=None):
+        kwargs = {
+            'Bucket': self.bucket,
+            'Key': self.key,
+        }
+        if start is not None:
+            kwargs['Range'] = f'bytes={start}-{end - 1}'
+        print(f"Calling s3.get_object with kwargs: {json.dumps(kwargs)}")
+        response = s3.get_object(**kwargs)
+        body = response['Body'].read()
+        print(f"Received {len(body)} bytes")
+        return body, response['ETag']
+
+    def get_etag(self):
+        kwargs = {
+            'Bucket': self.bucket,
+            'Key': self.key,
+        }
+        print(f"Calling s3.head_object with kwargs: {json.dumps(kwargs)}")
+        response = s3.head_object(**kwargs)
+        print(f"Received response: {json.dumps(response, default=str)}")
+        return response['ETag']
+
+
+class TabixReader:
+    """
+    Reads regions of a bgzipped vcf using its .tbi or .csi index, fetching
+    and decompressing only the blocks that the index points to.
+    """
+    def __init__(self, location):
+        self.vcf = S3File(location)
+        self.index_file, self.index_etag, index = self._load_index(location)
+        self.index_checked = time.time()
+        self._parse_index(gzip.decompress(index))
+        self._header = None
+
+    def fetch(self, chrom, start, end):
+        """
+        Yields the raw lines of records overlapping the 1-based, inclusive
+        region chrom:start-end.
+        """
+        try:
+            tid = self.names.index(chrom)
+        except ValueError:
+            return
+        prefix = chrom.encode() + b'\t'
+        for chunk_start, chunk_end in self._get_chunks(tid, start - 1, end):
+            data = self._read_chunk(chunk_start, chunk_end)
+            for line in data.split(b'\n'):
+                if not line.startswith(prefix):
+                    continue
+                fields = line.split(b'\t', 4)
+                pos = int(fields[1])
+                if pos <= end and pos + len(fields[3]) > start:
+                    yield line
+
+    def get_contigs(self):
+        """
+        Returns the same (length, records) for each contig with records as
+        `bcftools index --stats`. The length is None for a contig without
+        one in the header, where bcftools gives '.'.
+        """
+        lengths = {}
+        for line in self.header:
+            contig_match = contig_pattern.fullmatch(line)
+            if contig_match:
+                contig_fields = contig_match.group(1)
+                contig_id = contig_id_pattern.search(contig_fields)
+                length = contig_length_pattern.search(contig_fields)
+                if contig_id and length:
+                    lengths[contig_id.group(1).decode()] = int(length.group(1))
+        contigs = {}
+        for name, records in zip(self.names, self.record_counts):
+            if records:
+                contigs[name] = (lengths.get(name), records)
+        return contigs
+
+    def has_info(self, *keys):
+        info_ids = {
+            info_match.group(1).decode()
+            for info_match in map(info_id_pattern.match, self.header)
+            if info_match
+        }
+        return all(key in info_ids for key in keys)
+
+    @property
+    def header(self):
+        if self._header is None:
+            self._header = self._read_header()
+        return self._header
+
+    def index_is_current(self):
+        return self.index_file.get_etag() == self.index_etag
+
+    def _get_chunks(self, tid, beg, end):
+        bins = self.bins[tid]
+        min_offset = 0
+        if self.linear_indexes is not None:
+            linear_index = self.linear_indexes[tid]
+            if linear_index:
+                min_offset = linear_index[min(beg >> self.min_shift,
+                                              len(linear_index) - 1)]
+        else:
+            # Use the offset of the smallest existing bin containing beg
+            for level in range(self.depth, -1, -1):
+                bin_number = (self._level_offset(level)
+                              + (beg >> self._level_shift(level)))
+                if bin_number in self.bin_offsets[tid]:
+                    min_offset = self.bin_offsets[tid][bin_number]
+                    break
+        chunks = sorted(
+            chunk
+            for bin_number in self._region_bins(beg, end)
+            for chunk in bins.get(bin_number, [])
+            if chunk[1] > min_offset
+        )
+        merged = []
+        for chunk_start, chunk_end in chunks:
+            if merged and chunk_start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], chunk_end)
+            else:
+                merged.append([chunk_start, chunk_end])
+        return merged
+
+    def _region_bins(self, beg, end):
+        end -= 1
+        for level in range(self.depth + 1):
+            level_offset = self._level_offset(level)
+            shift = self._level_shift(level)
+            yield from range(level_offset + (beg >> shift),
+                             level_offset + (end >> shift) + 1)
+
+    def _level_offset(self, level):
+        return ((1 << (3 * level)) - 1) // 7
+
+    def _level_shift(self, level):
+        return self.min_shift + 3 * (self.depth - level)
+
+    def _load_index(self, location):
+        for extension in ('.tbi', '.csi'):
+            index_file = S3File(location + extension)
+            try:
+                index, etag = index_file.get()
+            except ClientError as error:
+                print(json.dumps(error.response, default=str))
+                continue
+            return index_file, etag, index
+        raise ValueError(f"Could not find an index for {location}")
+
+    def _parse_index(self, index):
+        magic = index[:4]
+        if magic == b'TBI\x01':
+            n_ref, = struct.unpack_from('<i', index, 4)
+            self.min_shift = 14
+            self.depth = 5
+            offset = 8
+            aux_offset = offset
+        elif magic == b'CSI\x01':
+            self.min_shift, self.depth, l_aux = struct.unpack_from(
+                '<3i', index, 4)
+            aux_offset = 16
+            offset = aux_offset + l_aux
+            n_ref, = struct.unpack_from('<i', index, offset)
+            offset += 4
+        else:
+            raise ValueError("Unrecognised index format")
+        # Tabix configuration, followed by the null-separated contig names
+        l_nm, = struct.unpack_from('<i', index, aux_offset + 24)
+        names_start = aux_offset + 28
+        self.names = [
+            name.decode()
+            for name in index[names_start:names_start+l_nm].split(b'\x00')
+            if name
+        ]
+        if magic == b'TBI\x01':
+            offset = names_start + l_nm
+        # The bin after the last real bin holds each reference's metadata
+        pseudo_bin = self._level_offset(self.depth + 1) + 1
+        self.bins = []
+        self.bin_offsets = []
+        self.linear_indexes = [] if magic == b'TBI\x01' else None
+        self.record_counts = []
+        for _ in range(n_ref):
+            n_bin, = struct.unpack_from('<i', index, offset)
+            offset += 4
+            ref_bins = {}
+            ref_bin_offsets = {}
+            records = 0
+            for _ in range(n_bin):
+                if self.linear_indexes is None:
+                    bin_number, loffset, n_chunk = struct.unpack_from(
+                        '<IQi', index, offset)
+                    offset += 16
+                    ref_bin_offsets[bin_number] = loffset
+                else:
+                    bin_number, n_chunk = struct.unpack_from('<Ii', index,
+                                                             offset)
+                    offset += 8
+                chunks = [
+                    struct.unpack_from('<2Q', index, offset + 16*i)
+                    for i in range(n_chunk)
+                ]
+                offset += 16 * n_chunk
+                if bin_number == pseudo_bin:
+                    records = chunks[1][0]
+                else:
+                    ref_bins[bin_number] = chunks
+            self.bins.append(ref_bins)
+            self.bin_offsets.append(ref_bin_offsets)
+            self.record_counts.append(records)
+            if self.linear_indexes is not None:
+                n_intv, = struct.unpack_from('<i', index, offset)
+                offset += 4
+                self.linear_indexes.append(
+                    struct.unpack_from(f'<{n_intv}Q', index, offset))
+                offset += 8 * n_intv
+
+    def _read_chunk(self, chunk_start, chunk_end):
+        block_start = chunk_start >> 16
+        block_end = chunk_end >> 16
+        raw, _ = self.vcf.get(block_start, block_end + MAX_BLOCK_SIZE)
+        data = bytearray()
+        position = 0
+        while block_start + position <= block_end and position < len(raw):
+            block_data, block_size = _decompress_block(raw, position)
+            if block_start + position == block_end:
+                block_data = block_data[:chunk_end & 0xffff]
+            if position == 0:
+                block_data = block_data[chunk_start & 0xffff:]
+            data += block_data
+            position += block_size
+        return bytes(data)
+
+    def _read_header(self):
+        header = []
+        offset = 0
+        pending = b''
+        partial_line = b''
+        while True:
+            fetched, _ = self.vcf.get(offset, offset + HEADER_READ_SIZE)
+            offset += len(fetched)
+            raw = pending + fetched
+            position = 0
+            data = bytearray(partial_line)
+            while position + BLOCK_HEADER_SIZE <= len(raw):
+                block_size = _get_block_size(raw, position)
+                if position + block_size > len(raw):
+                    break
+                block_data, _ = _decompress_block(raw, position)
+                data += block_data
+                position += block_size
+            pending = raw[position:]
+            lines = bytes(data).split(b'\n')
+            partial_line = lines.pop()
+            for line in lines:
+                if not line.startswith(b'#'):
+                    return header
+                header.append(line)
+                if line.startswith(b'#CHROM'):
+                    return header
+            if len(fetched) < HEADER_READ_SIZE:
+                return header
+
+
+def _decompress_block(raw, position):
+    block_size = _get_block_size(raw, position)
+    extra_length, = struct.unpack_from('<H', raw, position + 10)
+    data_start = position + 12 + extra_length
+    data_end = position + block_size - 8
+    return (zlib.decompress(raw[data_start:data_end], -15), block_size)
+
+
+def _get_block_size(raw, position):
+    extra_length, = struct.unpack_from('<H', raw, position + 10)
+    extra_offset = position + 12
+    extra_end = extra_offset + extra_length
+    while extra_offset < extra_end:
+        si1, si2, sub_length = struct.unpack_from('<2BH', raw, extra_offset)
+        if (si1, si2) == (66, 67):  # BC
+            block_size, = struct.unpack_from('<H', raw, extra_offset + 4)
+            return block_size + 1
+        extra_offset += 4 + sub_length
+    raise ValueError("Not a BGZF block")
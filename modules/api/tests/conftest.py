@@ -0,0 +1,52 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+LAMBDA_DIR = os.path.join(API_DIR, 'lambda')
+
+# What the lambdas read from their environment when they're imported
+os.environ.update({
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'BEACON_ID': 'test',
+    'CACHE_BUCKET': 'test',
+    'CACHE_TABLE': 'test',
+    'CATALOG_VERSION_TABLE': 'test',
+    'DATASETS_TABLE': 'test',
+    'INDEX_BUCKET': 'test',
+    'LAMBDA_TASK_ROOT': os.path.join(LAMBDA_DIR, 'splitQuery'),
+    'PERFORM_QUERY_LAMBDA': 'performQuery',
+    'RESPONSE_BUCKET': 'test',
+    'SAMPLE_ENCODING': 'varint',
+    'SPLIT_QUERY_LAMBDA': 'splitQuery',
+    'SPLIT_SIZE': '10000',
+    'VCF_SUMMARIES_TABLE': 'test',
+})
+sys.path.insert(0, os.path.join(API_DIR, 'shared_resources'))
+
+
+def load_lambda(name):
+    # Every lambda's module is called lambda_function, so each is loaded
+    # under its own name.
+    spec = importlib.util.spec_from_file_location(
+        f'{name}_lambda', os.path.join(LAMBDA_DIR, name, 'lambda_function.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope='session')
+def perform_query_lambda():
+    return load_lambda('performQuery')
+
+
+@pytest.fixture(scope='session')
+def split_query_lambda():
+    return load_lambda('splitQuery')
+
+
+@pytest.fixture(scope='session')
+def query_datasets_lambda():
+    return load_lambda('queryDatasets')
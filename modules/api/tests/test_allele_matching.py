@@ -0,0 +1,142 @@
+import itertools
+import random
+import re
+
+import pytest
+
+import allele_matching
+from allele_matching import (IUPAC_MATCHES, compile_code_matcher,
+                             get_hit_finder, is_repeat)
+
+CODES = list(IUPAC_MATCHES)
+VARIANT_TYPES = [None, 'DEL', 'INS', 'DUP', 'DUP:TANDEM', 'CNV', 'INV']
+SYMBOLIC_ALTS = ['<DEL>', '<INS>', '<DUP>', '<DUP:TANDEM>', '<CN0>', '<CN1>',
+                 '<CN2>', '<CN3>', '<CNV>', '<INV>', '.', '*']
+
+
+def get_possible_codes(code):
+    # How matches were found before compile_code_matcher, by enumerating
+    # every sequence that could match.
+    possible_codes = {''}
+    if code is not None:
+        for base in code:
+            next_possible_codes = set()
+            for possible_code in possible_codes:
+                for iupac_code in IUPAC_MATCHES[base]:
+                    next_possible_codes.add(possible_code + iupac_code)
+            possible_codes = next_possible_codes
+    return possible_codes
+
+
+def regex_is_repeat(sequence, unit, min_repeats):
+    return re.fullmatch('({}){{{},}}'.format(unit, min_repeats),
+                        sequence) is not None
+
+
+def mix_case(sequence, random_state):
+    return ''.join(random_state.choice((base.upper(), base.lower()))
+                   for base in sequence)
+
+
+@pytest.mark.parametrize('length', [0, 1, 2])
+def test_code_matcher_matches_every_combination(length):
+    sequences = [''.join(sequence)
+                 for sequence in itertools.product(CODES, repeat=length)]
+    for code in [None] + sequences:
+        possible_codes = get_possible_codes(code)
+        matches = compile_code_matcher(code)
+        for sequence in sequences:
+            for case_sequence in (sequence, sequence.lower()):
+                assert (matches(case_sequence)
+                        == (case_sequence.upper() in possible_codes)), (
+                    code, case_sequence)
+
+
+def test_code_matcher_matches_longer_codes():
+    random_state = random.Random(0)
+    # Expanding a code is exponential in its length, so these stay short
+    for _ in range(50):
+        code = ''.join(random_state.choices(CODES,
+                                            k=random_state.randint(3, 4)))
+        possible_codes = get_possible_codes(code)
+        matches = compile_code_matcher(code)
+        sequences = [
+            mix_case(''.join(random_state.choice(sorted(IUPAC_MATCHES[base]))
+                             for base in code), random_state),
+            mix_case(''.join(random_state.choices(CODES, k=len(code))),
+                     random_state),
+            mix_case(''.join(random_state.choices(
+                CODES, k=random_state.randint(0, 6))), random_state),
+        ] + SYMBOLIC_ALTS
+        for sequence in sequences:
+            assert (matches(sequence)
+                    == (sequence.upper() in possible_codes)), (code, sequence)
+
+
+@pytest.mark.parametrize('min_repeats', [0, 1, 2, 3])
+def test_is_repeat_matches_regex(min_repeats):
+    random_state = random.Random(min_repeats)
+    units = ['', 'A', 'c', 'AC', 'Ac', 'ACG', 'NNN', 'ACGT']
+    for unit in units:
+        sequences = ['', '.', 'A', 'a', 'C', 'AA', 'ACA', 'ACACA']
+        for repeats in range(6):
+            sequence = unit * repeats
+            sequences.append(sequence)
+            sequences.append(sequence + 'A')
+            sequences.append(sequence[:-1])
+            sequences.append(sequence.swapcase())
+            sequences.append(mix_case(sequence, random_state))
+        for sequence in sequences:
+            assert (is_repeat(sequence, unit, min_repeats)
+                    == regex_is_repeat(sequence, unit, min_repeats)), (
+                unit, sequence)
+
+
+def test_hit_sets_match_code_expansion(monkeypatch):
+    random_state = random.Random(0)
+    queries = []
+    # Query bases arrive upper case, the vcf's may not be
+    for reference_bases in ['N', 'A', 'AC', 'NN', 'RY', 'ACGT', '']:
+        for alternate_bases in [None, 'N', 'C', 'T', 'NN', 'ACAC', 'K', '']:
+            for variant_type in VARIANT_TYPES:
+                if alternate_bases is None or variant_type is None:
+                    queries.append((reference_bases, alternate_bases,
+                                    variant_type))
+    records = []
+    for _ in range(400):
+        reference = mix_case(''.join(random_state.choices(
+            'ACGTN', k=random_state.randint(1, 4))), random_state)
+        alts = []
+        for _ in range(random_state.randint(1, 3)):
+            kind = random_state.randrange(3)
+            if kind == 0:
+                alts.append(random_state.choice(SYMBOLIC_ALTS))
+            elif kind == 1:
+                alts.append(reference[:1] + reference
+                            * random_state.randint(0, 3))
+            else:
+                alts.append(mix_case(''.join(random_state.choices(
+                    CODES, k=random_state.randint(1, 5))), random_state))
+        records.append((random_state.randint(1, 50), reference,
+                        ','.join(alts)))
+
+    def get_finders():
+        return [
+            get_hit_finder(reference_bases, 10, 30, alternate_bases,
+                           variant_type)
+            for reference_bases, alternate_bases, variant_type in queries
+        ]
+
+    finders = get_finders()
+    with monkeypatch.context() as patch:
+        # The old matching upper cased each sequence before looking it up
+        patch.setattr(allele_matching, 'compile_code_matcher', lambda code: (
+            lambda sequence, codes=get_possible_codes(code): (
+                sequence.upper() in codes)))
+        patch.setattr(allele_matching, 'is_repeat', regex_is_repeat)
+        expanded_finders = get_finders()
+    for query, find_hits, expanded_find_hits in zip(queries, finders,
+                                                    expanded_finders):
+        for record in records:
+            assert (find_hits(*record)
+                    == expanded_find_hits(*record)), (query, record)
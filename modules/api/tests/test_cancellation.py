@@ -0,0 +1,70 @@
+from botocore.exceptions import ClientError
+
+import cancellation
+from cancellation import Cancellation
+
+
+class FakeS3:
+    """
+    Stands in for the S3 client, holding the markers left so far.
+    """
+    def __init__(self):
+        self.markers = set()
+        self.heads = 0
+
+    def head_object(self, Bucket, Key):
+        self.heads += 1
+        if Key not in self.markers:
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        return {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.markers.add(Key)
+        return {}
+
+
+class FakeStopped:
+    """
+    Stands in for the stopped event, recording how long the poller waits
+    and leaving a marker once it has waited a number of times.
+    """
+    def __init__(self, fake_s3, marker_after):
+        self.fake_s3 = fake_s3
+        self.marker_after = marker_after
+        self.waits = []
+
+    def wait(self, timeout):
+        self.waits.append(timeout)
+        if len(self.waits) > self.marker_after:
+            self.fake_s3.markers.add('parent')
+        return False
+
+
+def test_polling_backs_off(monkeypatch):
+    fake_s3 = FakeS3()
+    monkeypatch.setattr(cancellation, 's3', fake_s3)
+    child = Cancellation('test', parent_keys=['grandparent', 'parent'])
+    child.stopped = FakeStopped(fake_s3, 6)
+    child._poll()
+    assert child.is_cancelled()
+    assert child.stopped.waits == [0.5, 1, 2, 4, 4, 4, 4]
+    assert fake_s3.heads == 2 * 6 + 2
+
+
+def test_keyless_invocation_leaves_no_marker(monkeypatch):
+    fake_s3 = FakeS3()
+    monkeypatch.setattr(cancellation, 's3', fake_s3)
+    parent = Cancellation('test')
+    assert parent.child_keys == []
+    with parent:
+        parent.cancel_children()
+    assert parent.poller is None
+    assert parent.should_dispatch()
+    assert not fake_s3.markers
+    # With a key, children are given it to watch, and stop dispatching
+    # once it's left
+    parent = Cancellation('test', 'parent', ['grandparent'])
+    assert parent.child_keys == ['grandparent', 'parent']
+    parent.cancel_children()
+    assert not parent.should_dispatch()
+    assert fake_s3.markers == {'parent'}
@@ -0,0 +1,128 @@
+import pytest
+
+from memory_cache import MemoryCache
+
+VCF_LOCATION = 's3://test/test.vcf.gz'
+DATASET = {
+    'annotation_index': None,
+    'annotation_location': None,
+    'dataset_id': 'test',
+    'description': 'test',
+    'name': 'test',
+    'vcf_locations': {
+        VCF_LOCATION: '1',
+    },
+    'vcf_etags': {
+        VCF_LOCATION: 'summarised',
+    },
+    'index_etags': {
+        VCF_LOCATION: 'summarised',
+    },
+    'sample_count': 20,
+    'update_date_time': '2026-10-01T00:00:00',
+}
+QUERY_DETAILS = {
+    'region_start': 100,
+    'region_end': 200,
+    'end_min': 100,
+    'end_max': 300,
+    'reference_bases': 'N',
+    'alternate_bases': 'A',
+    'variant_type': None,
+    'include_datasets': 'ALL',
+    'sample_fields': None,
+}
+PAGE_DETAILS = {
+    'page': 1,
+    'page_size': None,
+    'sortby': 'pos',
+    'desc': False,
+}
+
+
+class FakeTable:
+    """
+    Stands in for the DynamoDB client, holding the cache table in memory.
+    Like the table, it is left as it was when the dataset changes until
+    flushCache gets to it.
+    """
+    def __init__(self):
+        self.items = {}
+
+    def get_item(self, TableName, Key, **kwargs):
+        item = self.items.get((Key['datasetId']['S'], Key['queryArgs']['S']))
+        return {} if item is None else {'Item': item}
+
+    def put_item(self, TableName, Item):
+        self.items[Item['datasetId']['S'], Item['queryArgs']['S']] = Item
+        return {}
+
+    def query(self, TableName, ExpressionAttributeValues, **kwargs):
+        dataset_id = ExpressionAttributeValues[':datasetId']['S']
+        prefix = ExpressionAttributeValues[':prefix']['S']
+        return {
+            'Items': [
+                item for (item_dataset_id, query_args), item
+                in self.items.items()
+                if item_dataset_id == dataset_id
+                and query_args.startswith(prefix)
+            ],
+        }
+
+
+@pytest.fixture
+def split_query_lambda(split_query_lambda, monkeypatch):
+    monkeypatch.setattr(split_query_lambda, 'dynamodb', FakeTable())
+    monkeypatch.setattr(split_query_lambda, 'response_cache',
+                        MemoryCache('Test response cache', 2**20))
+    return split_query_lambda
+
+
+def answer_query(split_query_lambda, dataset):
+    """
+    Answers the query as splitQuery would, returning whether the vcfs had
+    to be queried.
+    """
+    plan = split_query_lambda.plan_query(dataset, QUERY_DETAILS, PAGE_DETAILS)
+    queried = 'run_details' in plan
+    if queried:
+        totals = split_query_lambda.new_totals()
+        split_query_lambda.add_to_totals(totals, {
+            'all_alleles_count': 40,
+            'call_count': 2,
+            'exists': True,
+            'variant_call_counts': {
+                '150N>A': 2,
+            },
+            'variant_samples': {
+                '150N>A': [3, 7],
+            },
+            'vcf_location': VCF_LOCATION,
+        }, check_all=True)
+        plan['stored'] = split_query_lambda.get_stored_result(
+            dataset, plan['run_details'], totals)
+    split_query_lambda.complete_query(dataset, QUERY_DETAILS, PAGE_DETAILS,
+                                      plan)
+    return queried
+
+
+@pytest.mark.parametrize('change', [
+    # Resubmitted, perhaps with new sample metadata at the same location
+    {
+        'update_date_time': '2026-10-02T00:00:00',
+    },
+    # A vcf replaced in place
+    {
+        'vcf_etags': {
+            VCF_LOCATION: 'replaced',
+        },
+    },
+])
+def test_changed_dataset_misses_cache(split_query_lambda, change):
+    assert answer_query(split_query_lambda, DATASET)
+    assert not answer_query(split_query_lambda, DATASET)
+    changed_dataset = dict(DATASET, **change)
+    # Neither the response in memory nor the cache item is used, though
+    # the item hasn't yet been flushed
+    assert answer_query(split_query_lambda, changed_dataset)
+    assert not answer_query(split_query_lambda, changed_dataset)
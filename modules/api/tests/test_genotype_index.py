@@ -0,0 +1,191 @@
+import io
+import random
+
+import pytest
+
+from genotype_index import GenotypeIndex, GenotypeIndexWriter, get_index_key
+
+VCF_LOCATION = 's3://test/test.vcf.gz'
+VCF_ETAG = 'summarised'
+CHROM = '1'
+SLICES = [(1, 150), (151, 400)]
+SAMPLE_COUNT = 12
+
+REFERENCES = ['A', 'C', 'G', 'T', 'AC', 'GT']
+# Enough alts for allele numbers with more than one digit
+ALTS = ['A', 'C', 'G', 'T', 'AT', 'ACAC', 'GTGT', 'TA', 'CA', 'GG', 'TT',
+        '<DEL>', '<DUP>']
+SEPARATORS = ['/', '|']
+
+QUERIES = [
+    ('N', 'N', None),
+    ('N', 'A', None),
+    ('N', 'TT', None),
+    ('A', 'C', None),
+    ('AC', 'ACAC', None),
+    ('N', None, 'DEL'),
+    ('N', None, 'DUP'),
+]
+REGIONS = [
+    (1, 400),
+    (100, 200),
+    (150, 151),
+    (390, 400),
+]
+
+
+def make_genotype(random_state, num_alts):
+    alleles = [0, 0, '.', *range(1, num_alts + 1)]
+    ploidy = random_state.choice([1, 2, 2, 2])
+    calls = [str(random_state.choice(alleles)) for _ in range(ploidy)]
+    return random_state.choice(SEPARATORS).join(calls)
+
+
+def make_records(random_state):
+    """
+    Returns records as `bcftools query` would give them, with haploid,
+    diploid, phased, missing and partial calls, and allele numbers of more
+    than one digit.
+    """
+    records = []
+    for pos in sorted(random_state.sample(range(1, 401), 200)):
+        reference = random_state.choice(REFERENCES)
+        alts = random_state.sample(ALTS, random_state.randint(1, len(ALTS)))
+        genotypes = ''.join(
+            f'{make_genotype(random_state, len(alts))},'
+            for _ in range(SAMPLE_COUNT))
+        records.append((pos, reference, ','.join(alts), genotypes))
+    return records
+
+
+def write_indexes(records, directory):
+    """
+    Writes the genotype index of each slice as summariseSlice would,
+    returning them by key.
+    """
+    indexes = {}
+    for start, end in SLICES:
+        writer = GenotypeIndexWriter()
+        for pos, reference, all_alts, genotypes in records:
+            if start <= pos <= end:
+                writer.add_record(pos, reference, all_alts, genotypes)
+        path = directory / f'{start}-{end}.gti'
+        path.write_bytes(writer.to_bytes())
+        indexes[get_index_key(VCF_LOCATION, CHROM, start, end)] = (
+            GenotypeIndex(str(path)))
+    return indexes
+
+
+class FakeQuery:
+    """
+    Stands in for subprocess.Popen running `bcftools query` over a vcf
+    holding records.
+    """
+    def __init__(self, records):
+        self.records = ''.join(
+            f'{pos}\t{reference}\t{all_alts}\tDP=30\t{genotypes}\n'
+            for pos, reference, all_alts, genotypes in records).encode()
+
+    def __call__(self, args, **kwargs):
+        self.stdout = io.BytesIO(self.records)
+        return self
+
+
+class FakeS3:
+    """
+    Stands in for the S3 client, listing the genotype indexes a page at a
+    time.
+    """
+    def __init__(self, keys):
+        self.keys = sorted(keys)
+        self.lists = 0
+
+    def list_objects_v2(self, Bucket, Prefix, ContinuationToken=None):
+        self.lists += 1
+        start = int(ContinuationToken or 0)
+        keys = [key for key in self.keys if key.startswith(Prefix)]
+        response = {
+            'Contents': [
+                {
+                    'Key': key,
+                    'ETag': f'"{key}"',
+                }
+                for key in keys[start:start+1]
+            ],
+        }
+        if start + 1 < len(keys):
+            response['NextContinuationToken'] = str(start + 1)
+        return response
+
+
+@pytest.fixture
+def records():
+    return make_records(random.Random(0))
+
+
+@pytest.fixture
+def fake_s3(perform_query_lambda, records, tmp_path, monkeypatch):
+    indexes = write_indexes(records, tmp_path)
+    fake_s3 = FakeS3(indexes)
+    monkeypatch.setattr(perform_query_lambda, 's3', fake_s3)
+    monkeypatch.setattr(perform_query_lambda, 'load_genotype_index',
+                        lambda key, etag: indexes[key])
+    monkeypatch.setattr(perform_query_lambda, 'genotype_index_lists',
+                        perform_query_lambda.MemoryCache(
+                            'Test genotype index lists', 2**20))
+    return fake_s3
+
+
+def get_queries(include_details):
+    return [
+        {
+            'reference_bases': reference_bases,
+            'region_start': region_start,
+            'region_end': region_end,
+            'end_min': region_start,
+            'end_max': 500,
+            'alternate_bases': alternate_bases,
+            'variant_type': variant_type,
+            'include_details': include_details,
+        }
+        for reference_bases, alternate_bases, variant_type in QUERIES
+        for region_start, region_end in REGIONS
+    ]
+
+
+@pytest.mark.parametrize('include_details', [True, False])
+def test_index_matches_bcftools(perform_query_lambda, records, fake_s3,
+                                include_details):
+    queries = get_queries(include_details)
+    splits = [(1, 100), (101, 300), (301, 400)]
+
+    def query(vcf_etag, popen):
+        return perform_query_lambda.perform_queries(
+            queries, VCF_LOCATION, CHROM, splits, vcf_etag=vcf_etag,
+            popen=popen)
+
+    def fail_popen(args, **kwargs):
+        raise AssertionError("bcftools was run")
+
+    indexed = query(VCF_ETAG, fail_popen)
+    assert fake_s3.lists == len(SLICES)
+    assert indexed == query(None, FakeQuery(records))
+    # The listing is kept for the vcf's eTag
+    assert query(VCF_ETAG, fail_popen) == indexed
+    assert fake_s3.lists == len(SLICES)
+
+
+def test_unindexed_vcf_is_not_listed(perform_query_lambda, records, fake_s3):
+    queries = get_queries(True)
+    # Replaced in place, or still being summarised, so splitQuery gives no
+    # eTag for its indexes
+    perform_query_lambda.perform_queries(
+        queries, VCF_LOCATION, CHROM, [(1, 400)], vcf_etag=None,
+        popen=FakeQuery(records))
+    assert fake_s3.lists == 0
+    # Indexes that don't cover the region aren't used
+    fake_s3.keys = fake_s3.keys[:1]
+    perform_query_lambda.perform_queries(
+        queries, VCF_LOCATION, CHROM, [(1, 400)], vcf_etag=VCF_ETAG,
+        popen=FakeQuery(records))
+    assert fake_s3.lists == 1
@@ -0,0 +1,102 @@
+import random
+import re
+
+import numpy as np
+import pytest
+
+from genotypes import get_allele_carriers, parse_genotypes
+
+SEPARATORS = ['/', '|']
+
+all_count_pattern = re.compile('[0-9]+')
+alt_pattern = re.compile('\\b([1-9][0-9]*)\\b')
+
+
+def regex_calls(genotypes):
+    # How calls were found before parse_genotypes, one sample at a time.
+    calls = []
+    for i, gt in enumerate(genotypes.rstrip(',\r\n').split(',')):
+        calls += [(i, int(call)) for call in all_count_pattern.findall(gt)]
+    return calls
+
+
+def regex_carriers(genotypes, allele):
+    # As VariantGenotypes.alt_indexes found the samples holding an alt
+    return [
+        i for i, gt in enumerate(genotypes.rstrip(',\r\n').split(','))
+        if allele - 1 in {int(call) - 1 for call in alt_pattern.findall(gt)}
+    ]
+
+
+def make_genotype(random_state, num_alts, ploidy):
+    alleles = [0, 0, '.', *range(1, num_alts + 1)]
+    separator = random_state.choice(SEPARATORS)
+    return separator.join(str(random_state.choice(alleles))
+                          for _ in range(ploidy))
+
+
+def make_genotypes(random_state, ploidies):
+    num_alts = random_state.choice([1, 2, 3, 9, 12, 120])
+    sample_count = random_state.randint(1, 30)
+    genotypes = ''.join(
+        make_genotype(random_state, num_alts, random_state.choice(ploidies))
+        + ','
+        for _ in range(sample_count))
+    return genotypes, num_alts
+
+
+def check_matches_regex(genotypes, num_alts):
+    for column in (genotypes, genotypes + '\n', genotypes.encode()):
+        samples, alleles = parse_genotypes(column)
+        assert samples.dtype == alleles.dtype == np.int32
+        assert list(zip(samples.tolist(), alleles.tolist())) == regex_calls(
+            genotypes), genotypes
+        for allele in range(1, num_alts + 1):
+            assert get_allele_carriers(samples, alleles, allele).tolist() == (
+                regex_carriers(genotypes, allele)), (genotypes, allele)
+
+
+@pytest.mark.parametrize('genotypes, num_alts', [
+    # Haploid
+    ('0,1,0,', 1),
+    ('1,.,2,0,', 2),
+    ('.,.,', 1),
+    ('1', 1),
+    # Diploid, phased and unphased
+    ('0/0,0/1,1/1,', 1),
+    ('0|1,1|0,1|2,2/2,', 2),
+    # Missing and partial calls
+    ('./.,.|.,0/.,./1,.|2,', 2),
+    ('./.,', 1),
+    # Allele numbers of more than one digit
+    ('0/10,10/11,1/12,12|1,', 12),
+    ('110/9,.|119,', 120),
+    ('10,11,.,', 11),
+    # Mixed ploidy and polyploid
+    ('0,0/1,1/1/2,1|0|0|1,.,', 2),
+    # No samples
+    ('', 1),
+])
+def test_parse_genotypes_matches_regex(genotypes, num_alts):
+    check_matches_regex(genotypes, num_alts)
+
+
+@pytest.mark.parametrize('ploidies', [[1], [2], [1, 2], [1, 2, 3, 4]])
+def test_random_genotypes_match_regex(ploidies):
+    random_state = random.Random(len(ploidies))
+    for _ in range(200):
+        check_matches_regex(*make_genotypes(random_state, ploidies))
+
+
+def test_counts_match_regex():
+    random_state = random.Random(0)
+    for _ in range(200):
+        genotypes, num_alts = make_genotypes(random_state, [1, 2])
+        calls = regex_calls(genotypes)
+        _, alleles = parse_genotypes(genotypes)
+        # performQuery's AN and AC when they aren't in INFO
+        assert len(alleles) == len(calls)
+        hit_alleles = random_state.sample(range(1, num_alts + 1),
+                                          random_state.randint(1, num_alts))
+        assert np.count_nonzero(np.isin(alleles, hit_alleles)) == sum(
+            1 for _, call in calls if call in hit_alleles)
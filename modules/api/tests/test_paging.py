@@ -0,0 +1,202 @@
+import gzip
+import io
+import json
+import random
+
+import pytest
+
+SAMPLE_FIELDS = ['Location', 'SampleCollectionDate']
+SAMPLE_COUNT = 2000
+VARIANT_COUNT = 95
+LOCATIONS = ['NSW', 'VIC', 'QLD', 'WA']
+
+
+def make_response(random_state):
+    variants = []
+    for pos in random_state.sample(range(1, 10000), VARIANT_COUNT):
+        samples = sorted(random_state.sample(range(SAMPLE_COUNT),
+                                             random_state.randint(1, 20)))
+        variants.append({
+            'pos': pos,
+            'ref': 'A',
+            'alt': 'C',
+            'sampleCount': len(samples),
+            'frequency': len(samples) / SAMPLE_COUNT,
+            'samples': samples,
+        })
+    return {
+        'include': True,
+        'datasetId': 'test',
+        'exists': True,
+        'variantCount': VARIANT_COUNT,
+        'info': {
+            'name': 'test',
+            'variants': variants,
+            'totalEntries': VARIANT_COUNT,
+            'sampleFields': SAMPLE_FIELDS,
+            'sampleDetails': [
+                [random_state.choice(LOCATIONS), f'2026-01-{i % 28 + 1:02}']
+                for i in range(SAMPLE_COUNT)
+            ],
+            'locationCounts': [{location: 1} for location in LOCATIONS],
+        },
+    }
+
+
+class FakeS3:
+    """
+    Stands in for the S3 client, counting the bytes read.
+    """
+    def __init__(self):
+        self.objects = {}
+        self.bytes_read = 0
+
+    def put_object(self, bucket, key, body):
+        self.objects[key] = body
+
+    def get_object(self, bucket, key, byte_range=None):
+        body = self.objects[key]
+        if byte_range is not None:
+            body = body[byte_range[0]:byte_range[1]]
+        self.bytes_read += len(body)
+        return io.BytesIO(body)
+
+
+class FakeTable:
+    """
+    Stands in for the DynamoDB client, holding a single cache item.
+    """
+    def __init__(self, item):
+        self.item = item
+
+    def get_item(self, **kwargs):
+        return {
+            'Item': self.item,
+        }
+
+    def update_item(self, ExpressionAttributeNames, ExpressionAttributeValues,
+                    **kwargs):
+        self.item[ExpressionAttributeNames['#page']] = (
+            ExpressionAttributeValues[':page'])
+        return {}
+
+
+class FakeLambda:
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, **kwargs):
+        self.invocations.append(kwargs)
+        return {
+            'StatusCode': 202,
+        }
+
+
+@pytest.fixture
+def response():
+    return make_response(random.Random(0))
+
+
+@pytest.fixture
+def fakes(split_query_lambda, response, monkeypatch):
+    fake_s3 = FakeS3()
+    fake_s3.objects['test/args.json.gz'] = gzip.compress(json.dumps({
+        'response': response,
+        'details': None,
+    }).encode())
+    item = {
+        'queryLocation': {
+            'S': 'test/args.json.gz',
+        },
+        'datasetVersion': {
+            'S': 'version',
+        },
+    }
+    fake_lambda = FakeLambda()
+    monkeypatch.setattr(split_query_lambda, 's3', fake_s3)
+    monkeypatch.setattr(split_query_lambda, 'dynamodb', FakeTable(item))
+    monkeypatch.setattr(split_query_lambda, 'aws_lambda', fake_lambda)
+    monkeypatch.setenv('AWS_LAMBDA_FUNCTION_NAME', 'splitQuery')
+    return fake_s3, item, fake_lambda
+
+
+@pytest.mark.parametrize('sortby, desc', [('pos', False), ('pos', True),
+                                          ('sampleCount', True)])
+def test_indexed_pages_match_full_response(split_query_lambda, response,
+                                           fakes, sortby, desc):
+    fake_s3, item, fake_lambda = fakes
+    page_details = {
+        'page': 2,
+        'page_size': 10,
+        'sortby': sortby,
+        'desc': desc,
+    }
+    plan = {
+        'dataset_version': 'version',
+        'item': item,
+        'query_args': 'args',
+        'response': response,
+        'stored': {
+            'response': response,
+            'details': None,
+        },
+    }
+    full_page = split_query_lambda.complete_query(
+        {'dataset_id': 'test'}, {}, page_details, plan)
+    # The sorted copy is left to another invocation
+    assert fake_s3.objects.keys() == {'test/args.json.gz'}
+    (invocation,) = fake_lambda.invocations
+    assert invocation['InvocationType'] == 'Event'
+    split_query_lambda.lambda_handler(json.loads(invocation['Payload']),
+                                      None)
+    page_index = item[split_query_lambda.get_page_attribute(page_details)]
+    copy_size = sum(len(body) for key, body in fake_s3.objects.items()
+                    if key.endswith('.pages'))
+    for page_size in (1, 7, 10, 30, None):
+        pages = -(-VARIANT_COUNT // (page_size or VARIANT_COUNT))
+        for page in range(1, pages + 2):
+            page_details = dict(page_details, page=page, page_size=page_size)
+            for sample_fields in (SAMPLE_FIELDS, ['Location'], []):
+                fake_s3.bytes_read = 0
+                indexed = split_query_lambda.get_indexed_page(
+                    page_index, 'ALL', sample_fields, page_details)
+                expected = split_query_lambda.process_page(
+                    split_query_lambda.reuse_response(response, 'ALL',
+                                                      sample_fields),
+                    page_details)
+                assert indexed == expected, (page, page_size, sample_fields)
+                if page_size == 10:
+                    # Only the page's own sample details are read
+                    assert fake_s3.bytes_read < copy_size / 4
+    assert full_page == split_query_lambda.process_page(response, dict(
+        page_details, page=2, page_size=10))
+    assert full_page['info']['pages'] == 10
+
+
+def test_page_holds_its_own_samples(split_query_lambda, response):
+    page = split_query_lambda.process_page(response, {
+        'page': 3,
+        'page_size': 10,
+        'sortby': 'pos',
+        'desc': False,
+    })
+    info = page['info']
+    variants = sorted(response['info']['variants'],
+                      key=lambda variant: variant['pos'])[20:30]
+    assert len(info['sampleDetails']) == len(set(
+        sample for variant in variants for sample in variant['samples']))
+    for page_variant, variant in zip(info['variants'], variants):
+        assert [info['sampleDetails'][sample]
+                for sample in page_variant['samples']] == [
+            response['info']['sampleDetails'][sample]
+            for sample in variant['samples']]
+    # A single page is left with every sample's details
+    whole = split_query_lambda.process_page(response, {
+        'page': 1,
+        'page_size': None,
+        'sortby': 'pos',
+        'desc': False,
+    })
+    assert len(whole['info']['sampleDetails']) == len(set(
+        sample for variant in response['info']['variants']
+        for sample in variant['samples']))
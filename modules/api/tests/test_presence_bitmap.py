@@ -0,0 +1,155 @@
+import random
+
+import pytest
+
+from allele_matching import IUPAC_MATCHES, get_hit_finder
+from presence_bitmap import PresenceBitmap, PresenceBitmapWriter
+
+CODES = list(IUPAC_MATCHES)
+SYMBOLIC_ALTS = ['<DEL>', '<INS>', '<DUP>', '<CN0>', '<CN3>', '.', '*']
+
+
+def make_bitmap(slices, records):
+    """
+    Builds the presence bitmap of records of (pos, ref, alts) as if each
+    slice of (start, end) had been summarised.
+    """
+    bodies = []
+    for start, end in slices:
+        writer = PresenceBitmapWriter(start, end)
+        for pos, reference, all_alts in records:
+            writer.add_record(pos, reference, all_alts)
+        bodies.append((start, end, writer.to_bytes()))
+    # Slices are listed in key order, not position order
+    random.Random(0).shuffle(bodies)
+    return PresenceBitmap(bodies)
+
+
+@pytest.mark.parametrize('region_start, region_end, expected', [
+    (1, 9, False),
+    (10, 10, True),
+    (11, 19, False),
+    (15, 25, True),
+    (21, 100, False),
+    # Spans the boundary between two slices
+    (90, 110, False),
+    (90, 150, True),
+    # Runs into the part no slice covers
+    (180, 210, True),
+    (250, 260, True),
+    (301, 400, True),
+    (0, 5, True),
+])
+def test_may_match_covers_summarised_slices(region_start, region_end,
+                                            expected):
+    records = [(10, 'A', 'G'), (20, 'C', 'T'), (150, 'G', '<DEL>'),
+               (250, 'T', 'A')]
+    bitmap = make_bitmap([(1, 100), (101, 200), (241, 300)], records)
+    assert bitmap.may_match(region_start, region_end, None) == expected
+    if not expected:
+        for alternate_bases in ('A', 'N', 'AC'):
+            assert not bitmap.may_match(region_start, region_end,
+                                        alternate_bases)
+
+
+@pytest.mark.parametrize('reference, all_alts, matching, not_matching', [
+    ('A', 'G', 'GRKSVDBN', 'ACTUMWYH'),
+    ('A', 'R', 'AGMRWSKVHDBN', 'CTUY'),
+    ('A', 'u', 'TUWYKHDBN', 'ACGMRSV'),
+    # Truncated to C, as performQuery does
+    ('AT', 'CT', 'CMSYVHBN', 'AGTURWKD'),
+    # Not single bases, so only multiple base alts could match
+    ('A', 'AT', '', CODES),
+    ('A', '<DEL>,<CN3>', '', CODES),
+    ('A', 'G,<INS>', 'GRKSVDBN', 'ACTUMWYH'),
+])
+def test_may_match_single_base_alts(reference, all_alts, matching,
+                                    not_matching):
+    bitmap = make_bitmap([(1, 100)], [(50, reference, all_alts)])
+    for alternate_bases in matching:
+        assert bitmap.may_match(40, 60, alternate_bases), alternate_bases
+    for alternate_bases in not_matching:
+        assert not bitmap.may_match(40, 60, alternate_bases), alternate_bases
+    # Any record could match a longer alt or a variant type
+    assert bitmap.may_match(40, 60, 'AT')
+    assert bitmap.may_match(40, 60, None)
+    assert not bitmap.may_match(51, 60, None)
+
+
+def test_may_match_finds_every_hit():
+    random_state = random.Random(0)
+    records = []
+    for pos in random_state.sample(range(1, 301), 60):
+        reference = ''.join(random_state.choices('ACGT',
+                                                 k=random_state.randint(1, 3)))
+        alts = []
+        for _ in range(random_state.randint(1, 3)):
+            kind = random_state.randrange(3)
+            if kind == 0:
+                alts.append(random_state.choice(SYMBOLIC_ALTS))
+            elif kind == 1:
+                # Shares a suffix with the reference, so is truncated
+                alts.append(random_state.choice(CODES) + reference[1:])
+            else:
+                alts.append(''.join(random_state.choices(
+                    CODES + [code.lower() for code in CODES],
+                    k=random_state.randint(1, 3))))
+        records.append((pos, reference, ','.join(alts)))
+    bitmap = make_bitmap([(1, 120), (121, 300)], records)
+    queries = [(code, None) for code in CODES]
+    queries += [(''.join(random_state.choices(CODES, k=2)), None)
+                for _ in range(20)]
+    queries += [(None, variant_type)
+                for variant_type in ('DEL', 'INS', 'DUP', 'CNV')]
+    for alternate_bases, variant_type in queries:
+        find_hits = get_hit_finder('N', 1, 400, alternate_bases, variant_type)
+        for _ in range(50):
+            region_start = random_state.randint(1, 300)
+            region_end = random_state.randint(region_start,
+                                              region_start + 20)
+            hit = any(region_start <= pos <= region_end
+                      and find_hits(pos, reference, all_alts)[1]
+                      for pos, reference, all_alts in records)
+            if hit:
+                assert bitmap.may_match(region_start, region_end,
+                                        alternate_bases), (
+                    alternate_bases, variant_type, region_start, region_end)
+
+
+@pytest.mark.parametrize('current_etag, ruled_out', [
+    ('summarised', True),
+    # Replaced in place and not yet resummarised
+    ('replaced', False),
+])
+def test_replaced_vcf_is_queried(query_datasets_lambda, monkeypatch,
+                                 current_etag, ruled_out):
+    vcf_location = 's3://test/test.vcf.gz'
+    datasets = [{
+        'vcfLocations': {
+            'SS': [vcf_location],
+        },
+    }]
+    monkeypatch.setattr(query_datasets_lambda, 'get_contig_maps',
+                        lambda vcf_locations: (
+                            {vcf_location: [['chr1', 1000, 0, '1']]},
+                            {vcf_location: 'summarised'}))
+    monkeypatch.setattr(query_datasets_lambda, 'read_etag',
+                        lambda location: (location, current_etag))
+    monkeypatch.setattr(query_datasets_lambda, 'load_presence_bitmap',
+                        lambda location, chrom: (
+                            location, make_bitmap([(1, 1000)], [])))
+    monkeypatch.setattr(query_datasets_lambda, 'vcf_etags', {})
+    vcf_chromosomes, vcf_etags, index_etags, presence_bitmaps = (
+        query_datasets_lambda.get_vcf_chromosome_map(datasets, '1'))
+    assert vcf_chromosomes == {vcf_location: 'chr1'}
+    assert vcf_etags == {vcf_location: current_etag}
+    # Nor are its indexes
+    assert index_etags == ({vcf_location: current_etag} if ruled_out
+                           else {})
+    empty_vcfs = query_datasets_lambda.get_empty_vcfs(
+        [vcf_location], presence_bitmaps, {
+            'region_start': 100,
+            'region_end': 200,
+            'alternate_bases': None,
+        })
+    assert empty_vcfs == ([vcf_location] if ruled_out else [])
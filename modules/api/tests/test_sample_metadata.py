@@ -0,0 +1,86 @@
+import io
+import json
+
+import numpy as np
+
+from memory_cache import MemoryCache
+from sample_metadata import get_column_keys, get_manifest_key
+
+VCF_LOCATION = 's3://test/test.vcf.gz'
+
+
+class FakeS3:
+    """
+    Stands in for the S3 client, holding the sample metadata summariseVcf
+    built for a vcf.
+    """
+    def __init__(self, builds):
+        self.objects = {}
+        self.manifest_reads = 0
+        for build, columns in builds.items():
+            for field, (codes, values) in columns.items():
+                codes_key, values_key = get_column_keys(VCF_LOCATION, build,
+                                                        field)
+                codes_file = io.BytesIO()
+                np.save(codes_file, np.asarray(codes, dtype=np.int32))
+                self.objects[codes_key] = codes_file.getvalue()
+                self.objects[values_key] = json.dumps(values).encode()
+        self.set_build(next(iter(builds)), builds)
+
+    def set_build(self, build, builds):
+        self.objects[get_manifest_key(VCF_LOCATION)] = json.dumps({
+            'build': build,
+            'fields': list(builds[build]),
+            'sampleCount': 3,
+        }).encode()
+
+    def get_object(self, bucket, key, byte_range=None):
+        return io.BytesIO(self.objects[key])
+
+    def get_changed_object(self, bucket, key, etag=None):
+        self.manifest_reads += 1
+        body = self.objects[key]
+        current_etag = str(hash(body))
+        if current_etag == etag:
+            return None
+        return current_etag, io.BytesIO(body)
+
+
+def test_columns_are_cached_and_removed(split_query_lambda, tmp_path,
+                                        monkeypatch):
+    builds = {
+        'first': {
+            'Location': ([0, 1, 0], ['NSW', 'VIC']),
+        },
+        'second': {
+            'Location': ([1, 1, 0], ['QLD', 'WA']),
+        },
+    }
+    fake_s3 = FakeS3(builds)
+    now = [1000]
+    monkeypatch.setattr(split_query_lambda, 's3', fake_s3)
+    monkeypatch.setattr(split_query_lambda, 'manifests', {})
+    monkeypatch.setattr(split_query_lambda.time, 'time', lambda: now[0])
+    monkeypatch.setattr(split_query_lambda, 'METADATA_DIR', str(tmp_path))
+    monkeypatch.setattr(split_query_lambda, 'metadata_cache', MemoryCache(
+        'Test metadata cache', 2**20,
+        on_remove=split_query_lambda.metadata_cache.on_remove))
+
+    def get_locations():
+        (codes, values), = split_query_lambda.get_metadata_columns(
+            VCF_LOCATION, ['Location'])
+        return [values[code] for code in codes]
+
+    assert get_locations() == ['NSW', 'VIC', 'NSW']
+    (first_file,) = tmp_path.iterdir()
+    # The manifest is only checked again after a while, and only read
+    # again once it has changed
+    fake_s3.set_build('second', builds)
+    assert get_locations() == ['NSW', 'VIC', 'NSW']
+    assert fake_s3.manifest_reads == 1
+    now[0] += split_query_lambda.MANIFEST_CHECK_SECONDS
+    assert get_locations() == ['WA', 'WA', 'QLD']
+    assert fake_s3.manifest_reads == 2
+    # The column of the earlier build has been replaced, so its file is gone
+    assert not first_file.exists()
+    assert len(list(tmp_path.iterdir())) == 1
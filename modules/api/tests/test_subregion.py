@@ -0,0 +1,134 @@
+import io
+import random
+
+import pytest
+
+VCF_LOCATION = 'test.vcf.gz'
+CHROM = '1'
+REGION_START = 1
+REGION_END = 400
+SAMPLE_COUNT = 20
+
+REFERENCES = ['A', 'C', 'G', 'T', 'AC', 'ACGT', 'GT', 'TTA']
+ALTS = ['A', 'C', 'G', 'T', 'AT', 'ACAC', 'ACACAC', 'GTGT', 'TA', '<DEL>',
+        '<INS>', '<DUP>', '<DUP:TANDEM>', '<CN0>', '<CN2>', '<CN3>', '<CNV>']
+
+ALLELE_QUERIES = [
+    ('N', 'N', None),
+    ('N', 'A', None),
+    ('N', 'AT', None),
+    ('A', 'C', None),
+    ('AC', 'A', None),
+    ('AC', 'ACAC', None),
+    ('N', None, 'DEL'),
+    ('N', None, 'INS'),
+    ('N', None, 'DUP'),
+    ('N', None, 'DUP:TANDEM'),
+    ('N', None, 'CNV'),
+    ('AC', None, 'DEL'),
+    ('AC', None, 'DUP'),
+]
+
+# Covering region and end range, then regions and end ranges within them
+COVERING = (1, 400, 1, 500)
+SUBREGIONS = [
+    (1, 400, 1, 500),
+    (50, 220, 1, 500),
+    (50, 220, 52, 221),
+    (50, 220, 100, 150),
+    (100, 100, 100, 102),
+    (300, 400, 301, 420),
+]
+
+
+def make_records(random_state):
+    records = []
+    for pos in range(REGION_START, REGION_END + 1):
+        reference = random_state.choice(REFERENCES)
+        alts = random_state.sample(ALTS, random_state.randint(1, 3))
+        genotypes = ''.join(
+            f'{random_state.choice([0, 0, 0, ".", *range(1, len(alts)+1)])},'
+            for _ in range(SAMPLE_COUNT))
+        records.append(
+            f'{pos}\t{reference}\t{",".join(alts)}\tDP=30\t{genotypes}\n')
+    return ''.join(records).encode()
+
+
+class FakeQuery:
+    """
+    Stands in for subprocess.Popen running `bcftools query` over a vcf
+    holding records.
+    """
+    def __init__(self, records):
+        self.records = records
+
+    def __call__(self, args, **kwargs):
+        self.stdout = io.BytesIO(self.records)
+        return self
+
+
+def get_query_details(allele_query, region):
+    reference_bases, alternate_bases, variant_type = allele_query
+    region_start, region_end, end_min, end_max = region
+    return {
+        'region_start': region_start,
+        'region_end': region_end,
+        'end_min': end_min,
+        'end_max': end_max,
+        'reference_bases': reference_bases,
+        'alternate_bases': alternate_bases,
+        'variant_type': variant_type,
+        'include_datasets': 'ALL',
+        'sample_fields': None,
+    }
+
+
+def query_vcf(perform_query_lambda, split_query_lambda, dataset,
+              query_details, popen):
+    query = {
+        detail: query_details[detail]
+        for detail in ('reference_bases', 'end_min', 'end_max',
+                       'alternate_bases', 'variant_type', 'region_start',
+                       'region_end')
+    }
+    query['include_details'] = True
+    splits = [(REGION_START, 200), (201, REGION_END)]
+    totals = split_query_lambda.new_totals()
+    for (result,) in perform_query_lambda.perform_queries(
+            [query], VCF_LOCATION, CHROM, splits, popen=popen):
+        result['vcf_location'] = VCF_LOCATION
+        split_query_lambda.add_to_totals(totals, result, True)
+    return split_query_lambda.get_stored_result(dataset, query_details,
+                                                totals)
+
+
+@pytest.fixture
+def dataset(split_query_lambda, monkeypatch):
+    # Annotations are read from S3, so each variant is given a bare one
+    monkeypatch.setattr(
+        split_query_lambda, 'get_annotations',
+        lambda location, index, variants: [
+            {'Variant': variant} for variant in sorted(variants)])
+    return {
+        'dataset_id': 'test',
+        'name': 'test',
+        'description': 'test',
+        'sample_count': SAMPLE_COUNT,
+        'annotation_location': 's3://test/annotations.tsv',
+    }
+
+
+@pytest.mark.parametrize('allele_query', ALLELE_QUERIES)
+def test_subregion_matches_direct_query(perform_query_lambda,
+                                        split_query_lambda, dataset,
+                                        allele_query):
+    popen = FakeQuery(make_records(random.Random(0)))
+    covering = query_vcf(perform_query_lambda, split_query_lambda, dataset,
+                         get_query_details(allele_query, COVERING), popen)
+    for region in SUBREGIONS:
+        query_details = get_query_details(allele_query, region)
+        direct = query_vcf(perform_query_lambda, split_query_lambda,
+                           dataset, query_details, popen)
+        subregion = split_query_lambda.get_subregion(
+            dataset, query_details, covering['details'])
+        assert subregion == direct, region
@@ -0,0 +1,383 @@
+import io
+import random
+import struct
+import zlib
+
+import pytest
+from botocore.exceptions import ClientError
+
+import chrom_matching
+import tabix_reader
+
+VCF_LOCATION = 's3://test/test.vcf.gz'
+# Small enough for chunks to span blocks and records to be split across them
+BLOCK_DATA_SIZE = 200
+# Contigs as (name, header length, positions)
+CONTIGS = [
+    ('1', 250000, 200000),
+    ('2', None, 40000),
+    ('3', 1000, 0),
+]
+REFERENCES = ['A', 'C', 'G', 'T', 'AC', 'GTT']
+# Deletions on contig 1 as (pos, length). The first crosses the boundaries
+# of the finest two levels of bins in either binning, so it lands in a bin
+# covering positions far past it, the second overlaps many windows.
+DELETIONS = [(32000, 1500), (100000, 30000)]
+
+# TBI always bins this way, CSI is given a different binning to follow
+TBI_BINNING = (14, 5)
+CSI_BINNING = (12, 6)
+
+
+def make_records(random_state):
+    """
+    Returns the records of each contig as (pos, ref).
+    """
+    records = {}
+    for name, _, max_pos in CONTIGS:
+        if not max_pos:
+            continue
+        contig_records = [
+            (pos, random_state.choice(REFERENCES))
+            for pos in random_state.sample(range(1, max_pos), 600)
+            if name != '1' or pos not in dict(DELETIONS)
+        ]
+        if name == '1':
+            contig_records += [(pos, 'A' * length)
+                               for pos, length in DELETIONS]
+        records[name] = sorted(contig_records)
+    return records
+
+
+def make_vcf_text(records):
+    """
+    Returns the header and the lines of each record, with the header long
+    enough to take up several blocks.
+    """
+    header = [
+        '##fileformat=VCFv4.2',
+        *(f'##INFO=<ID=TAG{i},Number=1,Type=Integer,Description="Tag {i}">'
+          for i in range(20)),
+    ]
+    for name, length, _ in CONTIGS:
+        if length is None:
+            header.append(f'##contig=<ID={name}>')
+        else:
+            header.append(f'##contig=<ID={name},length={length}>')
+    header.append('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1'
+                  '\tS2')
+    lines = [
+        (name, pos, reference,
+         f'{name}\t{pos}\t.\t{reference}\tG\t.\tPASS\tTAG0={pos}\tGT:DP'
+         f'\t0|1:3\t1/1:4')
+        for name, contig_records in records.items()
+        for pos, reference in contig_records
+    ]
+    return header, lines
+
+
+BLOCK_HEADER_SIZE = tabix_reader.BLOCK_HEADER_SIZE
+
+
+def make_block(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    block_size = BLOCK_HEADER_SIZE + len(deflated) + 8
+    return (b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+            + struct.pack('<H', block_size - 1) + deflated
+            + struct.pack('<2I', zlib.crc32(data), len(data)))
+
+
+EOF_BLOCK = make_block(b'')
+
+
+def bgzip(data):
+    """
+    Compresses data into blocks of BLOCK_DATA_SIZE bytes, returning the
+    compressed data and the offset of each block.
+    """
+    compressed = bytearray()
+    block_offsets = []
+    for start in range(0, len(data), BLOCK_DATA_SIZE):
+        block_offsets.append(len(compressed))
+        compressed += make_block(data[start:start+BLOCK_DATA_SIZE])
+    return bytes(compressed + EOF_BLOCK), block_offsets
+
+
+def reg2bin(beg, end, min_shift, depth):
+    end -= 1
+    level = depth
+    shift = min_shift
+    while level > 0:
+        if beg >> shift == end >> shift:
+            return ((1 << (3 * level)) - 1) // 7 + (beg >> shift)
+        level -= 1
+        shift += 3
+    return 0
+
+
+def make_vcf(records):
+    """
+    Returns the bgzipped vcf, and for each contig its records as
+    (beg, end, start offset, end offset).
+    """
+    header, lines = make_vcf_text(records)
+    text = ''.join(f'{line}\n' for line in header).encode()
+    line_spans = []
+    for name, pos, reference, line in lines:
+        start = len(text)
+        text += f'{line}\n'.encode()
+        line_spans.append((name, pos - 1, pos - 1 + len(reference), start,
+                           len(text)))
+    compressed, block_offsets = bgzip(text)
+
+    def virtual_offset(position):
+        block, within_block = divmod(position, BLOCK_DATA_SIZE)
+        if block == len(block_offsets):
+            block -= 1
+            within_block += BLOCK_DATA_SIZE
+        return (block_offsets[block] << 16) | within_block
+
+    indexed = {}
+    for name, beg, end, start, stop in line_spans:
+        indexed.setdefault(name, []).append(
+            (beg, end, virtual_offset(start), virtual_offset(stop)))
+    return compressed, indexed
+
+
+def make_tabix_aux(names):
+    names = b''.join(name.encode() + b'\x00' for name in names)
+    # vcf format, columns 1, 2 and 0, '#' headers and no skipped lines
+    return struct.pack('<7i', 2, 1, 2, 0, ord('#'), 0, len(names)) + names
+
+
+def index_contig(contig_records, min_shift, depth):
+    """
+    Bins a contig's records, returning the merged chunks of each bin, the
+    linear index and the pseudo bin's chunks.
+    """
+    bins = {}
+    linear_index = []
+    for beg, end, start, stop in contig_records:
+        chunks = bins.setdefault(reg2bin(beg, end, min_shift, depth), [])
+        if chunks and chunks[-1][1] == start:
+            chunks[-1][1] = stop
+        else:
+            chunks.append([start, stop])
+        last_window = (end - 1) >> min_shift
+        if len(linear_index) <= last_window:
+            linear_index += [None] * (last_window + 1 - len(linear_index))
+        for window in range(beg >> min_shift, last_window + 1):
+            if linear_index[window] is None:
+                linear_index[window] = start
+    # Windows without records take the offset of the window before them
+    for window in range(len(linear_index)):
+        if linear_index[window] is None:
+            linear_index[window] = linear_index[window - 1] if window else 0
+    pseudo_chunks = [
+        [contig_records[0][2], contig_records[-1][3]],
+        [len(contig_records), 0],
+    ]
+    return bins, linear_index, pseudo_chunks
+
+
+def pack_chunks(chunks):
+    return struct.pack('<i', len(chunks)) + b''.join(
+        struct.pack('<2Q', *chunk) for chunk in chunks)
+
+
+def make_tbi(indexed, names):
+    min_shift, depth = TBI_BINNING
+    pseudo_bin = ((1 << (3 * (depth + 1))) - 1) // 7 + 1
+    index = b'TBI\x01' + struct.pack('<i', len(names)) + make_tabix_aux(names)
+    for name in names:
+        if name not in indexed:
+            index += struct.pack('<2i', 0, 0)
+            continue
+        bins, linear_index, pseudo_chunks = index_contig(indexed[name],
+                                                         min_shift, depth)
+        index += struct.pack('<i', len(bins) + 1)
+        for bin_number, chunks in sorted(bins.items()):
+            index += struct.pack('<I', bin_number) + pack_chunks(chunks)
+        index += struct.pack('<I', pseudo_bin) + pack_chunks(pseudo_chunks)
+        index += struct.pack(f'<i{len(linear_index)}Q', len(linear_index),
+                             *linear_index)
+    return index
+
+
+def make_csi(indexed, names):
+    min_shift, depth = CSI_BINNING
+    pseudo_bin = ((1 << (3 * (depth + 1))) - 1) // 7 + 1
+    aux = make_tabix_aux(names)
+    index = (b'CSI\x01' + struct.pack('<3i', min_shift, depth, len(aux)) + aux
+             + struct.pack('<i', len(names)))
+    for name in names:
+        if name not in indexed:
+            index += struct.pack('<i', 0)
+            continue
+        bins, linear_index, pseudo_chunks = index_contig(indexed[name],
+                                                         min_shift, depth)
+        index += struct.pack('<i', len(bins) + 1)
+        for bin_number, chunks in sorted(bins.items()):
+            # As htslib does, each bin's offset is where the linear index
+            # has its first window
+            level = next(level for level in range(depth, -1, -1)
+                         if bin_number >= ((1 << (3 * level)) - 1) // 7)
+            first_window = ((bin_number - ((1 << (3 * level)) - 1) // 7)
+                            << (3 * (depth - level)))
+            loffset = linear_index[min(first_window, len(linear_index) - 1)]
+            index += struct.pack('<IQ', bin_number, loffset) + pack_chunks(
+                chunks)
+        index += struct.pack('<IQ', pseudo_bin, 0) + pack_chunks(pseudo_chunks)
+    return index
+
+
+class FakeS3:
+    """
+    Stands in for the boto3 S3 client, recording the ranges read.
+    """
+    def __init__(self, objects):
+        self.objects = objects
+        self.ranges = []
+        self.heads = 0
+
+    def get_object(self, Bucket, Key, Range=None):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        body = self.objects[Key]
+        if Range is not None:
+            start, end = map(int, Range[len('bytes='):].split('-'))
+            self.ranges.append((Key, start))
+            body = body[start:end+1]
+        return {
+            'Body': io.BytesIO(body),
+            'ETag': f'"{hash(self.objects[Key])}"',
+        }
+
+    def head_object(self, Bucket, Key):
+        self.heads += 1
+        return {
+            'ETag': f'"{hash(self.objects[Key])}"',
+        }
+
+
+@pytest.fixture
+def records():
+    return make_records(random.Random(0))
+
+
+@pytest.fixture
+def vcf(records):
+    return make_vcf(records)
+
+
+@pytest.fixture(params=['.tbi', '.csi'])
+def fake_s3(vcf, monkeypatch, request):
+    compressed, indexed = vcf
+    names = [name for name, _, _ in CONTIGS]
+    make_index = make_tbi if request.param == '.tbi' else make_csi
+    index, _ = bgzip(make_index(indexed, names))
+    fake_s3 = FakeS3({
+        'test.vcf.gz': compressed,
+        'test.vcf.gz' + request.param: index,
+    })
+    monkeypatch.setattr(tabix_reader, 's3', fake_s3)
+    monkeypatch.setattr(tabix_reader, 'open_readers', {})
+    return fake_s3
+
+
+def get_expected(records, chrom, start, end):
+    return [
+        (pos, reference) for pos, reference in records.get(chrom, [])
+        if pos <= end and pos + len(reference) > start
+    ]
+
+
+def fetch(reader, chrom, start, end):
+    return [
+        (int(fields[1]), fields[3].decode())
+        for fields in (line.split(b'\t') for line in reader.fetch(chrom,
+                                                                  start, end))
+    ]
+
+
+def test_fetch_matches_records(records, fake_s3):
+    reader = tabix_reader.get_reader(VCF_LOCATION)
+    random_state = random.Random(1)
+    regions = [
+        ('1', 1, 250000),
+        ('1', 16384, 16385),
+        ('1', 131072, 131073),
+        ('2', 1, 40000),
+        ('3', 1, 1000),
+        ('4', 1, 1000),
+    ]
+    for _ in range(100):
+        chrom = random_state.choice(['1', '2'])
+        start = random_state.randint(1, 200000)
+        regions.append((chrom, start, start + random_state.randint(0, 5000)))
+    for chrom, start, end in regions:
+        assert fetch(reader, chrom, start, end) == get_expected(
+            records, chrom, start, end), (chrom, start, end)
+
+
+def test_linear_index_skips_earlier_blocks(records, vcf, fake_s3):
+    reader = tabix_reader.get_reader(VCF_LOCATION)
+    start = 60000
+    end = start + 100
+    # The first deletion is in the level 4 bin covering the region
+    _, indexed = vcf
+    (deletion_pos, _), _ = DELETIONS
+    deletion_beg, deletion_end, _, deletion_stop = next(
+        record for record in indexed['1'] if record[0] == deletion_pos - 1)
+    deletion_bin = reg2bin(deletion_beg, deletion_end, reader.min_shift,
+                           reader.depth)
+    assert deletion_bin == reader._level_offset(4)
+    assert deletion_bin in set(reader._region_bins(start - 1, end))
+    fake_s3.ranges.clear()
+    assert fetch(reader, '1', start, end) == get_expected(records, '1', start,
+                                                          end)
+    # Its chunk ends before the first record overlapping the region, so
+    # none of the blocks it spans are read
+    assert fake_s3.ranges
+    assert all(range_start > deletion_stop >> 16
+               for _, range_start in fake_s3.ranges)
+
+
+def test_contigs_match_bcftools(records, fake_s3, monkeypatch):
+    reader = tabix_reader.get_reader(VCF_LOCATION)
+    expected = {
+        '1': (250000, len(records['1'])),
+        '2': (None, len(records['2'])),
+    }
+    assert reader.get_contigs() == expected
+    assert reader.has_info('TAG0', 'TAG19')
+    assert not reader.has_info('TAG20')
+
+    def check_output(args, **kwargs):
+        return ''.join(f'{name}\t{"." if length is None else length}'
+                       f'\t{records}\n'
+                       for name, (length, records) in expected.items())
+
+    monkeypatch.setattr(chrom_matching.subprocess, 'check_output',
+                        check_output)
+    monkeypatch.setattr(chrom_matching, 'clear_tmp', lambda: None)
+    assert chrom_matching.get_vcf_chromosomes('test.vcf.gz') == expected
+
+
+def test_index_is_checked_after_a_while(fake_s3, monkeypatch):
+    now = [1000]
+    monkeypatch.setattr(tabix_reader.time, 'time', lambda: now[0])
+    reader = tabix_reader.get_reader(VCF_LOCATION)
+    assert tabix_reader.get_reader(VCF_LOCATION) is reader
+    assert fake_s3.heads == 0
+    now[0] += tabix_reader.INDEX_CHECK_SECONDS
+    assert tabix_reader.get_reader(VCF_LOCATION) is reader
+    assert fake_s3.heads == 1
+    # A rebuilt index is read again once it's next checked
+    index_key = next(key for key in fake_s3.objects if key != 'test.vcf.gz')
+    fake_s3.objects[index_key] += tabix_reader.gzip.compress(b'')
+    assert tabix_reader.get_reader(VCF_LOCATION) is reader
+    now[0] += tabix_reader.INDEX_CHECK_SECONDS
+    assert tabix_reader.get_reader(VCF_LOCATION) is not reader
+    assert fake_s3.heads == 2
@@ -13,6 +13,18 @@ variable max_api_requests_per_ip_in_five_minutes {
   default = 300
 }
 
+variable vcf-reader {
+  type = string
+  description = "How vcfs are read when querying and summarising. Either \"bcftools\" or \"python\" for the in-process tabix reader."
+  default = "bcftools"
+}
+
+variable sample-encoding {
+  type = string
+  description = "How performQuery sends matching sample indexes to splitQuery. Either \"json\" lists or \"varint\" for base64 packed varints."
+  default = "json"
+}
+
 variable organisation-id {
   type = string
   description = "Unique identifier of the organization providing the beacon."